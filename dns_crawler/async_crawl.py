@@ -0,0 +1,137 @@
+# Copyright © 2019-2021 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from . import dns_transport
+from .crawl import (build_dns_local, dump_result, get_dns_auth_async, get_dns_local_records, get_mail_records,
+                    get_web_statuses_async, is_dead, timed_stage)
+from .imports import lazy_import
+from .mail_utils import get_mx_info_async
+from .utils import get_private_loop, run_async
+
+
+class AsyncCrawler:
+    """Crawls many domains at once in a single process, using the setup of a (sync) Crawler.
+
+    DNS lookups, CHAOS queries to the nameservers, and SMTP banners use asyncio. HTTP(S) checks (and SPF/DMARC
+    parsing, which might do DNS lookups of its own) don't have an async implementation, so they run in a thread pool.
+    """
+
+    def __init__(self, crawler, concurrency=None, threads=None):
+        self.crawler = crawler
+        self.concurrency = int(concurrency or crawler.config["async"]["concurrency"])
+        self.threads = int(threads or crawler.config["async"]["threads"])
+        self.timeout = int(crawler.config["timeouts"]["job"])
+        self.loop = None
+        self.executor = None
+        self.callback_executor = None
+
+    async def run_in_thread(self, func, *args, **kwargs):
+        return await self.loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def get_dns_local(self, domain, resolver, delegation=None):
+        crawler = self.crawler
+        records, dnssec, rcode = await get_dns_local_records(domain, crawler.config, resolver, crawler.dnssec_validator,
+                                                             delegation)
+        return await self.run_in_thread(build_dns_local, domain, crawler.config, records, dnssec, crawler.geoip_dbs,
+                                        rcode)
+
+    async def get_dns_auth(self, nameservers, resolver, glue=None):
+        crawler = self.crawler
+        return await get_dns_auth_async(nameservers, crawler.redis, crawler.config, resolver,
+                                        crawler.geoip_dbs, crawler.limiter, (crawler.source_ipv4, crawler.source_ipv6),
+                                        glue)
+
+    async def get_mail(self, domain, dns_local, resolver):
+        crawler = self.crawler
+        config = crawler.config
+        return await get_mx_info_async(get_mail_records(domain, dns_local), config["mail"]["ports"],
+                                       crawler.geoip_dbs, config["timeouts"]["mail"], config["mail"]["get_banners"],
+                                       config["timeouts"]["cache"], resolver, crawler.redis,
+                                       crawler.source_ipv4, crawler.source_ipv6, config["mail"]["max_ips_per_host"],
+                                       crawler.limiter, config["timeouts"]["cache_lock"])
+
+    async def get_web_statuses(self, domain, dns_local, paths):
+        crawler = self.crawler
+        return await get_web_statuses_async(domain, dns_local, crawler.config,
+                                            (crawler.source_ipv4, crawler.source_ipv6), paths, crawler.limiter,
+                                            self.executor)
+
+    async def crawl(self, domain, delegation=None):
+        config = self.crawler.config
+        # counts the domain's queries, see RetryPolicy
+        resolver = dns_transport.DomainQueries(self.crawler.local_resolver)
+        with timed_stage("dns_local"):
+            dns_local = await self.get_dns_local(domain, resolver, delegation)
+        if is_dead(dns_local, config):
+            return self.crawler.build_result(domain, dns_local, None, None, None, None, status=dns_local["rcode"],
+                                             dns_queries=resolver.stats)
+        with timed_stage("dns_auth"):
+            dns_auth = await self.get_dns_auth(dns_local["NS_AUTH"], resolver,
+                                               delegation.get("glue") if delegation else None)
+        with timed_stage("mail"):
+            mail = await self.get_mail(domain, dns_local, resolver)
+        with timed_stage("web"):
+            paths = config["web"].get("paths") or []
+            web, *statuses = await self.get_web_statuses(domain, dns_local, ["/"] + paths)
+            hsts = lazy_import(".hsts_utils").get_hsts_status(domain)
+            web_paths = dict(zip(paths, statuses)) if len(paths) > 0 else None
+        return self.crawler.build_result(domain, dns_local, dns_auth, mail, web, hsts, web_paths,
+                                         dns_queries=resolver.stats)
+
+    async def crawl_many(self, domains, callback, delegations=None):
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def crawl_one(index, domain):
+            delegation = delegations[index] if delegations is not None else None
+            async with slots:
+                try:
+                    result = await asyncio.wait_for(self.crawl(domain, delegation), self.timeout)
+                except asyncio.TimeoutError:
+                    result, error = None, f"Crawling the domain took longer than {self.timeout} seconds."
+                except Exception as e:
+                    result, error = None, str(e)
+                else:
+                    result, error = dump_result(result), None
+            # eg. pushing the result to Redis, the other domains go on in the meantime
+            await self.loop.run_in_executor(self.callback_executor, callback, index, domain, result, error)
+
+        await asyncio.gather(*[crawl_one(index, domain) for index, domain in enumerate(domains)])
+
+    def run(self, domains, callback, delegations=None):
+        """Crawls the domains, `callback(index, domain, result, error)` is called as soon as each one is finished.
+
+        `result` is the JSON string (or None if the domain failed), `error` the error message (or None).
+        `delegations` (if any) are passed to `crawl` along with the domains. The callback runs in a thread of its
+        own (one call at a time), so it can block.
+
+        The batches run in the thread's private event loop (see `run_async`), so the sockets opened to the resolvers
+        (see dns_transport) are kept for the next batches too.
+        """
+        self.loop = get_private_loop()
+        # kept by the crawler for the next batches, so threads of timed out HTTP(S) checks don't pile up
+        self.executor = self.crawler.get_executor("async", self.threads)
+        self.callback_executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            run_async(self.crawl_many(domains, callback, delegations))
+        finally:
+            self.callback_executor.shutdown(wait=True)
+            self.loop = None
@@ -0,0 +1,154 @@
+# Copyright © 2019-2021 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+from math import ceil
+from os import getloadavg
+from time import monotonic, sleep
+
+from rq import Queue
+
+from .metrics import get_host_key
+from .timestamp import timestamp
+
+POLL_INTERVAL = 1
+STAGE_SUM = "dns_crawler_stage_duration_seconds_sum"
+DOMAINS = "dns_crawler_domains_total"
+
+
+def read_cpu_times():
+    """Returns (busy, total) CPU time since boot from /proc/stat, or None if it's not available."""
+    try:
+        with open("/proc/stat") as f:
+            times = [int(value) for value in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    idle = times[3] + (times[4] if len(times) > 4 else 0)
+    return (sum(times) - idle, sum(times))
+
+
+def get_available_memory():
+    """Returns the available fraction of RAM from /proc/meminfo, or None if it's not available."""
+    info = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                info[name] = int(value.split()[0])
+        return info["MemAvailable"] / info["MemTotal"]
+    except (OSError, ValueError, KeyError, ZeroDivisionError):
+        return None
+
+
+class Autoscaler:
+    """Picks the number of workers on this machine from the CPU usage, available memory, queue depth,
+    and the time the workers spend per domain (mostly waiting for the network).
+
+    The workers needed to keep the CPUs at `target_cpu` are estimated as
+    `cpus × target_cpu × (1 + wait time / CPU time)` for each domain, capped by the queue and memory,
+    and the pool is changed by at most `step` workers at once.
+    """
+
+    def __init__(self, redis, hostname, config, cpus, max_workers=None):
+        autoscale = config["autoscale"]
+        self.redis = redis
+        self.queue = Queue(connection=redis)
+        self.metrics_key = get_host_key(hostname)
+        self.cpus = cpus
+        self.min_workers = int(autoscale["min_workers"] or cpus)
+        self.max_workers = int(max_workers or autoscale["max_workers"] or cpus * 24)
+        self.min_workers = min(self.min_workers, self.max_workers)
+        self.interval = float(autoscale["interval"])
+        self.step = int(autoscale["step"])
+        self.target_cpu = float(autoscale["target_cpu"])
+        self.min_free_memory = float(autoscale["min_free_memory"])
+        # an async worker crawls many domains at once
+        self.domains_per_worker = int(config["async"]["concurrency"]) if config["async"]["enabled"] else 1
+        self.last = self.read_counters()
+
+    def read_counters(self):
+        samples = self.redis.hgetall(self.metrics_key)
+        wall = sum(float(value) for name, value in samples.items() if name.startswith(STAGE_SUM.encode()))
+        domains = sum(float(value) for name, value in samples.items() if name.startswith(DOMAINS.encode()))
+        return (monotonic(), read_cpu_times(), wall, domains)
+
+    def measure(self):
+        """Returns the stats for the time since the last call – CPU usage (0–1), available memory (0–1),
+        queued jobs, finished domains, and average wall clock and CPU seconds per domain."""
+        now = self.read_counters()
+        (then, cpu_then, wall_then, domains_then), self.last = self.last, now
+        elapsed = now[0] - then
+        if now[1] is not None and cpu_then is not None and now[1][1] > cpu_then[1]:
+            cpu = (now[1][0] - cpu_then[0]) / (now[1][1] - cpu_then[1])
+        else:
+            cpu = min(1.0, getloadavg()[0] / self.cpus)
+        domains = now[3] - domains_then
+        stats = {
+            "cpu": cpu,
+            "memory": get_available_memory(),
+            "queued": self.queue.count,
+            "domains": domains,
+            "wall": (now[2] - wall_then) / domains if domains > 0 else None,
+            "compute": cpu * self.cpus * elapsed / domains if domains > 0 else None,
+        }
+        return stats
+
+    def get_target(self, count, stats):
+        target = count
+        if stats["domains"] > 0 and stats["compute"] > 0:
+            wait = max(0.0, stats["wall"] - stats["compute"])
+            target = ceil(self.cpus * self.target_cpu * (1 + wait / stats["compute"]) / self.domains_per_worker)
+        elif stats["queued"] > 0 and stats["cpu"] < self.target_cpu:
+            # nothing finished yet, so there's nothing to estimate from
+            target = count + self.step
+        if stats["queued"] == 0:
+            # idle workers exit on their own once the queue is empty
+            target = min(target, count)
+        if stats["memory"] is not None and stats["memory"] < self.min_free_memory:
+            target = min(target, count - self.step)
+        target = max(count - self.step, min(count + self.step, target))
+        return max(self.min_workers, min(self.max_workers, target))
+
+
+class FixedSize:
+    """A fixed number of workers for `supervise` – it just replaces the crashed ones."""
+
+    def __init__(self, count):
+        self.min_workers = self.max_workers = count
+        self.interval = float("inf")
+
+
+def supervise(autoscaler, pool):
+    """Keeps resizing the pool until all the workers are done (the queue ran out), crashed workers are replaced."""
+    pool.resize(autoscaler.min_workers)
+    next_check = monotonic() + autoscaler.interval
+    while pool.running() > 0:
+        sleep(POLL_INTERVAL)
+        pool.check()
+        if monotonic() < next_check or len(pool.procs) == 0:
+            continue
+        next_check = monotonic() + autoscaler.interval
+        stats = autoscaler.measure()
+        target = autoscaler.get_target(len(pool.procs), stats)
+        if target != len(pool.procs):
+            memory = "n/a" if stats["memory"] is None else f"{stats['memory']:.0%}"
+            wait = "n/a" if stats["wall"] is None else f"{max(0.0, stats['wall'] - stats['compute']):.2f} s"
+            sys.stderr.write(f"{timestamp()} Scaling from {len(pool.procs)} to {target} workers "
+                             f"(CPU {stats['cpu']:.0%}, free memory {memory}, {stats['queued']} queued jobs, "
+                             f"network wait {wait} per domain).\n")
+            pool.resize(target)
@@ -0,0 +1,82 @@
+# Copyright © 2019-2021 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from os import path, replace
+
+
+class LineSet:
+    """A set of input line numbers, kept as a bitmap (a bit per input line)."""
+
+    def __init__(self, bitmap=b""):
+        self.bitmap = bytearray(bitmap)
+
+    def __contains__(self, line):
+        byte = line >> 3
+        return byte < len(self.bitmap) and bool(self.bitmap[byte] & (1 << (line & 7)))
+
+    def add(self, line):
+        byte = line >> 3
+        if byte >= len(self.bitmap):
+            self.bitmap.extend(bytes(byte - len(self.bitmap) + 1))
+        self.bitmap[byte] = self.bitmap[byte] | (1 << (line & 7))
+
+    def count(self):
+        return sum(bin(byte).count("1") for byte in self.bitmap)
+
+
+class Checkpoint:
+    """A bitmap of finished input lines, saved to disk so an interrupted crawl can be resumed.
+
+    Lines marked as done are pending until `commit` (once their results are safely in the output), only committed
+    lines are saved.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.exists = path.isfile(filename)
+        if self.exists:
+            with open(filename, "rb") as file:
+                self.lines = LineSet(file.read())
+        else:
+            self.lines = LineSet()
+        self.pending = set()
+
+    def is_done(self, line):
+        return line in self.pending or line in self.lines
+
+    def mark_done(self, line):
+        if line not in self.lines:
+            self.pending.add(line)
+
+    # so it can be used as a LineSet of done lines
+    __contains__ = is_done
+    add = mark_done
+
+    def commit(self):
+        for line in self.pending:
+            self.lines.add(line)
+        self.pending.clear()
+
+    def count(self):
+        return self.lines.count() + len(self.pending)
+
+    def save(self):
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, "wb") as file:
+            file.write(self.lines.bitmap)
+        replace(tmp_filename, self.filename)
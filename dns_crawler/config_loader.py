@@ -43,15 +43,26 @@ defaults = {
             "version.bind",
             "hostname.bind"
         ],
-        "check_www": True
+        "check_www": True,
+        "hedge_after": 1,
+        "short_circuit": True,
+        "dnssec": "validate",
+        "max_retries": 2,
+        "retry_backoff": 0.1,
+        "max_queries_per_domain": 500,
+        "cache_size": 10000,
+        "cache_max_ttl": 3600
     },
     "timeouts": {
         "job": 80,
         "dns": 2,
+        "dns_deadline": 10,
+        "web_deadline": 60,
         "http": 2,
         "http_read": 5,
         "mail": 2,
-        "cache": 3600
+        "cache": 3600,
+        "cache_lock": 30
     },
     "mail": {
         "get_banners": False,
@@ -67,12 +78,52 @@ defaults = {
         "accept_language": "en-US;q=0.9,en;q=0.8",
         "content_size_limit": 5120000,
         "max_ips_per_domain": None,
+        "max_connections": 8,
         "check_http": True,
         "check_https": True,
         "check_ipv4": True,
         "check_ipv6": True,
         "save_intermediate_steps": True
     },
+    "input": {
+        "dedupe": True,
+        "dedupe_capacity": 10000000,
+        "dedupe_error_rate": 0.0001
+    },
+    "output": {
+        "path": None,
+        "compression": None,
+        "max_lines_per_file": None,
+        "buffer_size": 1048576,
+        "threaded": False
+    },
+    "controller": {
+        "max_jobs_in_flight": None,
+        "batch_size": 1
+    },
+    "async": {
+        "enabled": False,
+        "concurrency": 100,
+        "threads": 32
+    },
+    "politeness": {
+        "enabled": False,
+        "per": "ip",
+        "rate": 20,
+        "burst": 40,
+        "concurrency": 16,
+        "max_wait": 10,
+        "key_ttl": 300
+    },
+    "autoscale": {
+        "enabled": False,
+        "min_workers": None,
+        "max_workers": None,
+        "interval": 10,
+        "step": 16,
+        "target_cpu": 0.8,
+        "min_free_memory": 0.1
+    },
     "connectivity_check_ips": {
         "ipv4": "193.17.47.1",
         "ipv6": "2001:148f:ffff::1"
@@ -103,6 +154,16 @@ def merge_dicts(source, destination):
     return destination
 
 
+def check_config(config):
+    if config["async"]["enabled"] and int(config["controller"]["batch_size"]) <= 1:
+        # jobs with a single domain never get to the async engine, and there's just one worker per CPU core with it
+        batch_size = int(config["async"]["concurrency"]) * 2
+        sys.stderr.write(f"{timestamp()} The async engine needs batches of domains, `controller.batch_size` is 1 "
+                         f"– using {batch_size} instead.\n")
+        config["controller"]["batch_size"] = batch_size
+    return config
+
+
 def load_config_from_file(filename=default_config_filename):
     pwd = getcwd()
     try:
@@ -135,7 +196,7 @@ def load_config_from_file(filename=default_config_filename):
                 config = merge_dicts(config_from_file, defaults)
     except FileNotFoundError:
         config = defaults
-    return config
+    return check_config(config)
 
 
 def load_config(filename=default_config_filename, redis=None, hostname=None, save=False):
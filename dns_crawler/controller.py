@@ -16,23 +16,34 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import pickle
 import sys
+from itertools import islice
 from os.path import basename
-from time import sleep
+from time import monotonic
 
 from redis import Redis
 from redis.exceptions import ConnectionError, ExecAbortError, ResponseError
 from rq import Queue
-from rq.registry import FinishedJobRegistry
+from rq.registry import StartedJobRegistry
 
+from .checkpoint import Checkpoint, LineSet
 from .config_loader import default_config_filename, load_config
-from .crawl import get_json_result
-from .redis_utils import get_redis_host
+from .crawl import push_json_result, push_json_results
+from .input_utils import InputNormalizer, ZoneError, read_zone
+from .metrics import Metrics, serve_metrics
+from .output import OutputError, create_writer
+from .redis_utils import clear_crawl_state, get_redis_host
+from .results import RESULTS_KEY, ResultDecoder, read_results
 from .timestamp import timestamp
+from .utils import pop_option
+from .worker import fail_orphaned_jobs
 
-POLL_INTERVAL = 5
+POLL_TIMEOUT = 1
+PROGRESS_INTERVAL = 5
+CHECKPOINT_INTERVAL = 10
+ORPHANS_INTERVAL = 10
 INPUT_CHUNK_SIZE = 10000
+RESULTS_BATCH_SIZE = 1000
 
 
 class ControllerNotRunning(Exception):
@@ -42,22 +53,47 @@ class ControllerNotRunning(Exception):
 def print_help():
     exe = basename(sys.argv[0])
     sys.stderr.write(f"{exe} - the main process controlling the job queue and printing results.\n\n")
-    sys.stderr.write(f"Usage: {exe} <file> [redis]\n")
+    sys.stderr.write(f"Usage: {exe} [-o output] [-c checkpoint] [-m metrics] [-z origin] <file> [redis]\n")
+    sys.stderr.write("       output - file to save the results to, stdout by default (see `output` in config.yml)\n")
+    sys.stderr.write("       checkpoint - file to keep track of finished domains in, an interrupted crawl is resumed\n")
+    sys.stderr.write("                    if it exists (use the same input and output)\n")
+    sys.stderr.write("       metrics - [host:]port to serve Prometheus metrics on (http://host:port/metrics)\n")
+    sys.stderr.write("       origin - the file is a zone file of this zone, domains delegated from it are crawled\n")
+    sys.stderr.write("                (their DS and nameserver glue from the zone are used instead of querying them)\n")
     sys.stderr.write("       file - plaintext domain list, one domain per line, empty lines are ignored\n")
+    sys.stderr.write("              use '-' to read the list from stdin\n")
     sys.stderr.write("       redis - redis host:port:db, localhost:6379:0 by default\n\n")
     sys.stderr.write(f"Examples: {exe} domains.txt\n")
     sys.stderr.write(f"          {exe} domains.txt 192.168.0.22:4444:0\n")
     sys.stderr.write(f"          {exe} domains.txt redis.foo.bar:7777:2\n")
     sys.stderr.write(f"          {exe} domains.txt redis.foo.bar # port 6379 and DB 0 will be used if not specified\n")
+    sys.stderr.write(f"          xzcat domains.txt.xz | {exe} -\n")
+    sys.stderr.write(f"          {exe} -o results.jsonl.gz domains.txt\n")
+    sys.stderr.write(f"          {exe} -o results.jsonl.gz -c domains.checkpoint domains.txt\n")
+    sys.stderr.write(f"          {exe} -m 9100 domains.txt\n")
+    sys.stderr.write(f"          {exe} -z cz cz.zone\n")
     sys.exit(1)
 
 
-def create_jobs(domains, function, redis, queue, timeout):
+def create_jobs(items, redis, queue, timeout, batch_size=1):
     pipe = redis.pipeline()
     jobs = []
-    for domain in domains:
-        jobs.append(Queue.prepare_data(function, (domain,), job_id=domain,
-                                       description=domain, timeout=timeout, result_ttl=-1))
+    if batch_size == 1:
+        for line, domain, delegation in items:
+            args = (domain, line) if delegation is None else (domain, line, delegation)
+            jobs.append(Queue.prepare_data(push_json_result, args, job_id=domain,
+                                           description=domain, timeout=timeout, result_ttl=0))
+    else:
+        for i in range(0, len(items), batch_size):
+            batch = items[i:i + batch_size]
+            lines = [line for line, _, _ in batch]
+            domains = [domain for _, domain, _ in batch]
+            delegations = [delegation for _, _, delegation in batch]
+            args = (domains, lines) if all(delegation is None for delegation in delegations) \
+                else (domains, lines, delegations)
+            jobs.append(Queue.prepare_data(push_json_results, args,
+                                           description=f"{domains[0]} (+{len(domains) - 1})",
+                                           timeout=timeout * len(domains), result_ttl=0))
     queue.enqueue_many(jobs, pipeline=pipe)
     try:
         pipe.execute()
@@ -70,12 +106,100 @@ def create_jobs(domains, function, redis, queue, timeout):
             sys.stderr.write(f"  used:  {used_memory}\n")
             sys.stderr.write(f"  limit: {maxmemory}\n")
             sys.stderr.write("Try increasing the `maxmemory` config option in redis.conf.\n")
-        redis.flushdb()
+        clear_crawl_state(redis)
         sys.exit(1)
-    return len(jobs)
+    return len(items)
+
+
+def read_input(entries, normalizer, checkpoint=None):
+    """Yields (line, domain, delegation) for the domains to crawl from (line, name, delegation) input entries."""
+    for line, text, delegation in entries:
+        if checkpoint is not None and checkpoint.is_done(line):
+            normalizer.normalize(text, skip=True)
+            continue
+        domain = normalizer.normalize(text)
+        if domain is not None:
+            yield (line, domain, delegation)
+
+
+def collect_metrics(redis, queue, controller_metrics):
+    samples = controller_metrics.get_samples()
+    pipe = redis.pipeline(transaction=False)
+    pipe.llen(queue.key)
+    pipe.zcard(StartedJobRegistry(queue=queue).key)
+    pipe.llen(RESULTS_KEY)
+    samples["dns_crawler_queued_jobs"], samples["dns_crawler_started_jobs"], \
+        samples["dns_crawler_pending_results"] = pipe.execute()
+    return samples
+
+
+def save_checkpoint(checkpoint, writer):
+    if checkpoint is not None:
+        # results have to be on the disk before they're marked as done
+        writer.flush()
+        checkpoint.commit()
+        checkpoint.save()
+
+
+def close_broken_writer(writer):
+    try:
+        writer.close()
+    except (OutputError, OSError):
+        pass
+
+
+def filter_results(results, lines, failures, done, enqueued, settled):
+    """Drops results of lines which are done already (eg. sent late by workers which were still crawling for
+    the previous run of the controller).
+
+    Returns (results to write, their lines, failures to report, count of finished lines). Only the first result
+    or failure of each line enqueued by this controller counts (into `settled`), so the crawl never ends early.
+    """
+    kept_results = []
+    kept_lines = []
+    finished_count = 0
+    for result, line in zip(results, lines):
+        if line is not None:
+            if line in done:
+                continue
+            done.add(line)
+            if line not in enqueued or line in settled:
+                # written anyway, the line is skipped when the input gets there
+                kept_results.append(result)
+                kept_lines.append(line)
+                continue
+            settled.add(line)
+        kept_results.append(result)
+        kept_lines.append(line)
+        finished_count = finished_count + 1
+    kept_failures = []
+    for failure in failures:
+        line = failure.get("line")
+        if line is not None:
+            if line in done or line not in enqueued or line in settled:
+                continue
+            settled.add(line)
+        kept_failures.append(failure)
+    return (kept_results, kept_lines, kept_failures, finished_count)
+
+
+def write_leftover_results(redis, decoder, writer, checkpoint):
+    # results which were already in Redis when the previous controller stopped
+    count = 0
+    while True:
+        results, lines, _ = decoder.decode(read_results(redis, RESULTS_BATCH_SIZE))
+        if len(results) == 0:
+            return count
+        results, lines, _, _ = filter_results(results, lines, [], checkpoint, LineSet(), LineSet())
+        writer.write(results)
+        count = count + len(results)
 
 
 def main():
+    output_filename = pop_option(sys.argv, ("-o", "--output"))
+    checkpoint_filename = pop_option(sys.argv, ("-c", "--checkpoint"))
+    metrics_address = pop_option(sys.argv, ("-m", "--metrics"))
+    zone_origin = pop_option(sys.argv, ("-z", "--zone"))
     if "-h" in sys.argv or "--help" in sys.argv or len(sys.argv) < 2:
         print_help()
 
@@ -86,9 +210,17 @@ def main():
         sys.exit(1)
     redis = Redis(host=redis_host[0], port=redis_host[1], db=redis_host[2])
 
-    redis.flushdb()
+    checkpoint = Checkpoint(checkpoint_filename) if checkpoint_filename else None
+    resume = checkpoint is not None and checkpoint.exists
+
+    clear_crawl_state(redis, keep_results=resume)
     config = load_config(default_config_filename, redis, save=True)
-    finished_registry = FinishedJobRegistry(connection=redis)
+
+    try:
+        writer = create_writer(config, output_filename, append=resume)
+    except (OutputError, OSError) as e:
+        sys.stderr.write(f"{timestamp()} Can't open the output: {e}\n")
+        sys.exit(1)
 
     try:
         filename = sys.argv[1]
@@ -96,71 +228,148 @@ def main():
         print_help()
 
     try:
-        sys.stderr.write(f"{timestamp()} Reading domains from {filename}.\n")
-        input_file = open(filename, "r", encoding="utf-8")
+        decoder = ResultDecoder()
+        if resume:
+            leftover_count = write_leftover_results(redis, decoder, writer, checkpoint)
+            save_checkpoint(checkpoint, writer)
+            sys.stderr.write(f"{timestamp()} Resuming from {checkpoint_filename}, {checkpoint.count()} domains "
+                             f"already done ({leftover_count} of them were waiting in Redis).\n")
+            if writer.part_filename is not None:
+                sys.stderr.write(f"{timestamp()} Compressed output can't be appended to, writing the rest of "
+                                 f"the results to {writer.part_filename}.\n")
+        if filename == "-":
+            sys.stderr.write(f"{timestamp()} Reading domains from stdin.\n")
+            input_file = sys.stdin
+        else:
+            sys.stderr.write(f"{timestamp()} Reading domains from {filename}.\n")
+            input_file = open(filename, "r", encoding="utf-8")
+        normalizer = InputNormalizer(config)
+        if zone_origin is not None:
+            entries = read_zone(input_file, zone_origin)
+        else:
+            entries = ((line, text, None) for line, text in enumerate(input_file))
+        domains = read_input(entries, normalizer, checkpoint)
+        max_in_flight = config["controller"]["max_jobs_in_flight"]
+        batch_size = int(config["controller"]["batch_size"])
         sys.stderr.write(
             f"{timestamp()} Creating job queue…\n")
         redis.set("locked", 1)
+        redis.set("feeding", 1)
         queue = Queue(connection=redis)
+        controller_metrics = Metrics()
+        if metrics_address is not None:
+            serve_metrics(metrics_address, lambda: collect_metrics(redis, queue, controller_metrics))
+            sys.stderr.write(f"{timestamp()} Serving metrics on {metrics_address}.\n")
+        # input lines of the jobs created by this controller, and the ones which got their result (or failed)
+        enqueued = LineSet()
+        settled = LineSet()
+        # the checkpoint, or just the lines written in this run
+        done = checkpoint if checkpoint is not None else LineSet()
+        feeding = True
         domain_count = 0
-        read_domains = []
-        for line in input_file:
-            read_domains.append(line.rstrip())
-            if len(read_domains) == INPUT_CHUNK_SIZE:
-                domain_count = domain_count + create_jobs(read_domains, get_json_result, queue=queue,
-                                                          redis=redis, timeout=config["timeouts"]["job"])
-                sys.stderr.write(f"{timestamp()} {domain_count}\n")
-                read_domains = []
-        domain_count = domain_count + create_jobs(read_domains, get_json_result, queue=queue,
-                                                  redis=redis, timeout=config["timeouts"]["job"])
-        sys.stderr.write(f"{timestamp()} {domain_count}\n")
-        input_file.close()
-
         finished_count = 0
-        sys.stderr.write(f"{timestamp()} Created {domain_count} jobs. Unlocking queue and waiting for workers…\n")
-
-        redis.set("locked", 0)
-
-        while finished_count < domain_count:
-            finished_domains = finished_registry.get_job_ids()
-            if len(finished_domains) > 0:
-                pipe = redis.pipeline()
-                hashes = []
-                for domain in finished_domains:
-                    hash = f"rq:job:{domain}"
-                    hashes.append(hash)
-                    pipe.hget(hash, "result")
-                results = pipe.execute()
-                pipe = redis.pipeline()
-                count = 0
-                for index, result in enumerate(results):
-                    if result:
-                        count = count + 1
-                        try:
-                            print(pickle.loads(result))
-                        except pickle.UnpicklingError:
-                            sys.stderr.write(f"{timestamp()} UnpicklingError: {hashes[index]}\n")
-                            continue
-                        else:
-                            pipe.delete(hashes[index])
-                pipe.execute()
-                finished_count = finished_count + count
-            sys.stderr.write(f"{timestamp()} {finished_count}/{domain_count}\n")
-            sleep(POLL_INTERVAL)
+        failed_count = 0
+        last_progress = monotonic()
+        last_checkpoint = monotonic()
+        last_orphans = monotonic()
+
+        while feeding or finished_count + failed_count < domain_count:
+            topped_up = False
+            if feeding:
+                room = INPUT_CHUNK_SIZE
+                if max_in_flight is not None:
+                    room = min(room, int(max_in_flight) * batch_size - (domain_count - finished_count - failed_count))
+                if room > 0:
+                    read_domains = list(islice(domains, room))
+                    if len(read_domains) > 0:
+                        for line, _, _ in read_domains:
+                            enqueued.add(line)
+                        created_count = create_jobs(read_domains, queue=queue, redis=redis,
+                                                    timeout=config["timeouts"]["job"], batch_size=batch_size)
+                        domain_count = domain_count + created_count
+                        controller_metrics.inc("dns_crawler_input_domains_total", created_count)
+                        topped_up = True
+                    if len(read_domains) < room:
+                        feeding = False
+                        redis.set("feeding", 0)
+                        if input_file is not sys.stdin:
+                            input_file.close()
+                        sys.stderr.write(f"{timestamp()} Created jobs for {domain_count} domains, input finished. "
+                                         f"{normalizer.report()}\n")
+                    if redis.get("locked") == b"1":
+                        sys.stderr.write(f"{timestamp()} Unlocking queue, workers can start now…\n")
+                        redis.set("locked", 0)
+
+            frames = read_results(redis, RESULTS_BATCH_SIZE, None if topped_up else POLL_TIMEOUT)
+            results, lines, failures = decoder.decode(frames)
+            results, lines, failures, settled_count = filter_results(results, lines, failures, done, enqueued, settled)
+            writer.write(results)
+            for failure in failures:
+                sys.stderr.write(f"{timestamp()} {failure['domain']} failed: {failure['error']}\n")
+            finished_count = finished_count + settled_count
+            failed_count = failed_count + len(failures)
+            if len(frames) > 0:
+                controller_metrics.inc("dns_crawler_received_bytes_total", sum(len(frame) for frame in frames))
+                controller_metrics.inc("dns_crawler_domains_total", settled_count, status="finished")
+                controller_metrics.inc("dns_crawler_domains_total", len(failures), status="failed")
+
+            if monotonic() - last_orphans >= ORPHANS_INTERVAL:
+                # jobs of dead workers, their failures are read with the next results
+                fail_orphaned_jobs(redis, queue)
+                last_orphans = monotonic()
+
+            if checkpoint is not None:
+                if monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                    save_checkpoint(checkpoint, writer)
+                    last_checkpoint = monotonic()
+
+            if monotonic() - last_progress >= PROGRESS_INTERVAL or \
+               (not feeding and finished_count + failed_count == domain_count):
+                progress = f"{timestamp()} {finished_count}/{domain_count}{'+' if feeding else ''}"
+                if failed_count > 0:
+                    progress = progress + f" ({failed_count} failed)"
+                sys.stderr.write(progress + "\n")
+                last_progress = monotonic()
+        save_checkpoint(checkpoint, writer)
+        writer.close()
         queue.delete(delete_jobs=True)
         sys.exit(0)
 
     except KeyboardInterrupt:
-        created_count = queue.count
-        sys.stderr.write(f"{timestamp()} Cancelled. Deleting {created_count} jobs…\n")
-        redis.flushdb()
+        save_checkpoint(checkpoint, writer)
+        writer.close()
+        sys.stderr.write(f"{timestamp()} Cancelled. Deleting jobs…\n")
+        clear_crawl_state(redis, keep_results=checkpoint is not None)
         sys.stderr.write(f"{timestamp()} All jobs deleted, exiting.\n")
+        if checkpoint is not None:
+            sys.stderr.write(f"{timestamp()} Run the same command again to resume the crawl.\n")
         sys.exit(1)
 
     except ConnectionError:
+        save_checkpoint(checkpoint, writer)
+        writer.close()
         sys.stderr.write(f"{timestamp()} Connection to Redis lost. :(\n")
         sys.exit(1)
 
     except FileNotFoundError:
         sys.stderr.write(f"File '{filename}' does not exist.\n\n")
         print_help()
+
+    except OutputError as e:
+        # only the lines flushed before the error are saved, results received since then might not have made it
+        # to the output, so their domains are crawled again when the crawl is resumed
+        if checkpoint is not None:
+            checkpoint.save()
+        close_broken_writer(writer)
+        sys.stderr.write(f"{timestamp()} {e}. Deleting jobs…\n")
+        clear_crawl_state(redis, keep_results=checkpoint is not None)
+        if checkpoint is not None:
+            sys.stderr.write(f"{timestamp()} Fix the output and run the same command again to resume the crawl.\n")
+        sys.exit(1)
+
+    except ZoneError as e:
+        save_checkpoint(checkpoint, writer)
+        writer.close()
+        sys.stderr.write(f"{timestamp()} Can't read the zone file, {e}. Deleting jobs…\n")
+        clear_crawl_state(redis, keep_results=checkpoint is not None)
+        sys.exit(1)
@@ -16,51 +16,127 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import json
+import os
 import re
+import signal
+import sys
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime
+from functools import partial
 from socket import gethostname
+from time import monotonic
 
-from rq import get_current_connection
+import dns.rcode
 
 from .config_loader import default_config_filename, load_config
-from .dns_utils import (annotate_dns_algorithm, check_dnssec,
-                        get_local_resolver, get_ns_info, get_record,
-                        get_record_parser, get_txt, parse_dmarc, parse_spf,
-                        parse_tlsa)
+from .dns_utils import (annotate_dns_algorithm, get_dnssec_records_async,
+                        get_local_resolver, get_ns_info_async,
+                        get_record_async, get_record_parser,
+                        get_record_with_rcode_async, get_txt, parse_dmarc,
+                        parse_spf, parse_tlsa)
+from .dns_transport import DomainQueries
+from .dnssec_utils import get_dnssec_validator
 from .geoip_utils import annotate_geoip, init_geoip
-from .hsts_utils import get_hsts_status
+from .imports import lazy_import
 from .ip_utils import get_source_addresses
 from .mail_utils import get_mx_info
-from .web_utils import get_webserver_info
+from .metrics import get_host_key, metrics
+from .politeness import TargetLimiter
+from .results import push_failure, push_result
+from .utils import gather_until, run_async
 
+# the domain doesn't exist or is broken, no point in crawling it any further
+DEAD_RCODES = ("NXDOMAIN", "SERVFAIL")
 
-def get_dns_local(domain, config, local_resolver, geoip_dbs):
+
+class DomainTimeout(BaseException):
+    # not an Exception subclass, so it can't get swallowed by the catch-all handlers in the crawling code
+    pass
+
+
+@contextmanager
+def domain_timeout(timeout):
+    def handle_timeout(signum, frame):
+        raise DomainTimeout(f"Crawling the domain took longer than {timeout} seconds.")
+
+    previous_handler = signal.signal(signal.SIGALRM, handle_timeout)
+    previous_alarm = signal.alarm(timeout)
+    started = monotonic()
+    try:
+        yield
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous_handler)
+        if previous_alarm > 0:
+            # restore the job timeout set by RQ
+            signal.alarm(max(1, previous_alarm - int(monotonic() - started)))
+
+
+def is_timeout(e):
+    if isinstance(e, (DomainTimeout, asyncio.CancelledError)):
+        return True
+    # RQ's job timeout can only happen in a worker, which has RQ imported already
+    job_timeout = getattr(sys.modules.get("rq.timeouts"), "JobTimeoutException", None)
+    return job_timeout is not None and isinstance(e, job_timeout)
+
+
+@contextmanager
+def timed_stage(stage):
+    started = monotonic()
+    try:
+        yield
+    except BaseException as e:
+        if is_timeout(e):
+            metrics.inc("dns_crawler_stage_timeouts_total", stage=stage)
+        raise
+    metrics.observe("dns_crawler_stage_duration_seconds", monotonic() - started, stage=stage)
+
+
+def get_dns_local_queries(domain, config):
+    """Returns (name, record type) pairs for all the records get_dns_local needs."""
+    queries = [(domain, "TXT"), (domain, "NS"), (domain, "MX"), (domain, "A"), (domain, "AAAA"),
+               ("_443._tcp." + domain, "TLSA"), ("_dmarc." + domain, "TXT"), ("_openid." + domain, "TXT"),
+               (domain, "DS"), (domain, "DNSKEY")]
+    if config["dns"]["check_www"]:
+        queries = queries + [("www." + domain, "A"), ("www." + domain, "AAAA"), ("_443._tcp.www." + domain, "TLSA")]
+    for record in config["dns"]["additional"]:
+        queries.append((domain, record))
+    return list(dict.fromkeys(queries))
+
+
+def build_dns_local(domain, config, records, dnssec, geoip_dbs, rcode=None):
+    """Puts the result together from {(name, record type): records}, the DNSSEC check, and the domain's rcode."""
+    # additional records might be the same ones as the basic ones, which are annotated in place
+    additional_records = {record: deepcopy(records[(domain, record)]) for record in config["dns"]["additional"]}
     result = {}
-    txt = get_record(domain, "TXT", local_resolver)
-    result["NS_AUTH"] = get_record(domain, "NS", local_resolver)
-    result["MAIL"] = get_record(domain, "MX", local_resolver)
-    result["WEB4"] = annotate_geoip(get_record(domain, "A", local_resolver), geoip_dbs)
+    txt = records[(domain, "TXT")]
+    result["NS_AUTH"] = records[(domain, "NS")]
+    result["MAIL"] = records[(domain, "MX")]
+    result["WEB4"] = annotate_geoip(records[(domain, "A")], geoip_dbs)
     if config["dns"]["check_www"]:
-        result["WEB4_www"] = annotate_geoip(get_record("www." + domain, "A", local_resolver), geoip_dbs)
-    result["WEB6"] = annotate_geoip(get_record(domain, "AAAA", local_resolver), geoip_dbs)
+        result["WEB4_www"] = annotate_geoip(records[("www." + domain, "A")], geoip_dbs)
+    result["WEB6"] = annotate_geoip(records[(domain, "AAAA")], geoip_dbs)
     if config["dns"]["check_www"]:
-        result["WEB6_www"] = annotate_geoip(get_record("www." + domain, "AAAA", local_resolver), geoip_dbs)
-    result["WEB_TLSA"] = parse_tlsa(get_record("_443._tcp." + domain, "TLSA", local_resolver))
+        result["WEB6_www"] = annotate_geoip(records[("www." + domain, "AAAA")], geoip_dbs)
+    result["WEB_TLSA"] = parse_tlsa(records[("_443._tcp." + domain, "TLSA")])
     if config["dns"]["check_www"]:
-        result["WEB_TLSA_www"] = parse_tlsa(get_record("_443._tcp.www." + domain, "TLSA", local_resolver))
+        result["WEB_TLSA_www"] = parse_tlsa(records[("_443._tcp.www." + domain, "TLSA")])
     result["TXT"] = txt
     if txt:
         result["TXT_SPF"] = parse_spf(get_txt(re.compile('^"?v=spf'), deepcopy(txt)), domain)
-    result["TXT_DMARC"] = parse_dmarc(get_record("_dmarc." + domain, "TXT", local_resolver), domain)
-    result["TXT_openid"] = get_record("_openid." + domain, "TXT", local_resolver)
-    result["DS"] = annotate_dns_algorithm(get_record(domain, "DS", local_resolver), 1)
-    result["DNSKEY"] = annotate_dns_algorithm(get_record(domain, "DNSKEY", local_resolver), 2)
-    result["DNSSEC"] = check_dnssec(domain, local_resolver)
+    result["TXT_DMARC"] = parse_dmarc(records[("_dmarc." + domain, "TXT")], domain)
+    result["TXT_openid"] = records[("_openid." + domain, "TXT")]
+    result["DS"] = annotate_dns_algorithm(records[(domain, "DS")], 1)
+    result["DNSKEY"] = annotate_dns_algorithm(records[(domain, "DNSKEY")], 2)
+    result["DNSSEC"] = dnssec
+    result["rcode"] = rcode
     additional = {}
     for record in config["dns"]["additional"]:
-        values = get_record(domain, record, local_resolver)
+        values = additional_records[record]
         parser = get_record_parser(record)
         if parser is not None:
             additional[record] = parser(values, domain)
@@ -69,119 +145,369 @@ def get_dns_local(domain, config, local_resolver, geoip_dbs):
     return dict(result, **additional)
 
 
-def get_dns_auth(domain, nameservers, redis, config, local_resolver, geoip_dbs):
-    source_ipv4, source_ipv6 = get_source_addresses(redis=redis, config=config)
-    timeout = config["timeouts"]["dns"]
-    cache_timeout = config["timeouts"]["cache"]
-    chaosrecords = config["dns"]["auth_chaos_txt"]
+async def get_dns_local_records(domain, config, local_resolver, validator=None, delegation=None):
+    """Returns ({(name, record type): records}, DNSSEC check result, rcode of the domain's NS query).
+
+    With `dns.short_circuit`, the NS query goes first, and if the domain doesn't exist or is broken (see DEAD_RCODES),
+    that's it. Otherwise all the (other) queries are sent at once. The DS from the `delegation` (see
+    `input_utils.read_zone`) is used instead of querying it.
+    """
+    queries = get_dns_local_queries(domain, config)
+    deadline = config["timeouts"]["dns_deadline"]
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    ns = None
+    if config["dns"]["short_circuit"]:
+        ns = await get_record_with_rcode_async(domain, "NS", local_resolver)
+        if ns[1] in DEAD_RCODES:
+            # same message as in the DNSSEC check
+            dnssec = {"valid": None, "message": f"rcode {dns.rcode.from_text(ns[1])}"}
+            return ({query: None for query in queries}, dnssec, ns[1])
+        if deadline is not None:
+            deadline = max(0, float(deadline) - (loop.time() - started))
+    # DS and DNSKEY are fetched along with the DNSSEC check, which uses the same responses
+    done = [(domain, "DS"), (domain, "DNSKEY")] + ([] if ns is None else [(domain, "NS")])
+    rest = [query for query in queries if query not in done]
+    *answers, dnssec_answers = await gather_until(
+        deadline,
+        [get_record_with_rcode_async(name, record, local_resolver) for name, record in rest] +
+        [get_dnssec_records_async(domain, validator or get_dnssec_validator(config, local_resolver), local_resolver,
+                                  delegation.get("DS") if delegation is not None else None)])
+    answers = dict(zip(rest, [answer or (None, None) for answer in answers]))
+    if ns is not None:
+        answers[(domain, "NS")] = ns
+    if dnssec_answers is None:
+        answers[(domain, "DS")] = answers[(domain, "DNSKEY")] = (None, None)
+        dnssec = {"valid": None, "error": "timeout"}
+    else:
+        answers[(domain, "DS")], answers[(domain, "DNSKEY")], dnssec = dnssec_answers
+    records = {query: answer[0] for query, answer in answers.items()}
+    return (records, dnssec, answers[(domain, "NS")][1])
+
+
+def get_dns_local(domain, config, local_resolver, geoip_dbs, validator=None, delegation=None):
+    records, dnssec, rcode = run_async(get_dns_local_records(domain, config, local_resolver, validator, delegation))
+    return build_dns_local(domain, config, records, dnssec, geoip_dbs, rcode)
+
+
+def is_dead(dns_local, config):
+    """Whether the rest of the crawl can be skipped (see `get_dns_local_records`)."""
+    return config["dns"]["short_circuit"] and dns_local["rcode"] in DEAD_RCODES
+
+
+async def get_ns_ips_info(ips, source_ip, redis, config, geoip_dbs, limiter):
+    if ips is None or source_ip is None:
+        return []
+    results = await asyncio.gather(*[
+        get_ns_info_async(ip, config["dns"]["auth_chaos_txt"], geoip_dbs, config["timeouts"]["dns"],
+                          config["timeouts"]["cache"], redis, limiter, config["timeouts"]["cache_lock"])
+        for ip in ips])
+    return [ns_info for ns_info in results if ns_info]
+
+
+async def get_ns_auth(ns, redis, config, local_resolver, geoip_dbs, limiter, source_addresses, glue=None):
+    """`glue` – {nameserver: {"A": [IPs], "AAAA": [IPs]}} from the parent zone, used instead of querying them."""
+    source_ipv4, source_ipv6 = source_addresses
+    addresses = (glue or {}).get(ns.lower(), {})
+
+    async def get_addresses(record):
+        if record in addresses:
+            return [{"value": ip} for ip in addresses[record]]
+        return await get_record_async(ns, record, local_resolver, cached=True)
+
+    a, aaaa = await asyncio.gather(get_addresses("A"), get_addresses("AAAA"))
+    ipv4_results, ipv6_results = await asyncio.gather(
+        get_ns_ips_info(a, source_ipv4, redis, config, geoip_dbs, limiter),
+        get_ns_ips_info(aaaa, source_ipv6, redis, config, geoip_dbs, limiter))
+    result = {
+        "ns": ns,
+    }
+    if len(ipv4_results) > 0:
+        result["ipv4"] = ipv4_results
+    if len(ipv6_results) > 0:
+        result["ipv6"] = ipv6_results
+    return result
+
+
+async def get_dns_auth_async(nameservers, redis, config, local_resolver, geoip_dbs, limiter, source_addresses,
+                             glue=None):
     if not nameservers or len(nameservers) < 1:
         return None
-    results = []
-    for item in nameservers:
-        ns = item["value"]
-        if not ns:
-            continue
-        a = get_record(ns, "A", local_resolver)
-        aaaa = get_record(ns, "AAAA", local_resolver)
-        ipv4_results = []
-        ipv6_results = []
-        if a is not None and source_ipv4 is not None:
-            for ipv4 in a:
-                ns_info = get_ns_info(ipv4, chaosrecords, geoip_dbs, timeout, cache_timeout, redis)
-                if ns_info:
-                    ipv4_results.append(ns_info)
-        if aaaa is not None and source_ipv6 is not None:
-            for ipv6 in aaaa:
-                ns_info = get_ns_info(ipv6, chaosrecords, geoip_dbs, timeout, cache_timeout, redis)
-                if ns_info:
-                    ipv6_results.append(ns_info)
-        result = {
-            "ns": ns,
-        }
-        if len(ipv4_results) > 0:
-            result["ipv4"] = ipv4_results
-        if len(ipv6_results) > 0:
-            result["ipv6"] = ipv6_results
-        results.append(result)
-    return results
+    names = [item["value"] for item in nameservers if item["value"]]
+    results = await gather_until(
+        config["timeouts"]["dns_deadline"],
+        [get_ns_auth(ns, redis, config, local_resolver, geoip_dbs, limiter, source_addresses, glue) for ns in names])
+    return [result if result is not None else {"ns": ns, "error": "timeout"} for ns, result in zip(names, results)]
 
 
-def get_web_status(domain, dns, config, source_ipv4, source_ipv6, path="/"):
-    result = {}
+def get_dns_auth(domain, nameservers, redis, config, local_resolver, geoip_dbs, limiter=None, source_addresses=None,
+                 glue=None):
+    if source_addresses is None:
+        source_addresses = get_source_addresses(redis=redis, config=config)
+    return run_async(get_dns_auth_async(nameservers, redis, config, local_resolver, geoip_dbs, limiter,
+                                        source_addresses, glue))
+
+
+def get_mail_records(domain, dns_local):
+    if dns_local["MAIL"]:
+        return dns_local["MAIL"]
+    if dns_local["WEB4"] or dns_local["WEB6"]:
+        # no MX, but the domain itself might accept mail
+        return [{"value": domain}]
+    return None
+
+
+def get_web_probes(domain, dns, config, source_ipv4, source_ipv6):
+    """Returns (result key, domain, IPs, source IP, ipv6, tls) for each enabled webserver check."""
+    protocols = []
     if config["web"]["check_ipv4"] and source_ipv4:
-        if config["web"]["check_http"]:
-            result["WEB4_80"] = get_webserver_info(domain, dns["WEB4"], config, source_ipv4, path=path)
-        if config["dns"]["check_www"] and config["web"]["check_http"]:
-            result["WEB4_80_www"] = get_webserver_info(f"www.{domain}", dns["WEB4_www"], config, source_ipv4, path=path)
-        if config["web"]["check_https"]:
-            result["WEB4_443"] = get_webserver_info(domain, dns["WEB4"], config, source_ipv4, tls=True, path=path)
-        if config["dns"]["check_www"] and config["web"]["check_https"]:
-            result["WEB4_443_www"] = get_webserver_info(f"www.{domain}", dns["WEB4_www"], config, source_ipv4, tls=True,
-                                                        path=path)
+        protocols.append(("4", source_ipv4, False))
     if config["web"]["check_ipv6"] and source_ipv6:
-        if config["web"]["check_http"]:
-            result["WEB6_80"] = get_webserver_info(domain, dns["WEB6"], config, source_ipv6, ipv6=True, path=path)
-        if config["dns"]["check_www"] and config["web"]["check_http"]:
-            result["WEB6_80_www"] = get_webserver_info(f"www.{domain}", dns["WEB6_www"], config, source_ipv6, ipv6=True,
-                                                       path=path)
-        if config["web"]["check_https"]:
-            result["WEB6_443"] = get_webserver_info(domain, dns["WEB6"], config, source_ipv6, ipv6=True, tls=True,
-                                                    path=path)
-        if config["dns"]["check_www"] and config["web"]["check_https"]:
-            result["WEB6_443_www"] = get_webserver_info(f"www.{domain}", dns["WEB6_www"],
-                                                        config, source_ipv6, ipv6=True, tls=True, path=path)
-    return result
+        protocols.append(("6", source_ipv6, True))
+    ports = []
+    if config["web"]["check_http"]:
+        ports.append(("80", False))
+    if config["web"]["check_https"]:
+        ports.append(("443", True))
+    probes = []
+    for version, source_ip, ipv6 in protocols:
+        for port, tls in ports:
+            probes.append((f"WEB{version}_{port}", domain, dns[f"WEB{version}"], source_ip, ipv6, tls))
+            if config["dns"]["check_www"]:
+                probes.append((f"WEB{version}_{port}_www", f"www.{domain}", dns[f"WEB{version}_www"],
+                               source_ip, ipv6, tls))
+    return probes
 
 
-def process_domain(domain):
-    redis = get_current_connection()
-    hostname = gethostname()
-    config = load_config(default_config_filename, redis=redis, hostname=hostname)
-    source_ipv4, source_ipv6 = get_source_addresses(redis=redis, config=config)
-    geoip_dbs = init_geoip(config)
-    local_resolver = get_local_resolver(config)
-    dns_local = get_dns_local(domain, config, local_resolver, geoip_dbs)
-    dns_auth = get_dns_auth(domain, dns_local["NS_AUTH"], redis, config, local_resolver, geoip_dbs)
-    if dns_local["MAIL"]:
-        mail = get_mx_info(dns_local["MAIL"], config["mail"]["ports"], geoip_dbs, config["timeouts"]["mail"],
-                           config["mail"]["get_banners"], config["timeouts"]["cache"],
-                           local_resolver, redis, source_ipv4, source_ipv6, config["mail"]["max_ips_per_host"])
-    elif dns_local["WEB4"] or dns_local["WEB6"]:
-        mail = get_mx_info([{"value": domain}], config["mail"]["ports"], geoip_dbs, config["timeouts"]["mail"],
-                           config["mail"]["get_banners"], config["timeouts"]["cache"],
-                           local_resolver, redis, source_ipv4, source_ipv6, config["mail"]["max_ips_per_host"])
-    else:
-        mail = None
-    web = get_web_status(domain, dns_local, config, source_ipv4, source_ipv6)
-    hsts = get_hsts_status(domain)
+async def get_web_statuses_async(domain, dns, config, source_addresses, paths, limiter=None, executor=None):
+    """Checks the webservers of the domain for all the paths at once, returns a `get_web_status` result for each path.
 
-    fetch_web_paths = "paths" in config["web"] and len(config["web"]["paths"]) > 0
+    At most `web.max_connections` requests run at the same time (in the executor's threads), IPs which aren't done
+    in `timeouts.web_deadline` seconds are recorded as timed out. Probes which haven't started by then are cancelled,
+    the running ones stop on their own at the deadline (see `get_webserver_ip_info`).
+    """
+    probes = get_web_probes(domain, dns, config, *source_addresses)
+    if len(probes) == 0:
+        # web checks are disabled (or there's no source address), no need to import them
+        return [{} for path in paths]
+    web_utils = lazy_import(".web_utils")
+    loop = asyncio.get_event_loop()
+    budget = asyncio.Semaphore(int(config["web"]["max_connections"]))
+    deadline = config["timeouts"]["web_deadline"]
+    end = None if deadline is None else monotonic() + float(deadline)
 
-    if fetch_web_paths:
-        web_paths = {}
-        for path in config["web"]["paths"]:
-            web_paths[path] = get_web_status(domain, dns_local, config, source_ipv4, source_ipv6, path=path)
+    async def run_probe(name, ip, source_ip, path, ipv6, tls):
+        async with budget:
+            return await loop.run_in_executor(executor, partial(web_utils.get_webserver_ip_info, name, ip, config,
+                                                                source_ip, path=path, ipv6=ipv6, tls=tls,
+                                                                deadline=end))
 
-    result = {
-        "domain": domain,
-        "timestamp": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-        "results": {
-            "DNS_LOCAL": dns_local,
-            "DNS_AUTH": dns_auth,
-            "MAIL": mail,
-            "WEB": web,
-            "HSTS": hsts
+    async def probe(name, ip, source_ip, path, ipv6, tls):
+        try:
+            return await asyncio.wait_for(run_probe(name, ip, source_ip, path, ipv6, tls),
+                                          None if end is None else max(0, end - monotonic()))
+        except asyncio.TimeoutError:
+            return [{"ip": ip, "error": "timeout"}]
+
+    statuses = await asyncio.gather(*[
+        asyncio.gather(*[
+            web_utils.get_webserver_info_async(name, ips, config, source_ip, probe, path=path, ipv6=ipv6,
+                                               tls=tls, limiter=limiter)
+            for _, name, ips, source_ip, ipv6, tls in probes])
+        for path in paths])
+    return [{probe[0]: result for probe, result in zip(probes, results)} for results in statuses]
+
+
+def get_web_statuses(domain, dns, config, source_ipv4, source_ipv6, paths, limiter=None, executor=None):
+    """`executor` runs the probes, a Crawler passes the one it keeps for all the domains (see `get_executor`),
+    without it, a pool just for this call is used."""
+    if executor is not None:
+        return run_async(get_web_statuses_async(domain, dns, config, (source_ipv4, source_ipv6), paths, limiter,
+                                                executor))
+    executor = ThreadPoolExecutor(max_workers=int(config["web"]["max_connections"]))
+    try:
+        return run_async(get_web_statuses_async(domain, dns, config, (source_ipv4, source_ipv6), paths, limiter,
+                                                executor))
+    finally:
+        executor.shutdown(wait=False)
+
+
+def get_web_status(domain, dns, config, source_ipv4, source_ipv6, path="/", limiter=None):
+    return get_web_statuses(domain, dns, config, source_ipv4, source_ipv6, [path], limiter)[0]
+
+
+def dump_result(result):
+    return json.dumps(result, ensure_ascii=False, check_circular=False, separators=(",", ":"))
+
+
+class Crawler:
+    """Everything needed for crawling – config, DNS resolver, GeoIP DBs, source addresses – set up just once.
+
+    Workers create one before they start taking jobs (and keep it for all of them), library users can create
+    their own and call `crawl` (or `crawl_json`) for as many domains as they like.
+    """
+
+    def __init__(self, config=None, redis=None, hostname=None):
+        self.redis = redis
+        self.hostname = hostname or gethostname()
+        if config is None:
+            config = load_config(default_config_filename, redis=redis, hostname=self.hostname)
+        self.config = config
+        self.source_ipv4, self.source_ipv6 = get_source_addresses(redis=redis, hostname=self.hostname, config=config)
+        self.geoip_dbs = init_geoip(config)
+        self.local_resolver = get_local_resolver(config)
+        self.dnssec_validator = get_dnssec_validator(config, self.local_resolver)
+        if config["politeness"]["enabled"] and redis is not None:
+            self.limiter = TargetLimiter(redis, config, self.geoip_dbs)
+        else:
+            self.limiter = None
+        self.executors = {}
+
+    def get_executor(self, name, threads):
+        """A thread pool for the blocking parts of the crawl (HTTP(S) checks), kept for all the domains (one per
+        process). Threads of checks which ran out of time finish in it, instead of piling up in new pools."""
+        pid, executor = self.executors.get(name, (None, None))
+        if executor is None or pid != os.getpid():
+            executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=name)
+            self.executors[name] = (os.getpid(), executor)
+        return executor
+
+    def crawl(self, domain, delegation=None):
+        """`delegation` is the domain's DS and glue from the parent zone, if the input is a zone file (see
+        `input_utils.read_zone`) – the DS and the nameservers' addresses from it aren't queried again."""
+        config = self.config
+        redis = self.redis
+        geoip_dbs = self.geoip_dbs
+        # counts the domain's queries, see RetryPolicy
+        local_resolver = DomainQueries(self.local_resolver)
+        validator = self.dnssec_validator
+        source_ipv4, source_ipv6 = self.source_ipv4, self.source_ipv6
+        limiter = self.limiter
+        with timed_stage("dns_local"):
+            dns_local = get_dns_local(domain, config, local_resolver, geoip_dbs, validator, delegation)
+        if is_dead(dns_local, config):
+            return self.build_result(domain, dns_local, None, None, None, None, status=dns_local["rcode"],
+                                     dns_queries=local_resolver.stats)
+        with timed_stage("dns_auth"):
+            dns_auth = get_dns_auth(domain, dns_local["NS_AUTH"], redis, config, local_resolver, geoip_dbs, limiter,
+                                    (source_ipv4, source_ipv6), delegation.get("glue") if delegation else None)
+        with timed_stage("mail"):
+            mail = get_mx_info(get_mail_records(domain, dns_local), config["mail"]["ports"], geoip_dbs,
+                               config["timeouts"]["mail"], config["mail"]["get_banners"], config["timeouts"]["cache"],
+                               local_resolver, redis, source_ipv4, source_ipv6, config["mail"]["max_ips_per_host"],
+                               limiter, config["timeouts"]["cache_lock"])
+        with timed_stage("web"):
+            paths = config["web"].get("paths") or []
+            web, *statuses = get_web_statuses(domain, dns_local, config, source_ipv4, source_ipv6, ["/"] + paths,
+                                              limiter, self.get_executor("web", int(config["web"]["max_connections"])))
+            hsts = lazy_import(".hsts_utils").get_hsts_status(domain)
+            web_paths = dict(zip(paths, statuses)) if len(paths) > 0 else None
+        return self.build_result(domain, dns_local, dns_auth, mail, web, hsts, web_paths,
+                                 dns_queries=local_resolver.stats)
+
+    def build_result(self, domain, dns_local, dns_auth, mail, web, hsts, web_paths=None, status=None, dns_queries=None):
+        """`status` is set (to the rcode) when the domain is dead and only DNS_LOCAL was crawled, `dns_queries` are
+        the domain's query counters (see DomainQueries)."""
+        result = {
+            "domain": domain,
+            "timestamp": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+            "results": {
+                "DNS_LOCAL": dns_local,
+                "DNS_AUTH": dns_auth,
+                "MAIL": mail,
+                "WEB": web,
+                "HSTS": hsts
+            }
         }
-    }
 
-    if fetch_web_paths:
-        result["results"]["WEB_paths"] = web_paths
+        if web_paths is not None:
+            result["results"]["WEB_paths"] = web_paths
 
-    if config["save_worker_hostname"]:
-        result["worker_hostname"] = hostname
+        if status is not None:
+            result["status"] = status
 
-    return result
+        if dns_queries is not None:
+            result["dns_queries"] = dns_queries
 
+        if self.config["save_worker_hostname"]:
+            result["worker_hostname"] = self.hostname
 
-def get_json_result(domain):
-    return json.dumps(process_domain(domain), ensure_ascii=False, check_circular=False, separators=(",", ":"))
+        return result
+
+    def crawl_json(self, domain, delegation=None):
+        return dump_result(self.crawl(domain, delegation))
+
+
+crawler = None
+
+
+def get_crawler():
+    """Returns the crawler for the current Redis connection (if any), creates it on the first use."""
+    global crawler
+    from rq import get_current_connection
+    redis = get_current_connection()
+    if crawler is None or crawler.redis is not redis:
+        crawler = Crawler(redis=redis)
+    return crawler
+
+
+def process_domain(domain):
+    return get_crawler().crawl(domain)
+
+
+def get_json_result(domain, delegation=None):
+    return get_crawler().crawl_json(domain, delegation)
+
+
+def push_json_result(domain, line=None, delegation=None):
+    from rq import get_current_connection
+    redis = get_current_connection()
+    pipe = redis.pipeline(transaction=False)
+    try:
+        result = get_json_result(domain, delegation)
+        push_result(pipe, result, line)
+        metrics.inc("dns_crawler_result_bytes_total", len(result.encode("utf-8")))
+        metrics.inc("dns_crawler_domains_total", status="finished")
+    except BaseException:
+        metrics.inc("dns_crawler_domains_total", status="failed")
+        raise
+    finally:
+        # the failure itself is reported by the worker (see CrawlerWorker.handle_job_failure)
+        metrics.flush(pipe, get_host_key(gethostname()))
+        pipe.execute()
+
+
+def push_json_results(domains, lines=None, delegations=None):
+    from rq import get_current_connection, get_current_job
+    redis = get_current_connection()
+    job = get_current_job()
+    crawler = get_crawler()
+    timeout = int(crawler.config["timeouts"]["job"])
+
+    def push(index, domain, result, error):
+        line = lines[index] if lines is not None else None
+        pipe = redis.pipeline(transaction=False)
+        if error is None:
+            push_result(pipe, result, line)
+            metrics.inc("dns_crawler_result_bytes_total", len(result.encode("utf-8")))
+            metrics.inc("dns_crawler_domains_total", status="finished")
+        else:
+            push_failure(pipe, domain, error, line)
+            metrics.inc("dns_crawler_domains_total", status="failed")
+        # used to report the rest of the batch as failed if the whole job dies
+        pipe.hset(job.key, f"done-{index}", 1)
+        metrics.flush(pipe, get_host_key(crawler.hostname))
+        pipe.execute()
+
+    if crawler.config["async"]["enabled"]:
+        from .async_crawl import AsyncCrawler
+        AsyncCrawler(crawler).run(domains, push, delegations)
+        return
+    for index, domain in enumerate(domains):
+        try:
+            with domain_timeout(timeout):
+                result = crawler.crawl_json(domain, delegations[index] if delegations is not None else None)
+        except (Exception, DomainTimeout) as e:
+            push(index, domain, None, str(e))
+        else:
+            push(index, domain, result, None)
@@ -0,0 +1,92 @@
+# Copyright © 2019-2021 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Lock
+from time import monotonic
+
+from .metrics import metrics
+
+
+class RecordCache:
+    """LRU cache of lookup results, {(name, record type): (records, rcode)}, each kept for the TTL it came with.
+
+    Only for names shared by many domains (nameservers, mailservers), the domains' own records aren't worth it.
+    Hits and misses go to the `dns_crawler_cache_requests_total{cache="<name>"}` metric too. Values are copied
+    on the way in and out, unless `copy` is False (for values nobody modifies, eg. dnspython's rrsets).
+    """
+
+    def __init__(self, size, max_ttl=None, name="dns", copy=True):
+        self.size = size
+        self.max_ttl = max_ttl
+        self.name = name
+        self.copy = copy
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_key(self, name, record):
+        return (name.lower().rstrip("."), record)
+
+    def get(self, name, record):
+        """Returns (True, value) if it's cached and still valid, (False, None) otherwise."""
+        key = self.get_key(name, record)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses = self.misses + 1
+            else:
+                self.hits = self.hits + 1
+                self.entries.move_to_end(key)
+        metrics.inc("dns_crawler_cache_requests_total", cache=self.name, result="miss" if entry is None else "hit")
+        if entry is None:
+            return (False, None)
+        # callers annotate the records in place
+        return (True, deepcopy(entry[1]) if self.copy else entry[1])
+
+    def set(self, name, record, value, ttl):
+        if not ttl or ttl <= 0:
+            return
+        if self.max_ttl is not None:
+            ttl = min(ttl, self.max_ttl)
+        key = self.get_key(name, record)
+        with self.lock:
+            self.entries[key] = (monotonic() + ttl, deepcopy(value) if self.copy else value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions = self.evictions + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
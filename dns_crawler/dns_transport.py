@@ -0,0 +1,453 @@
+# Copyright © 2019-2021 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import random
+import struct
+from copy import copy
+from time import monotonic
+from weakref import WeakKeyDictionary
+
+import dns.entropy
+import dns.exception
+import dns.message
+import dns.query
+
+from .metrics import metrics
+
+# pipelined TCP connections kept open to each resolver
+TCP_CONNECTIONS = 2
+
+# smoothing factor for the average response time of a resolver
+RTT_WEIGHT = 0.3
+# seconds, a resolver which keeps failing is skipped for this long, doubled with each failure (up to MAX_BACKOFF)
+BACKOFF = 0.5
+MAX_BACKOFF = 30
+
+# event loop: {(resolver IP, port): Resolver}
+resolvers = WeakKeyDictionary()
+
+
+def get_id(wire):
+    return struct.unpack("!H", wire[:2])[0]
+
+
+def set_result(pending, wire):
+    future = pending.pop(get_id(wire), None)
+    if future is not None and not future.done():
+        future.set_result(wire)
+
+
+def fail_pending(pending, exception):
+    for future in pending.values():
+        if not future.done():
+            future.set_exception(exception)
+    pending.clear()
+
+
+class UDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, pending):
+        self.pending = pending
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        # the socket is connected to the resolver, so the kernel drops datagrams from anywhere else
+        if len(data) >= 2:
+            set_result(self.pending, data)
+
+    def error_received(self, exc):
+        # eg. ICMP port unreachable, queries sent so far won't get an answer
+        fail_pending(self.pending, dns.exception.Timeout())
+
+    def connection_lost(self, exc):
+        self.transport = None
+        fail_pending(self.pending, dns.exception.Timeout())
+
+
+class TCPConnection:
+    """A TCP connection with many queries in flight at once (RFC 7766), answers can come in any order."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}
+        self.closed = False
+        self.reading = asyncio.ensure_future(self.read_responses())
+
+    async def read_responses(self):
+        try:
+            while True:
+                size = struct.unpack("!H", await self.reader.readexactly(2))[0]
+                set_result(self.pending, await self.reader.readexactly(size))
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            self.close()
+
+    def send(self, request_id, wire):
+        if self.closed:
+            raise ConnectionResetError()
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(struct.pack("!H", len(wire)) + wire)
+        return future
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        # resolvers close idle connections, the queries are retried on a new one
+        fail_pending(self.pending, ConnectionResetError())
+
+
+class Resolver:
+    """Long-lived UDP socket and pipelined TCP connections to a single resolver.
+
+    Queries get random IDs which aren't in flight already, so responses can be matched to them and any number
+    of them can be sent at once without opening a socket for each.
+    """
+
+    def __init__(self, address, port):
+        self.address = address
+        self.port = port
+        self.udp = None
+        self.udp_pending = {}
+        self.udp_lock = asyncio.Lock()
+        self.tcp = []
+        self.tcp_lock = asyncio.Lock()
+
+    def get_free_id(self, pending):
+        while True:
+            request_id = dns.entropy.random_16()
+            if request_id not in pending:
+                return request_id
+
+    async def get_udp(self):
+        async with self.udp_lock:
+            if self.udp is None or self.udp.transport is None:
+                loop = asyncio.get_event_loop()
+                self.udp_pending = {}
+                _, self.udp = await loop.create_datagram_endpoint(lambda: UDPProtocol(self.udp_pending),
+                                                                  remote_addr=(self.address, self.port))
+            return self.udp
+
+    async def get_tcp(self, timeout):
+        async with self.tcp_lock:
+            self.tcp = [connection for connection in self.tcp if not connection.closed]
+            idle = [connection for connection in self.tcp if len(connection.pending) == 0]
+            if len(idle) > 0 or len(self.tcp) >= TCP_CONNECTIONS:
+                return min(idle or self.tcp, key=lambda connection: len(connection.pending))
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(self.address, self.port), timeout)
+            except asyncio.TimeoutError:
+                raise dns.exception.Timeout()
+            connection = TCPConnection(reader, writer)
+            self.tcp.append(connection)
+            return connection
+
+    async def wait(self, future, pending, request_id, timeout):
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise dns.exception.Timeout()
+        finally:
+            pending.pop(request_id, None)
+
+    async def udp_query(self, request, timeout, raise_on_truncation=False):
+        protocol = await self.get_udp()
+        request.id = self.get_free_id(protocol.pending)
+        future = asyncio.get_event_loop().create_future()
+        protocol.pending[request.id] = future
+        protocol.transport.sendto(request.to_wire())
+        wire = await self.wait(future, protocol.pending, request.id, timeout)
+        return parse_response(request, wire, raise_on_truncation)
+
+    async def tcp_query(self, request, timeout, retry=True):
+        started = asyncio.get_event_loop().time()
+        connection = await self.get_tcp(timeout)
+        if timeout is not None:
+            # connecting counts towards the timeout too
+            timeout = max(0, timeout - (asyncio.get_event_loop().time() - started))
+        request.id = self.get_free_id(connection.pending)
+        try:
+            future = connection.send(request.id, request.to_wire())
+            wire = await self.wait(future, connection.pending, request.id, timeout)
+        except ConnectionResetError:
+            if not retry:
+                raise dns.exception.Timeout()
+            return await self.tcp_query(request, timeout, retry=False)
+        return parse_response(request, wire)
+
+    def close(self):
+        if self.udp is not None and self.udp.transport is not None:
+            self.udp.transport.close()
+        for connection in self.tcp:
+            connection.close()
+
+
+def parse_response(request, wire, raise_on_truncation=False):
+    response = dns.message.from_wire(wire, keyring=request.keyring, request_mac=request.mac,
+                                     raise_on_truncation=raise_on_truncation)
+    if not request.is_response(response):
+        raise dns.query.BadResponse()
+    return response
+
+
+def get_resolver(where, port):
+    loop = asyncio.get_event_loop()
+    if loop not in resolvers:
+        resolvers[loop] = {}
+    if (where, port) not in resolvers[loop]:
+        resolvers[loop][(where, port)] = Resolver(where, port)
+    return resolvers[loop][(where, port)]
+
+
+async def udp(request, where, timeout=None, port=53, ignore_unexpected=False, raise_on_truncation=False):
+    """Same as `dns.asyncquery.udp`, but reuses the socket of the current event loop for the resolver."""
+    return await get_resolver(where, port).udp_query(request, timeout, raise_on_truncation)
+
+
+async def tcp(request, where, timeout=None, port=53):
+    """Same as `dns.asyncquery.tcp`, but queries are pipelined over connections kept open for the resolver."""
+    return await get_resolver(where, port).tcp_query(request, timeout)
+
+
+def close(loop):
+    """Closes the sockets opened in the event loop – call it before closing the loop."""
+    for resolver in resolvers.pop(loop, {}).values():
+        resolver.close()
+
+
+class RetryPolicy:
+    """How many times a query is retried after a bad response (with jittered exponential backoff), and how many
+    queries a single domain can send (None for no limit)."""
+
+    def __init__(self, max_retries=2, backoff=0.1, max_backoff=1, max_queries=None):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_queries = max_queries
+
+    def get_delay(self, attempt):
+        # full jitter, so retries from many domains don't come in waves
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class QueryBudgetExceeded(dns.exception.Timeout):
+    msg = "The domain sent too many queries."
+
+
+class ResolverStats:
+    def __init__(self):
+        self.rtt = None
+        self.in_flight = 0
+        self.failures = 0
+        self.skip_until = 0
+
+    def is_available(self):
+        return monotonic() >= self.skip_until
+
+    def score(self):
+        # unknown resolvers go first, so every one of them gets tried
+        return (self.rtt or 0) * (1 + self.in_flight)
+
+    def update_rtt(self, rtt):
+        self.rtt = rtt if self.rtt is None else (1 - RTT_WEIGHT) * self.rtt + RTT_WEIGHT * rtt
+
+    def success(self, rtt):
+        self.update_rtt(rtt)
+        self.failures = 0
+        self.skip_until = 0
+
+    def failure(self):
+        self.failures = self.failures + 1
+        self.skip_until = monotonic() + min(MAX_BACKOFF, BACKOFF * 2 ** (self.failures - 1))
+
+
+class ResolverPool:
+    """All the configured resolvers, each query goes to the better one of two random picks (by response time and
+    queries in flight).
+
+    If the resolver fails, the query is retried with another one, and if it doesn't answer in `hedge_after` seconds,
+    the query is sent to another one as well – the first answer wins. Resolvers which keep failing are skipped for
+    a while. The response times and failures are kept as long as the pool (a worker has one for all its jobs, see
+    `Crawler`), so a new job doesn't start from scratch. Has the `nameservers`, `timeout`, `lifetime`, and `cache`
+    (a `dns_cache.RecordCache`, or None) of a `dns.resolver.Resolver`. Retries after bad responses are up to the
+    `retry_policy` (see `query_with_retries`).
+    """
+
+    def __init__(self, nameservers, timeout, hedge_after=None, port=53, cache=None, retry_policy=None):
+        self.nameservers = list(nameservers)
+        self.timeout = self.lifetime = timeout
+        self.hedge_after = hedge_after
+        self.port = port
+        self.cache = cache
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.stats = {nameserver: ResolverStats() for nameserver in self.nameservers}
+
+    def pick(self, exclude=()):
+        candidates = [nameserver for nameserver in self.nameservers if nameserver not in exclude]
+        if len(candidates) == 0:
+            return None
+        available = [nameserver for nameserver in candidates if self.stats[nameserver].is_available()] or candidates
+        if len(available) == 1:
+            return available[0]
+        first, second = random.sample(available, 2)
+        return first if self.stats[first].score() <= self.stats[second].score() else second
+
+    async def send(self, nameserver, request, tcp, timeout, raise_on_truncation):
+        stats = self.stats[nameserver]
+        resolver = get_resolver(nameserver, self.port)
+        # each copy gets its own ID
+        request = copy(request)
+        started = monotonic()
+        stats.in_flight = stats.in_flight + 1
+        try:
+            if tcp:
+                response = await resolver.tcp_query(request, timeout)
+            else:
+                response = await resolver.udp_query(request, timeout, raise_on_truncation)
+        except dns.message.Truncated:
+            # not the resolver's fault
+            stats.success(monotonic() - started)
+            raise
+        except (dns.exception.Timeout, dns.query.BadResponse, OSError):
+            stats.failure()
+            metrics.inc("dns_crawler_resolver_queries_total", resolver=nameserver, result="error")
+            raise
+        except asyncio.CancelledError:
+            # another resolver was faster, this one took at least this long
+            stats.update_rtt(monotonic() - started)
+            raise
+        finally:
+            stats.in_flight = stats.in_flight - 1
+        stats.success(monotonic() - started)
+        metrics.inc("dns_crawler_resolver_queries_total", resolver=nameserver, result="ok")
+        metrics.observe("dns_crawler_resolver_response_seconds", monotonic() - started, resolver=nameserver)
+        return response
+
+    async def query(self, request, tcp=False, raise_on_truncation=False):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.timeout
+        tried = []
+        tasks = {}
+        error = dns.exception.Timeout()
+
+        def start(nameserver):
+            tried.append(nameserver)
+            task = asyncio.ensure_future(self.send(nameserver, request, tcp, deadline - loop.time(),
+                                                   raise_on_truncation))
+            tasks[task] = nameserver
+
+        start(self.pick())
+        try:
+            while len(tasks) > 0:
+                remaining = deadline - loop.time()
+                can_hedge = self.hedge_after is not None and len(tried) < len(self.nameservers)
+                wait = min(self.hedge_after, remaining) if can_hedge and len(tasks) == 1 else remaining
+                done, _ = await asyncio.wait(list(tasks), timeout=max(0, wait), return_when=asyncio.FIRST_COMPLETED)
+                if len(done) == 0:
+                    if can_hedge and loop.time() < deadline:
+                        # the resolver is slow, let's see if another one is faster
+                        metrics.inc("dns_crawler_resolver_queries_total", resolver=tasks[next(iter(tasks))],
+                                    result="hedged")
+                        start(self.pick(exclude=tried))
+                        continue
+                    break
+                for task in done:
+                    del tasks[task]
+                    try:
+                        return task.result()
+                    except (dns.exception.Timeout, dns.query.BadResponse, OSError) as e:
+                        error = e
+                if len(tasks) == 0 and len(tried) < len(self.nameservers) and loop.time() < deadline:
+                    # failover
+                    start(self.pick(exclude=tried))
+        finally:
+            for task in tasks:
+                task.cancel()
+        raise error
+
+    async def udp(self, request, raise_on_truncation=False):
+        return await self.query(request, raise_on_truncation=raise_on_truncation)
+
+    async def tcp(self, request):
+        return await self.query(request, tcp=True)
+
+    def count(self, event):
+        metrics.inc("dns_crawler_query_retries_total", result=event)
+
+
+class DomainQueries:
+    """The resolver pool as seen by a single domain – counts its queries and retries, and once the domain sends
+    `retry_policy.max_queries` of them, the rest fail right away (with QueryBudgetExceeded, a Timeout)."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.stats = {"queries": 0, "retries": 0, "gave_up": 0, "over_budget": 0}
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def use_budget(self):
+        max_queries = self.pool.retry_policy.max_queries
+        if max_queries is not None and self.stats["queries"] >= max_queries:
+            self.count("over_budget")
+            raise QueryBudgetExceeded()
+        self.stats["queries"] = self.stats["queries"] + 1
+
+    async def udp(self, request, raise_on_truncation=False):
+        self.use_budget()
+        return await self.pool.udp(request, raise_on_truncation)
+
+    async def tcp(self, request):
+        self.use_budget()
+        return await self.pool.tcp(request)
+
+    def count(self, event):
+        key = "retries" if event == "retry" else event
+        self.stats[key] = self.stats[key] + 1
+        self.pool.count(event)
+
+
+async def query_with_retries(resolver, request, tcp=False):
+    """Sends the request to the resolver (ResolverPool or DomainQueries), over TCP if the answer is truncated.
+
+    After a bad response, the query is retried (with a growing random delay), until the resolver's retry policy runs
+    out – then the error is raised. Timeouts aren't retried, the pool tries all the resolvers before giving up.
+    """
+    policy = resolver.retry_policy
+    attempt = 0
+    while True:
+        try:
+            if tcp:
+                return await resolver.tcp(request)
+            return await resolver.udp(request, raise_on_truncation=True)
+        except dns.message.Truncated:
+            tcp = True
+        except (dns.query.UnexpectedSource, dns.query.BadResponse):
+            if attempt >= policy.max_retries:
+                resolver.count("gave_up")
+                raise
+            resolver.count("retry")
+            await asyncio.sleep(policy.get_delay(attempt))
+            attempt = attempt + 1
@@ -16,115 +16,75 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json
+import asyncio
 import re
+from copy import deepcopy
 
+import dns.asyncresolver
 import dns.dnssec
 import dns.name
 import dns.resolver
+import dns.rrset
 
-import checkdmarc
-
+from .dns_cache import RecordCache
+from .dns_transport import ResolverPool, RetryPolicy, query_with_retries
+from .dnssec_utils import DnssecValidator
 from .geoip_utils import annotate_geoip
+from .imports import lazy_import
+from .politeness import limited_map, limited_map_async
+from .redis_utils import get_cached_locked, get_cached_locked_async, set_cached, unlock_cached
+from .utils import run_async, run_blocking
 
 
 def get_local_resolver(config):
     dns_timeout = config["timeouts"]["dns"]
     use_custom_dns = "dns" in config and len(config["dns"]["resolvers"]) > 0
 
-    local_resolver = dns.resolver.Resolver(configure=(not use_custom_dns))
-    local_resolver.timeout = local_resolver.lifetime = dns_timeout
     if use_custom_dns:
-        local_resolver.nameservers = config["dns"]["resolvers"]
-    return local_resolver
-
-
-def validate_rrset(rrset, rrsigset, keys, origin=None, now=None):
-    if isinstance(origin, str):
-        origin = dns.name.from_text(origin, dns.name.root)
-
-    if isinstance(rrset, tuple):
-        rrname = rrset[0]
-    else:
-        rrname = rrset.name
-
-    if isinstance(rrsigset, tuple):
-        rrsigname = rrsigset[0]
-        rrsigrdataset = rrsigset[1]
+        nameservers = config["dns"]["resolvers"]
     else:
-        rrsigname = rrsigset.name
-        rrsigrdataset = rrsigset
-
-    rrname = rrname.choose_relativity(origin)
-    rrsigname = rrsigname.choose_relativity(origin)
-    if rrname != rrsigname:
-        raise dns.dnssec.ValidationFailure("owner names do not match")
-
-    messages = []
-    for rrsig in rrsigrdataset:
-        try:
-            dns.dnssec._validate_rrsig(rrset, rrsig, keys, origin, now)
-            return
-        except dns.dnssec.ValidationFailure as e:
-            messages.append(str(e))
-    raise dns.dnssec.ValidationFailure(messages[-1])
-
-
-def check_dnssec(domain, resolver):
-    dnsname = dns.name.from_text(domain)
-    depth = dnsname.__len__()
-    sub = (dnsname.split(depth=depth))[1]
-    q = dns.message.make_query(sub, "DNSKEY", want_dnssec=True)
-    try:
-        response = dns.query.udp(q, resolver.nameservers[0], resolver.timeout, ignore_unexpected=True)
-    except dns.exception.Timeout:
-        return {"valid": None, "error": "timeout"}
-    except dns.exception.FormError as e:
-        return {"valid": None, "error": str(e)}
-    except dns.message.Truncated:
-        try:
-            response = dns.query.tcp(q, resolver.nameservers[0], resolver.timeout)
-        except dns.exception.Timeout:
-            return {"valid": None, "error": "timeout"}
-
-    rcode = response.rcode()
+        nameservers = dns.resolver.Resolver().nameservers
+    cache = None
+    if config["dns"]["cache_size"]:
+        cache = RecordCache(int(config["dns"]["cache_size"]), config["dns"]["cache_max_ttl"])
+    max_queries = config["dns"]["max_queries_per_domain"]
+    retry_policy = RetryPolicy(int(config["dns"]["max_retries"]), float(config["dns"]["retry_backoff"]),
+                               max_queries=int(max_queries) if max_queries else None)
+    return ResolverPool(nameservers, dns_timeout, hedge_after=config["dns"]["hedge_after"], cache=cache,
+                        retry_policy=retry_policy)
 
-    if rcode == 2:  # NOERROR
-        return {"valid": False, "message": f"rcode {rcode}"}
 
-    if rcode != 0:  # NOERROR
-        return {"valid": None, "message": f"rcode {rcode}"}
+def check_dnssec(domain, resolver, validator=None):
+    return run_async(check_dnssec_async(domain, resolver, validator))
 
-    answer = response.answer
 
-    if len(answer) == 0:  # no DNSSEC records
-        return {"valid": None, "message": "No records"}
+async def check_dnssec_async(domain, resolver, validator=None):
+    ds, dnskey, dnssec = await get_dnssec_records_async(domain, validator or DnssecValidator(resolver))
+    return dnssec
 
-    if len(answer) == 1:  # missing DS or DNSKEY
-        if "DNSKEY" in repr(answer[0]):
-            return {"valid": None, "message": "Missing DS"}
-        elif "DS" in repr(answer[0]):
-            return {"valid": None, "message": "Missing DNSKEY"}
-        else:
-            return {"valid": None, "message": f"Missing DS or DNSKEY, answer contains: '{answer[0]}'."}
-
-    try:
-        if answer[0].rdtype == dns.rdatatype.RRSIG:
-            rrsig, rrset = answer
-        elif answer[1].rdtype == dns.rdatatype.RRSIG:
-            rrset, rrsig = answer
-        else:
-            return {"valid": None, "error": "something weird happened"}
-    except ValueError as e:
-        return {"valid": None, "error": str(e)}
 
-    keys = {sub: rrset}
+async def get_dnssec_records_async(domain_name, validator, resolver=None, ds=None):
+    """Returns ((DS records, rcode), (DNSKEY records, rcode), DNSSEC check) – the check uses the same two responses.
 
-    try:
-        validate_rrset(rrset, rrsig, keys)
-    except Exception as e:
-        return {"valid": False, "error": str(e)}
-    return {"valid": True, "rrsig": str(rrsig).split("\n")}
+    `resolver` is the one for the domain's own queries (eg. DomainQueries), the validator's one by default. With `ds`
+    (DS records as text, from the parent zone), the DS isn't queried, and it's trusted without validation.
+    """
+    domain = dns.name.from_text(domain_name)
+    if ds is None:
+        ds_response, dnskey_response = await asyncio.gather(
+            try_query(validator.query(domain, "DS", resolver=resolver)),
+            try_query(validator.query_keys(domain, resolver)))
+        dnssec = await validator.check(domain, dnskey_response, ds_response)
+        ds_records = get_records_with_rcode(ds_response, domain, "DS")
+    else:
+        ds_rrset = dns.rrset.from_text_list(domain, 0, "IN", "DS", ds)
+        dnskey_response = await try_query(validator.query_keys(domain, resolver))
+        dnssec = await validator.check(domain, dnskey_response, None, ds_rrset)
+        ds_records = (get_rrset_records(ds_rrset), "NOERROR")
+    if validator.trust_ad and dnskey_response is not None and dnskey_response.rcode() == dns.rcode.SERVFAIL:
+        # bogus, get the records without validation
+        dnskey_response = await try_query(validator.query(domain, "DNSKEY", resolver=resolver))
+    return (ds_records, get_records_with_rcode(dnskey_response, domain, "DNSKEY"), dnssec)
 
 
 def annotate_dns_algorithm(items, index, key="value"):
@@ -132,6 +92,10 @@ def annotate_dns_algorithm(items, index, key="value"):
         for item in items:
             if not item[key]:
                 continue
+            rdata = getattr(item, "rdata", None)
+            if hasattr(rdata, "algorithm"):
+                item["algorithm"] = dns.dnssec.algorithm_to_text(rdata.algorithm)
+                continue
             try:
                 alg_number = item[key].split()[index]
             except IndexError:
@@ -144,6 +108,7 @@ def annotate_dns_algorithm(items, index, key="value"):
 def parse_dmarc(items, domain, key="value"):
     if (not items) or len(items) == 0:
         return None
+    checkdmarc = lazy_import("checkdmarc")
     parsed = []
     for item in items:
         try:
@@ -166,6 +131,7 @@ def get_spf_pass_ips(parsed_record, ipv):
 def parse_spf(items, domain, key="value"):
     if (not items) or len(items) == 0:
         return None
+    checkdmarc = lazy_import("checkdmarc")
     parsed = []
     for item in items:
         try:
@@ -190,6 +156,11 @@ def parse_tlsa(items, key="value"):
     for item in items:
         if not item[key]:
             continue
+        rdata = getattr(item, "rdata", None)
+        if rdata is not None and rdata.rdtype == dns.rdatatype.TLSA:
+            parsed.append({"usage": rdata.usage, "selector": rdata.selector, "matchingtype": rdata.mtype,
+                           "data": rdata.cert.hex()})
+            continue
         output = {}
         fields = item[key].split(" ")
         output["usage"] = int(fields[0])
@@ -232,80 +203,227 @@ def get_chaostxt(nameserver, qname, timeout):
     return result
 
 
-def get_ns_info(ip, chaosrecords, geoip_dbs, timeout, cache_timeout, redis):
-    cache_key = f"cache-ns-{ip['value']}"
-    if redis is not None:
-        cached = redis.get(cache_key)
-        if cached is not None:
-            redis.expire(cache_key, cache_timeout)
-            return json.loads(cached.decode("utf-8"))
-    if ip["value"] is None:
-        return None
+async def get_chaostxt_async(nameserver, qname, timeout):
+    try:
+        resolver = dns.asyncresolver.Resolver(configure=False)
+        resolver.nameservers = [nameserver]
+        resolver.timeout = timeout
+        resolver.lifetime = timeout
+        answers = await resolver.resolve(qname, rdtype="TXT", rdclass="CHAOS", lifetime=timeout)
+        return {"value": [str(answer).replace('"', "") for answer in answers]}
+    except Exception as e:
+        return {"value": None, "error": str(e)}
+
+
+def get_chaostxts(nameserver, chaosrecords, timeout):
+    return {record.replace(".", ""): get_chaostxt(nameserver, record, timeout) for record in chaosrecords}
+
+
+async def get_chaostxts_async(nameserver, chaosrecords, timeout):
+    values = await asyncio.gather(*[get_chaostxt_async(nameserver, record, timeout) for record in chaosrecords])
+    return {record.replace(".", ""): value for record, value in zip(chaosrecords, values)}
+
+
+def get_ns_geoip(ip, geoip_dbs):
     geoip = annotate_geoip([ip], geoip_dbs)[0]
-    result = {
+    return {
         "ip": ip["value"],
         "geoip": geoip["geoip"] if "geoip" in geoip else None
     }
-    for record in chaosrecords:
-        result[record.replace(".", "")] = get_chaostxt(ip["value"], record, timeout)
-    if redis is not None:
-        redis.set(cache_key, json.dumps(result), ex=cache_timeout)
-    return result
 
 
-def value_from_record(record, data):
-    return re.sub(r".*" + re.escape(record) + " ", "", data)
+def get_ns_info(ip, chaosrecords, geoip_dbs, timeout, cache_timeout, redis, limiter=None, lock_timeout=None):
+    """With `lock_timeout`, only one worker at a time sends the CHAOS queries to a nameserver missing in the cache,
+    the others wait for its result (see `get_cached_locked`)."""
+    if ip["value"] is None:
+        return None
+    cache_key = f"cache-ns-{ip['value']}"
+    cached, lock = get_cached_locked(redis, cache_key, cache_timeout, "ns", lock_timeout)
+    if cached is not None:
+        return cached
+    try:
+        result = get_ns_geoip(ip, geoip_dbs)
+        chaos = limited_map(limiter, [ip["value"]],
+                            lambda nameserver: get_chaostxts(nameserver, chaosrecords, timeout),
+                            lambda nameserver: None)[0]
+        if chaos is None:
+            # rate limited, don't cache the incomplete result
+            result["error"] = "rate limited"
+            return result
+        result.update(chaos)
+        set_cached(redis, cache_key, result, cache_timeout)
+        return result
+    finally:
+        unlock_cached(redis, cache_key, lock)
+
+
+async def get_ns_info_async(ip, chaosrecords, geoip_dbs, timeout, cache_timeout, redis, limiter=None,
+                            lock_timeout=None):
+    if ip["value"] is None:
+        return None
+    cache_key = f"cache-ns-{ip['value']}"
+    cached, lock = await get_cached_locked_async(redis, cache_key, cache_timeout, "ns", lock_timeout)
+    if cached is not None:
+        return cached
+    try:
+        result = get_ns_geoip(ip, geoip_dbs)
+        chaos = (await limited_map_async(limiter, [ip["value"]],
+                                         lambda nameserver: get_chaostxts_async(nameserver, chaosrecords, timeout),
+                                         lambda nameserver: None))[0]
+        if chaos is None:
+            result["error"] = "rate limited"
+            return result
+        result.update(chaos)
+        if redis is not None:
+            await run_blocking(set_cached, redis, cache_key, result, cache_timeout)
+        return result
+    finally:
+        if lock is not None:
+            await run_blocking(unlock_cached, redis, cache_key, lock)
+
+
+# same as rdata.to_text(), just a lot faster for the most common types
+RDATA_TEXT = {
+    dns.rdatatype.A: lambda rdata: rdata.address,
+    dns.rdatatype.AAAA: lambda rdata: rdata.address
+}
+
+
+class Record(dict):
+    """A record as it goes to the results, `{"value": "<text>", …}`, with the dnspython rdata kept aside
+    (as `record.rdata`) for the parsers."""
 
+    __slots__ = ("rdata",)
 
-def get_record(domain_name, record, resolver, protocol="udp", cname_count=None):
-    results = []
+    def __deepcopy__(self, memo):
+        # rdata is immutable
+        return make_record(self.rdata, deepcopy(dict(self), memo))
+
+
+def make_record(rdata, fields):
+    record = Record(fields)
+    record.rdata = rdata
+    return record
+
+
+def get_rdata_text(rdata):
+    to_text = RDATA_TEXT.get(rdata.rdtype)
+    return rdata.to_text() if to_text is None else to_text(rdata)
+
+
+def make_record_query(domain_name, record):
     domain = dns.name.from_text(domain_name)
     if not domain.is_absolute():
         domain = domain.concatenate(dns.name.root)
     request = dns.message.make_query(domain, record)
     request.flags |= dns.flags.CD
-    try:
-        if protocol == "udp":
-            response = getattr(dns.query, protocol)(request, resolver.nameservers[0],
-                                                    resolver.timeout, raise_on_truncation=True)
-        else:
-            response = getattr(dns.query, protocol)(request, resolver.nameservers[0], resolver.timeout)
-    except (
-        dns.query.UnexpectedSource,
-        dns.query.BadResponse
-    ):
-        return get_record(domain_name, record, resolver)
-    except (
-        dns.resolver.NoAnswer,
-        dns.rdatatype.UnknownRdatatype,
-        dns.resolver.NoNameservers,
-        dns.resolver.NXDOMAIN,
-        dns.exception.Timeout,
-        dns.exception.FormError
-    ):
-        return None
-    except dns.message.Truncated:
-        return get_record(domain_name, record, resolver, protocol="tcp")
+    return (domain, request)
+
+
+def get_rrset_records(rrset):
+    records = [make_record(rdata, {"value": get_rdata_text(rdata)}) for rdata in rrset]
+    return records if len(records) > 0 else None
+
+
+def parse_record_response(response, domain, record):
+    rdtype = dns.rdatatype.from_text(record)
+    results = []
     for item in response.answer:
-        if item.rdtype == dns.rdatatype.from_text(record) and item.name == domain:
-            for line in str(item).split("\n"):
-                results.append({"value": value_from_record(record, line)})
-        elif item.rdtype == dns.rdatatype.from_text("CNAME"):
-            for line in str(item).split("\n"):
-                cname_domain = value_from_record("CNAME", line)
-                results.append({
-                    "cname": cname_domain,
-                    "value": None
-                })
-        if item.rdtype == dns.rdatatype.from_text(record) and "cname" in results[-1]:
-            for line in str(item).split("\n"):
-                results.append({"value": value_from_record(record, line), "from_cname": str(item.name)})
+        if item.rdtype == rdtype and item.name == domain:
+            results.extend(make_record(rdata, {"value": get_rdata_text(rdata)}) for rdata in item)
+        elif item.rdtype == dns.rdatatype.CNAME:
+            results.extend(make_record(rdata, {"cname": rdata.to_text(), "value": None}) for rdata in item)
+        if item.rdtype == rdtype and len(results) > 0 and "cname" in results[-1]:
+            results.extend(make_record(rdata, {"value": get_rdata_text(rdata), "from_cname": str(item.name)})
+                           for rdata in item)
     if len(results) > 0:
         return results
     else:
         return None
 
 
+RECORD_ERRORS = (
+    dns.resolver.NoAnswer,
+    dns.rdatatype.UnknownRdatatype,
+    dns.resolver.NoNameservers,
+    dns.resolver.NXDOMAIN,
+    dns.exception.Timeout,
+    dns.exception.FormError
+)
+
+
+def get_response_ttl(response):
+    """Returns how long the answer can be cached, or None if it can't (errors other than NXDOMAIN)."""
+    rcode = response.rcode()
+    if rcode == dns.rcode.NOERROR and len(response.answer) > 0:
+        return min(rrset.ttl for rrset in response.answer)
+    if rcode in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+        # negative answer, cached for the SOA minimum (RFC 2308)
+        for rrset in response.authority:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return min(rrset.ttl, rrset[0].minimum)
+    return None
+
+
+def get_record(domain_name, record, resolver, protocol="udp", cname_count=None, cached=False):
+    return run_async(get_record_async(domain_name, record, resolver, protocol, cached))
+
+
+def get_record_with_rcode(domain_name, record, resolver, protocol="udp", cached=False):
+    return run_async(get_record_with_rcode_async(domain_name, record, resolver, protocol, cached))
+
+
+async def query_record_async(domain_name, record, resolver, protocol="udp"):
+    """Returns (query name, response), or None if there's no response."""
+    try:
+        domain, request = make_record_query(domain_name, record)
+        response = await query_with_retries(resolver, request, tcp=protocol != "udp")
+    except RECORD_ERRORS + (dns.query.UnexpectedSource, dns.query.BadResponse):
+        return None
+    return (domain, response)
+
+
+async def try_query(coroutine):
+    """Returns the response, or None if there's none."""
+    try:
+        return await coroutine
+    except RECORD_ERRORS + (dns.query.UnexpectedSource, dns.query.BadResponse):
+        return None
+
+
+def get_records_with_rcode(response, domain, record):
+    if response is None:
+        return (None, None)
+    return (parse_record_response(response, domain, record), dns.rcode.to_text(response.rcode()))
+
+
+async def get_record_async(domain_name, record, resolver, protocol="udp", cached=False):
+    """Returns the records (see `parse_record_response`), `cached` ones come from the resolver's cache if possible.
+
+    Use `cached` for names shared by many domains only (nameservers, mailservers).
+    """
+    records, rcode = await get_record_with_rcode_async(domain_name, record, resolver, protocol, cached)
+    return records
+
+
+async def get_record_with_rcode_async(domain_name, record, resolver, protocol="udp", cached=False):
+    """Same as `get_record_async`, but returns (records, rcode) – the rcode as text, eg. `NXDOMAIN`, or None if
+    there's no response."""
+    cache = resolver.cache if cached else None
+    if cache is not None:
+        hit, answer = cache.get(domain_name, record)
+        if hit:
+            return answer
+    answer = await query_record_async(domain_name, record, resolver, protocol)
+    if answer is None:
+        return (None, None)
+    domain, response = answer
+    records = get_records_with_rcode(response, domain, record)
+    if cache is not None:
+        cache.set(domain_name, record, records, get_response_ttl(response))
+    return records
+
+
 additional_parsers = {
     "SPF": parse_spf
 }
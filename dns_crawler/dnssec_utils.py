@@ -0,0 +1,248 @@
+# Copyright © 2019-2021 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+from time import time
+
+import dns.dnssec
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+
+from .dns_cache import RecordCache
+from .dns_transport import query_with_retries
+
+# root zone KSKs (https://data.iana.org/root-anchors/root-anchors.xml)
+ROOT_TRUST_ANCHORS = [
+    "20326 8 2 E06D44B80B8F1D39A95C0B0D7C65D08458E880409BBC683457104237C7F8EC8D",
+    "38696 8 2 683D2D0ACB8C9B712A1948B27F741219298D0A450D612C483AF444A4C0FB2B16"
+]
+
+DS_DIGESTS = {1: "SHA1", 2: "SHA256", 4: "SHA384"}
+
+# zones above the domains (root, TLDs, …)
+KEY_CACHE_SIZE = 1000
+
+# seconds, for zones which can't be validated
+NEGATIVE_TTL = 60
+
+
+class InsecureZone(Exception):
+    pass
+
+
+def validate_rrset(rrset, rrsigset, keys, origin=None, now=None):
+    if isinstance(origin, str):
+        origin = dns.name.from_text(origin, dns.name.root)
+
+    if isinstance(rrset, tuple):
+        rrname = rrset[0]
+    else:
+        rrname = rrset.name
+
+    if isinstance(rrsigset, tuple):
+        rrsigname = rrsigset[0]
+        rrsigrdataset = rrsigset[1]
+    else:
+        rrsigname = rrsigset.name
+        rrsigrdataset = rrsigset
+
+    rrname = rrname.choose_relativity(origin)
+    rrsigname = rrsigname.choose_relativity(origin)
+    if rrname != rrsigname:
+        raise dns.dnssec.ValidationFailure("owner names do not match")
+
+    messages = []
+    for rrsig in rrsigrdataset:
+        try:
+            dns.dnssec.validate_rrsig(rrset, rrsig, keys, origin, now)
+            return
+        except dns.dnssec.ValidationFailure as e:
+            messages.append(str(e))
+    raise dns.dnssec.ValidationFailure(messages[-1])
+
+
+def make_dnssec_request(name, record, checking_disabled=True):
+    request = dns.message.make_query(name, record, want_dnssec=True)
+    if checking_disabled:
+        request.flags |= dns.flags.CD
+    return request
+
+
+def get_signed_rrset(response, name, record):
+    """Returns (rrset, RRSIG rrset) from the answer, either of them might be None."""
+    rdtype = dns.rdatatype.from_text(record)
+    rrset = response.get_rrset(response.answer, name, dns.rdataclass.IN, rdtype)
+    rrsig = response.get_rrset(response.answer, name, dns.rdataclass.IN, dns.rdatatype.RRSIG, rdtype)
+    return (rrset, rrsig)
+
+
+def get_validity(rrsets):
+    """How long the validation result holds – the lowest TTL, but not past the expiration of any of the signatures."""
+    expirations = [rrsig.expiration - time() for rrset in rrsets if rrset.rdtype == dns.rdatatype.RRSIG
+                   for rrsig in rrset]
+    return min([rrset.ttl for rrset in rrsets] + expirations)
+
+
+def validate_keys(name, dnskey, rrsig, ds):
+    """Checks that the DNSKEY set is signed by one of the keys the DS set points to."""
+    secure_keys = [key for key in dnskey for digest in ds
+                   if digest.digest_type in DS_DIGESTS and digest.key_tag == dns.dnssec.key_id(key) and
+                   dns.dnssec.make_ds(name, key, DS_DIGESTS[digest.digest_type]) == digest]
+    if len(secure_keys) == 0:
+        raise dns.dnssec.ValidationFailure("no DNSKEY matches the DS")
+    validate_rrset(dnskey, rrsig, {name: dns.rrset.from_rdata_list(name, dnskey.ttl, secure_keys)})
+
+
+class DnssecValidator:
+    """Validates the chain of trust from the root down to the domain's DNSKEY, using the domain's own DS and DNSKEY
+    responses (the crawler fetches them anyway).
+
+    The keys of the zones above (root, TLDs, …) are validated once and cached for their TTL, so checking a domain
+    usually doesn't need any extra queries. With `trust_ad`, the validation is left to the resolvers and the AD flag
+    of the DNSKEY response is all that matters.
+    """
+
+    def __init__(self, resolver, trust_ad=False, max_ttl=None, trust_anchors=ROOT_TRUST_ANCHORS):
+        self.resolver = resolver
+        self.trust_ad = trust_ad
+        self.anchors = dns.rrset.from_text_list(dns.name.root, 0, "IN", "DS", trust_anchors)
+        self.keys = RecordCache(KEY_CACHE_SIZE, max_ttl, name="dnssec", copy=False)
+        # zones being fetched right now, {(event loop, zone): task}
+        self.pending = {}
+
+    async def query(self, name, record, checking_disabled=True, resolver=None):
+        request = make_dnssec_request(name, record, checking_disabled)
+        return await query_with_retries(resolver or self.resolver, request)
+
+    async def query_keys(self, name, resolver=None):
+        """DNSKEY query for the domain – resolvers validate it only if asked to (without the CD flag)."""
+        return await self.query(name, "DNSKEY", checking_disabled=not self.trust_ad, resolver=resolver)
+
+    async def get_keys(self, zone):
+        """Returns the validated DNSKEY set of the zone, raises InsecureZone or ValidationFailure if there's none."""
+        hit, entry = self.keys.get(zone.to_text(), "DNSKEY")
+        if not hit:
+            loop = asyncio.get_event_loop()
+            key = (loop, zone)
+            if key not in self.pending:
+                # other domains under the same zone wait for the same task
+                self.pending[key] = loop.create_task(self.fetch_keys(zone))
+                self.pending[key].add_done_callback(lambda task: self.pending.pop(key, None))
+            entry = await asyncio.shield(self.pending[key])
+        keys, error, message = entry
+        if error is not None:
+            raise error(message)
+        return keys
+
+    async def fetch_keys(self, zone):
+        try:
+            keys, ttl = await self.validate_zone(zone)
+        except (InsecureZone, dns.dnssec.ValidationFailure, dns.dnssec.UnsupportedAlgorithm) as e:
+            entry = (None, type(e), str(e))
+            self.keys.set(zone.to_text(), "DNSKEY", entry, NEGATIVE_TTL)
+            return entry
+        entry = (keys, None, None)
+        self.keys.set(zone.to_text(), "DNSKEY", entry, ttl)
+        return entry
+
+    async def validate_zone(self, zone):
+        """Returns (validated DNSKEY set, TTL) of a zone above the domain."""
+        if zone == dns.name.root:
+            ds = self.anchors
+            chain = []
+        else:
+            ds_response = await self.query(zone, "DS")
+            ds, ds_rrsig = get_signed_rrset(ds_response, zone, "DS")
+            if ds is None:
+                raise InsecureZone(f"{zone} is not signed")
+            await self.validate_ds(ds, ds_rrsig)
+            chain = [ds, ds_rrsig]
+        response = await self.query(zone, "DNSKEY")
+        dnskey, rrsig = get_signed_rrset(response, zone, "DNSKEY")
+        if dnskey is None or rrsig is None:
+            raise dns.dnssec.ValidationFailure(f"{zone} has a DS, but no signed DNSKEY")
+        validate_keys(zone, dnskey, rrsig, ds)
+        return (dnskey, get_validity([dnskey, rrsig] + chain))
+
+    async def validate_ds(self, ds, rrsig):
+        """Checks the DS set with the keys of the zone which signed it (the parent zone).
+
+        The signer has to be a zone above the DS owner – otherwise any secure zone (eg. an attacker's own domain)
+        could vouch for a forged DS, and a zone signing its own DS would wait for its own keys.
+        """
+        if rrsig is None:
+            raise dns.dnssec.ValidationFailure(f"DS of {ds.name} is not signed")
+        signer = rrsig[0].signer
+        if signer == ds.name or not ds.name.is_subdomain(signer):
+            raise dns.dnssec.ValidationFailure(f"DS of {ds.name} is signed by {signer}, not by a zone above it")
+        validate_rrset(ds, rrsig, {signer: await self.get_keys(signer)})
+
+    async def check(self, domain, dnskey_response, ds_response, ds=None):
+        """Returns the DNSSEC check result of the domain (name) from its DNSKEY and DS responses (None for timeouts).
+
+        `ds` is a DS rrset known to be genuine (eg. from the parent zone file), used instead of the DS response.
+        """
+        if dnskey_response is None:
+            return {"valid": None, "error": "timeout"}
+        rcode = dnskey_response.rcode()
+        if rcode == dns.rcode.SERVFAIL and self.trust_ad:
+            # validating resolvers refuse bogus answers
+            return {"valid": False, "message": f"rcode {rcode}"}
+        if rcode != dns.rcode.NOERROR:
+            return {"valid": None, "message": f"rcode {rcode}"}
+        dnskey, rrsig = get_signed_rrset(dnskey_response, domain, "DNSKEY")
+        if dnskey is None:
+            return {"valid": None, "message": "No records"}
+        if rrsig is None:
+            return {"valid": None, "message": "Missing RRSIG"}
+        if self.trust_ad:
+            if not dnskey_response.flags & dns.flags.AD:
+                return {"valid": None, "message": "Not validated by the resolver"}
+            return {"valid": True, "rrsig": str(rrsig).split("\n")}
+        trusted = ds is not None
+        if not trusted:
+            if ds_response is None:
+                return {"valid": None, "error": "timeout"}
+            ds, ds_rrsig = get_signed_rrset(ds_response, domain, "DS")
+        if ds is None or len(ds) == 0:
+            return {"valid": None, "message": "Missing DS"}
+        try:
+            if not trusted:
+                await self.validate_ds(ds, ds_rrsig)
+            validate_keys(domain, dnskey, rrsig, ds)
+        except dns.exception.Timeout:
+            return {"valid": None, "error": "timeout"}
+        except InsecureZone as e:
+            return {"valid": None, "message": str(e)}
+        except dns.dnssec.UnsupportedAlgorithm as e:
+            return {"valid": None, "error": str(e)}
+        except dns.dnssec.ValidationFailure as e:
+            return {"valid": False, "error": str(e)}
+        except dns.exception.DNSException as e:
+            return {"valid": None, "error": str(e)}
+        return {"valid": True, "rrsig": str(rrsig).split("\n")}
+
+
+def get_dnssec_validator(config, resolver):
+    return DnssecValidator(resolver, trust_ad=config["dns"]["dnssec"] == "ad", max_ttl=config["dns"]["cache_max_ttl"])
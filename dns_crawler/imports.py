@@ -0,0 +1,68 @@
+# Copyright © 2019-2021 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import importlib
+import sys
+from time import monotonic
+
+# module name: seconds it took to import it
+import_times = {}
+
+
+def lazy_import(name):
+    """Imports the module on the first use (names starting with a dot are relative to dns_crawler).
+
+    Heavy parts of the crawler (web checks, SPF/DMARC parsing, encoding detection, …) are imported this way,
+    so crawls which don't need them (and the controller) don't pay for them.
+    """
+    if name.startswith("."):
+        name = f"dns_crawler{name}"
+    imported = name in sys.modules
+    started = monotonic()
+    # not just sys.modules.get – a module which another thread is still importing is there already (half-initialised),
+    # import_module waits for it to finish
+    module = importlib.import_module(name)
+    if not imported:
+        import_times.setdefault(name, monotonic() - started)
+    return module
+
+
+def get_subsystems(config):
+    """Returns the lazily imported modules crawling with the config will need."""
+    modules = ["checkdmarc", ".hsts_utils"]
+    web = config["web"]
+    if (web["check_http"] or web["check_https"]) and (web["check_ipv4"] or web["check_ipv6"]):
+        modules.append(".web_utils")
+        if web["save_content"]:
+            modules.append("icu")
+    return modules
+
+
+def import_subsystems(config):
+    """Imports everything the config needs right away – for processes which fork the workers."""
+    for name in get_subsystems(config):
+        lazy_import(name)
+
+
+def get_import_report():
+    if len(import_times) == 0:
+        return "Nothing was imported lazily."
+    modules = sorted(import_times.items(), key=lambda item: item[1], reverse=True)
+    return (f"Imported {len(modules)} module{('s' if len(modules) > 1 else '')} lazily in "
+            f"{sum(import_times.values()):.2f} s: " +
+            ", ".join(f"{name} ({seconds * 1000:.0f} ms)" for name, seconds in modules) + ".")
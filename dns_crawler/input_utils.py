@@ -0,0 +1,209 @@
+# Copyright © 2019-2021 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import math
+
+import dns.exception
+import dns.name
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.tokenizer
+import idna
+
+# records read from zone files, the rest is skipped
+ZONE_RECORDS = (dns.rdatatype.NS, dns.rdatatype.DS, dns.rdatatype.A, dns.rdatatype.AAAA)
+
+
+class ZoneError(Exception):
+    pass
+
+
+class BloomFilter:
+    """Fixed-size set of strings with no false negatives and a tunable rate of false positives."""
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def add(self, key):
+        """Adds the key, returns True if it (probably) was already there."""
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        present = True
+        for i in range(self.hash_count):
+            bit = (h1 + i * h2) % self.size
+            byte = bit >> 3
+            mask = 1 << (bit & 7)
+            if not self.bits[byte] & mask:
+                present = False
+                self.bits[byte] = self.bits[byte] | mask
+        return present
+
+
+def normalize_domain(line):
+    """Returns a tuple of (domain, key), where key is the ASCII form used for deduplication.
+
+    Unicode names are mapped with UTS #46 (eg. fullwidth or uppercase letters), so the crawled domain is the same one
+    the key stands for, ASCII names (including A-labels) are kept as they are. Domain is None for empty lines, raises
+    UnicodeError (idna.IDNAError) for invalid names.
+    """
+    domain = line.strip().rstrip(".").lower()
+    if not domain:
+        return (None, None)
+    # a fullwidth trailing dot is mapped to a normal one
+    key = idna.encode(domain, uts46=True).rstrip(b".")
+    if domain.encode("utf-8") != key:
+        domain = idna.decode(key)
+    return (domain, key)
+
+
+class InputNormalizer:
+    def __init__(self, config):
+        input_config = config["input"]
+        self.seen = None
+        if input_config["dedupe"]:
+            self.seen = BloomFilter(int(input_config["dedupe_capacity"]), float(input_config["dedupe_error_rate"]))
+        self.duplicate_count = 0
+        self.invalid_count = 0
+
+    def normalize(self, line, skip=False):
+        """Returns the normalized domain, or None for empty, invalid, and duplicate names.
+
+        With skip=True, the domain is just remembered (eg. when it was crawled before resuming).
+        """
+        try:
+            domain, key = normalize_domain(line)
+        except UnicodeError:
+            if not skip:
+                self.invalid_count = self.invalid_count + 1
+            return None
+        if domain is None:
+            return None
+        if self.seen is not None and self.seen.add(key):
+            if not skip:
+                self.duplicate_count = self.duplicate_count + 1
+            return None
+        return domain
+
+    def report(self):
+        return f"Dropped {self.duplicate_count} duplicate and {self.invalid_count} invalid domain names."
+
+
+def skip_line(tok):
+    while not tok.get().is_eol_or_eof():
+        pass
+
+
+def read_zone_records(file, origin):
+    """Streams (line number, owner name, record type, rdata) from a zone file (RFC 1035 master file, without
+    `$INCLUDE`s) – rdata is parsed for ZONE_RECORDS only, it's None for the rest."""
+    tok = dns.tokenizer.Tokenizer(file)
+    origin = dns.name.from_text(origin)
+    owner = None
+    try:
+        while True:
+            token = tok.get(want_leading=True, want_comment=True)
+            if token.is_eof():
+                return
+            if token.is_eol():
+                continue
+            if token.is_comment():
+                tok.get_eol()
+                continue
+            if token.value.startswith("$"):
+                if token.value.upper() == "$ORIGIN":
+                    origin = dns.name.from_text(tok.get_string(), origin)
+                    tok.get_eol()
+                else:
+                    # $TTL doesn't matter, $INCLUDE and $GENERATE aren't supported
+                    skip_line(tok)
+                continue
+            line = tok.line_number
+            if not token.is_whitespace():
+                owner = dns.name.from_text(token.value, origin)
+            elif owner is None:
+                raise dns.exception.SyntaxError("the first record has no owner name")
+            # TTL and class are optional (in any order), then the type
+            rdtype = None
+            while rdtype is None:
+                value = tok.get_string()
+                if value[0].isdigit():
+                    continue
+                try:
+                    dns.rdataclass.from_text(value)
+                except dns.rdataclass.UnknownRdataclass:
+                    rdtype = dns.rdatatype.from_text(value)
+            if rdtype in ZONE_RECORDS:
+                yield (line, owner, rdtype, dns.rdata.from_text(dns.rdataclass.IN, rdtype, tok, origin, False))
+            else:
+                skip_line(tok)
+                yield (line, owner, rdtype, None)
+    except dns.exception.DNSException as e:
+        raise ZoneError(f"line {tok.line_number}: {e}")
+
+
+def make_delegation(records, below, signed):
+    """The delegation as it goes to the jobs, see `read_zone`."""
+    targets = [rdata.target for rdata in records.get(dns.rdatatype.NS, [])]
+    glue = {}
+    for target in targets:
+        addresses = below.get(target, {})
+        glue[target.to_text().lower()] = {dns.rdatatype.to_text(rdtype): [rdata.address for rdata in addresses[rdtype]]
+                                          for rdtype in (dns.rdatatype.A, dns.rdatatype.AAAA) if rdtype in addresses}
+    # the NS set itself isn't passed on, the crawl asks the domain's nameservers for theirs
+    delegation = {
+        "glue": {target: addresses for target, addresses in glue.items() if len(addresses) > 0}
+    }
+    if signed or dns.rdatatype.DS in records:
+        delegation["DS"] = [rdata.to_text() for rdata in records.get(dns.rdatatype.DS, [])]
+    return delegation
+
+
+def read_zone(file, origin):
+    """Streams (line number, domain name, delegation) for each domain delegated from the zone (has NS records).
+
+    The delegation is `{"glue": {name: {"A": [IPs], "AAAA": [IPs]}}, "DS": [records]}` – with the glue
+    of the domain's own nameservers (below the domain), and the DS only if the zone is signed (has a DNSKEY at the
+    apex), otherwise a missing DS doesn't mean anything. The records of each domain (and its glue) have to be
+    together, as they are in zone dumps and AXFRs.
+    """
+    apex = dns.name.from_text(origin)
+    signed = False
+    # (line number, name, {type: [rdata]}, {name below: {type: [rdata]}})
+    current = None
+    for line, owner, rdtype, rdata in read_zone_records(file, origin):
+        if current is not None and (owner == current[1] or
+                                    owner.is_subdomain(current[1]) and dns.rdatatype.NS in current[2]):
+            records = current[2] if owner == current[1] else current[3].setdefault(owner, {})
+            records.setdefault(rdtype, []).append(rdata)
+            continue
+        if current is not None and dns.rdatatype.NS in current[2]:
+            yield (current[0], current[1].to_text(omit_final_dot=True),
+                   make_delegation(current[2], current[3], signed))
+        current = None
+        if owner == apex:
+            signed = signed or rdtype == dns.rdatatype.DNSKEY
+        elif owner.is_subdomain(apex):
+            current = (line, owner, {rdtype: [rdata]}, {})
+    if current is not None and dns.rdatatype.NS in current[2]:
+        yield (current[0], current[1].to_text(omit_final_dot=True),
+               make_delegation(current[2], current[3], signed))
@@ -17,12 +17,18 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import json
+import asyncio
 import socket
+from functools import partial
+from time import monotonic, sleep
 
-from .dns_utils import get_record, parse_tlsa
+from .dns_utils import get_record, get_record_async, parse_tlsa
 from .geoip_utils import annotate_geoip
 from .ip_utils import is_valid_ipv4_address, is_valid_ipv6_address
+from .politeness import limited_map, limited_map_async
+from .redis_utils import (CACHE_LOCK_INTERVAL, claim_cached, get_cached_locked, get_cached_locked_async,
+                          release_cached, set_cached, unlock_cached)
+from .utils import run_blocking
 
 
 def get_smtp_banner(host_ip, port, timeout):
@@ -45,63 +51,215 @@ def get_smtp_banner(host_ip, port, timeout):
     return result
 
 
-def get_mailserver_info(host, ports, geoip_dbs, timeout, get_banners, cache_timeout,
-                        resolver, redis, source_ipv4, source_ipv6, max_ips_per_host):
-    cache_key_host = f"cache-mail-host-{host}"
-    if redis is not None:
-        cached_host = redis.get(cache_key_host)
-        if cached_host is not None:
-            redis.expire(cache_key_host, cache_timeout)
-            return json.loads(cached_host.decode("utf-8"))
+async def get_smtp_banner_async(host_ip, port, timeout):
     result = {}
-    result["host"] = host
-    result["TLSA"] = {}
+    if not is_valid_ipv4_address(host_ip) and not is_valid_ipv6_address(host_ip):
+        return None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host_ip, port), timeout)
+        try:
+            banner = await asyncio.wait_for(reader.read(1024), timeout)
+            result["banner"] = banner.decode().replace("\r\n", "")
+        finally:
+            writer.close()
+    except asyncio.TimeoutError:
+        # same message as the socket timeout in get_smtp_banner
+        result["error"] = "timed out"
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+
+def get_ip_banners(host_ip, ports, timeout):
+    ip_banners = {"ip": host_ip, "banners": {}}
     for port in ports:
-        result["TLSA"][port] = parse_tlsa(get_record(f"_{port}._tcp." + host, "TLSA", resolver))
-    if get_banners:
-        result["banners"] = []
-        if source_ipv4 and source_ipv6:
-            host_ip4s = get_record(host, "A", resolver) or []
-            host_ip6s = get_record(host, "AAAA", resolver) or []
-            host_ips = host_ip4s + host_ip6s
-        if source_ipv4 and not source_ipv6:
-            host_ips = get_record(host, "A", resolver) or []
-        if source_ipv6 and not source_ipv4:
-            host_ips = get_record(host, "AAAA", resolver) or []
-        for host_ip in host_ips[:max_ips_per_host]:
-            host_ip = host_ip["value"]
-            cache_key_ip = f"cache-mail-ip-{host_ip}"
-            if redis is not None:
-                cached_ip = redis.get(cache_key_ip)
-                if cached_ip is not None:
-                    redis.expire(cache_key_ip, cache_timeout)
-                    result["banners"].append(json.loads(cached_ip.decode("utf-8")))
-                    continue
-            ip_banners = {"ip": host_ip, "banners": {}}
-            for port in ports:
-                ip_banners["banners"][port] = get_smtp_banner(host_ip, port, timeout)
+        ip_banners["banners"][port] = get_smtp_banner(host_ip, port, timeout)
+    return ip_banners
+
+
+async def get_ip_banners_async(host_ip, ports, timeout):
+    banners = await asyncio.gather(*[get_smtp_banner_async(host_ip, port, timeout) for port in ports])
+    return {"ip": host_ip, "banners": dict(zip(ports, banners))}
+
+
+def get_rate_limited_banners(host_ip):
+    return {"ip": host_ip, "banners": None, "error": "rate limited"}
+
+
+def get_host_ips(ip4s, ip6s, source_ipv4, source_ipv6, max_ips_per_host):
+    if source_ipv4 and source_ipv6:
+        host_ips = (ip4s or []) + (ip6s or [])
+    if source_ipv4 and not source_ipv6:
+        host_ips = ip4s or []
+    if source_ipv6 and not source_ipv4:
+        host_ips = ip6s or []
+    return [host_ip["value"] for host_ip in host_ips[:max_ips_per_host]]
+
+
+def cache_banners(banners, host_ips, fetched, redis, cache_timeout):
+    """Adds the fetched banners (and caches them), returns False if some of them are missing (rate limited)."""
+    complete = True
+    for host_ip, ip_banners in zip(host_ips, fetched):
+        if "error" in ip_banners:
+            complete = False
+        else:
+            set_cached(redis, f"cache-mail-ip-{host_ip}", ip_banners, cache_timeout)
+        banners[host_ip] = ip_banners
+    return complete
+
+
+def get_host_banners(host_ips, ports, timeout, redis, cache_timeout, lock_timeout=None, limiter=None):
+    """Returns ({IP: banners}, False if some of them are missing).
+
+    IPs which other workers are connecting to right now are waited for (see `get_cached_locked`) – after this worker
+    is done with its own ones and has released their locks, so nobody waits while holding a lock.
+    """
+    banners = {}
+    complete = True
+    pending = host_ips
+    deadline = monotonic() + (lock_timeout or 0)
+    waiting = set()
+    while len(pending) > 0:
+        keys = {f"cache-mail-ip-{host_ip}": host_ip for host_ip in pending}
+        cached, locks, busy = claim_cached(redis, list(keys), cache_timeout, "mail-ip", lock_timeout,
+                                           monotonic() >= deadline, waiting)
+        banners.update({keys[key]: value for key, value in cached.items()})
+        uncached_ips = [keys[key] for key in locks]
+        try:
+            fetched = limited_map(limiter, uncached_ips, lambda host_ip: get_ip_banners(host_ip, ports, timeout),
+                                  get_rate_limited_banners)
+            complete = cache_banners(banners, uncached_ips, fetched, redis, cache_timeout) and complete
+        finally:
+            release_cached(redis, locks)
+        pending = [keys[key] for key in busy]
+        if len(pending) > 0:
+            sleep(CACHE_LOCK_INTERVAL)
+    return (banners, complete)
+
+
+async def get_host_banners_async(host_ips, ports, timeout, redis, cache_timeout, lock_timeout=None, limiter=None):
+    banners = {}
+    complete = True
+    pending = host_ips
+    deadline = monotonic() + (lock_timeout or 0)
+    waiting = set()
+    while len(pending) > 0:
+        keys = {f"cache-mail-ip-{host_ip}": host_ip for host_ip in pending}
+        claim = partial(claim_cached, redis, list(keys), cache_timeout, "mail-ip", lock_timeout,
+                        monotonic() >= deadline, waiting)
+        cached, locks, busy = claim() if redis is None else await run_blocking(claim)
+        banners.update({keys[key]: value for key, value in cached.items()})
+        uncached_ips = [keys[key] for key in locks]
+        try:
+            fetched = await limited_map_async(limiter, uncached_ips,
+                                              lambda host_ip: get_ip_banners_async(host_ip, ports, timeout),
+                                              get_rate_limited_banners)
+            complete = await run_blocking(cache_banners, banners, uncached_ips, fetched, redis,
+                                          cache_timeout) and complete
+        finally:
             if redis is not None:
-                redis.set(cache_key_ip, json.dumps(ip_banners), ex=cache_timeout)
-            result["banners"].append(ip_banners)
-        if len(result["banners"]) == 0:
-            result["banners"] = None
+                await run_blocking(release_cached, redis, locks)
+        pending = [keys[key] for key in busy]
+        if len(pending) > 0:
+            await asyncio.sleep(CACHE_LOCK_INTERVAL)
+    return (banners, complete)
+
+
+def add_banners(result, host_ips, banners):
+    result["banners"] = [banners[host_ip] for host_ip in host_ips]
+    if len(result["banners"]) == 0:
+        result["banners"] = None
+
+
+def finish_mailserver_info(result, geoip_dbs, complete, redis, cache_timeout):
     if "banners" in result and result["banners"] is not None:
         annotate_geoip(result["banners"], geoip_dbs, "ip")
-    if redis is not None:
-        redis.set(cache_key_host, json.dumps(result), ex=cache_timeout)
+    if complete:
+        set_cached(redis, f"cache-mail-host-{result['host']}", result, cache_timeout)
     return result
 
 
-def get_mx_info(mx_records, ports, geoip_dbs, timeout, get_banners, cache_timeout,
-                resolver, redis, source_ipv4, source_ipv6, max_ips_per_host):
-    results = []
-    if not mx_records:
-        return None
+def get_mailserver_info(host, ports, geoip_dbs, timeout, get_banners, cache_timeout,
+                        resolver, redis, source_ipv4, source_ipv6, max_ips_per_host, limiter=None, lock_timeout=None):
+    """With `lock_timeout`, only one worker at a time gets the info about a mailserver missing in the cache, the others
+    wait for its result (see `get_cached_locked`)."""
+    cache_key = f"cache-mail-host-{host}"
+    cached, lock = get_cached_locked(redis, cache_key, cache_timeout, "mail-host", lock_timeout)
+    if cached is not None:
+        return cached
+    try:
+        result = {}
+        result["host"] = host
+        result["TLSA"] = {}
+        complete = True
+        for port in ports:
+            result["TLSA"][port] = parse_tlsa(get_record(f"_{port}._tcp." + host, "TLSA", resolver, cached=True))
+        if get_banners:
+            ip4s = get_record(host, "A", resolver, cached=True) if source_ipv4 else None
+            ip6s = get_record(host, "AAAA", resolver, cached=True) if source_ipv6 else None
+            host_ips = get_host_ips(ip4s, ip6s, source_ipv4, source_ipv6, max_ips_per_host)
+            banners, complete = get_host_banners(host_ips, ports, timeout, redis, cache_timeout, lock_timeout, limiter)
+            add_banners(result, host_ips, banners)
+        return finish_mailserver_info(result, geoip_dbs, complete, redis, cache_timeout)
+    finally:
+        unlock_cached(redis, cache_key, lock)
+
+
+async def get_mailserver_info_async(host, ports, geoip_dbs, timeout, get_banners, cache_timeout, resolver, redis,
+                                    source_ipv4, source_ipv6, max_ips_per_host, limiter=None, lock_timeout=None):
+    cache_key = f"cache-mail-host-{host}"
+    cached, lock = await get_cached_locked_async(redis, cache_key, cache_timeout, "mail-host", lock_timeout)
+    if cached is not None:
+        return cached
+    try:
+        result = {}
+        result["host"] = host
+        complete = True
+
+        async def get_host_record(record, enabled):
+            return await get_record_async(host, record, resolver, cached=True) if enabled else None
+
+        *tlsa, ip4s, ip6s = await asyncio.gather(
+            *[get_record_async(f"_{port}._tcp." + host, "TLSA", resolver, cached=True) for port in ports],
+            get_host_record("A", get_banners and source_ipv4),
+            get_host_record("AAAA", get_banners and source_ipv6))
+        result["TLSA"] = {port: parse_tlsa(records) for port, records in zip(ports, tlsa)}
+        if get_banners:
+            host_ips = get_host_ips(ip4s, ip6s, source_ipv4, source_ipv6, max_ips_per_host)
+            banners, complete = await get_host_banners_async(host_ips, ports, timeout, redis, cache_timeout,
+                                                             lock_timeout, limiter)
+            add_banners(result, host_ips, banners)
+        return await run_blocking(finish_mailserver_info, result, geoip_dbs, complete, redis, cache_timeout)
+    finally:
+        if lock is not None:
+            await run_blocking(unlock_cached, redis, cache_key, lock)
+
+
+def get_mx_hosts(mx_records):
+    hosts = []
     for mx in mx_records:
         if mx and mx["value"]:
             host = mx["value"].split(" ")[-1]
             if host and host != ".":
-                results.append(get_mailserver_info(host, ports, geoip_dbs, timeout, get_banners,
-                                                   cache_timeout, resolver, redis, source_ipv4, source_ipv6,
-                                                   max_ips_per_host))
-    return results
+                hosts.append(host)
+    return hosts
+
+
+def get_mx_info(mx_records, ports, geoip_dbs, timeout, get_banners, cache_timeout,
+                resolver, redis, source_ipv4, source_ipv6, max_ips_per_host, limiter=None, lock_timeout=None):
+    if not mx_records:
+        return None
+    return [get_mailserver_info(host, ports, geoip_dbs, timeout, get_banners, cache_timeout, resolver, redis,
+                                source_ipv4, source_ipv6, max_ips_per_host, limiter, lock_timeout)
+            for host in get_mx_hosts(mx_records)]
+
+
+async def get_mx_info_async(mx_records, ports, geoip_dbs, timeout, get_banners, cache_timeout,
+                            resolver, redis, source_ipv4, source_ipv6, max_ips_per_host, limiter=None,
+                            lock_timeout=None):
+    if not mx_records:
+        return None
+    return await asyncio.gather(*[get_mailserver_info_async(host, ports, geoip_dbs, timeout, get_banners,
+                                                            cache_timeout, resolver, redis, source_ipv4, source_ipv6,
+                                                            max_ips_per_host, limiter, lock_timeout)
+                                  for host in get_mx_hosts(mx_records)])
@@ -0,0 +1,183 @@
+# Copyright © 2019-2021 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import socket
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Lock, Thread
+
+METRICS_KEY = "metrics"
+
+# seconds
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+FAMILIES = {
+    "dns_crawler_domains": ("counter", "Crawled domains by status (finished or failed)."),
+    "dns_crawler_input_domains": ("counter", "Domains read from the input and queued."),
+    "dns_crawler_stage_duration_seconds": ("histogram", "Time spent in each crawling stage."),
+    "dns_crawler_stage_timeouts": ("counter", "Domains which ran out of time, by the stage they were in."),
+    "dns_crawler_cache_requests": ("counter", "Nameserver, mailserver, and DNS record cache lookups by result."),
+    "dns_crawler_cache_waits": ("counter", "Cache entries waited for while another worker was getting them."),
+    "dns_crawler_resolver_queries": ("counter", "Queries to the configured resolvers by result (ok, error, hedged)."),
+    "dns_crawler_resolver_response_seconds": ("histogram", "Response time of the configured resolvers."),
+    "dns_crawler_query_retries": ("counter", "DNS query retries, and queries given up (gave_up, over_budget)."),
+    "dns_crawler_result_bytes": ("counter", "Size of the results as JSON."),
+    "dns_crawler_received_bytes": ("counter", "Size of the compressed results read from Redis."),
+    "dns_crawler_queued_jobs": ("gauge", "Jobs waiting in the queue."),
+    "dns_crawler_started_jobs": ("gauge", "Jobs being processed by the workers."),
+    "dns_crawler_pending_results": ("gauge", "Result frames waiting in Redis for the controller."),
+    "dns_crawler_workers": ("gauge", "Running worker processes."),
+}
+
+SUFFIXES = ("_total", "_bucket", "_sum", "_count")
+
+LE_LABEL = re.compile(r',?le="([^"]*)"')
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+
+class Metrics:
+    """Counters and histograms, kept as {sample name with labels: value}.
+
+    Workers collect them while crawling and add them to the per-host totals in Redis after each domain,
+    the controller just keeps its own.
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(float)
+        self.lock = Lock()
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.samples[name + format_labels(labels)] += value
+
+    def observe(self, name, value, buckets=STAGE_BUCKETS, **labels):
+        for bucket in buckets:
+            # every bucket is always present (even with 0), so all series have the same set of buckets
+            self.inc(f"{name}_bucket", 1 if value <= bucket else 0, **labels, le=str(float(bucket)))
+        self.inc(f"{name}_bucket", **labels, le="+Inf")
+        self.inc(f"{name}_sum", value, **labels)
+        self.inc(f"{name}_count", **labels)
+
+    def get_samples(self):
+        with self.lock:
+            return dict(self.samples)
+
+    def flush(self, redis, key):
+        """Adds the samples to the totals in Redis (`redis` can be a pipeline) and starts from zero."""
+        with self.lock:
+            for sample, value in self.samples.items():
+                redis.hincrbyfloat(key, sample, value)
+            self.samples.clear()
+
+
+metrics = Metrics()
+
+
+def get_host_key(hostname):
+    return f"{METRICS_KEY}-{hostname}"
+
+
+def get_family(sample):
+    name = sample.split("{", 1)[0]
+    if name in FAMILIES:
+        return name
+    for suffix in SUFFIXES:
+        if name.endswith(suffix) and name[:-len(suffix)] in FAMILIES:
+            return name[:-len(suffix)]
+    return None
+
+
+def sort_key(sample):
+    # samples with the same labels go together – histogram buckets in increasing order, then count and sum
+    name, _, labels = sample[0].partition("{")
+    le = LE_LABEL.search(labels)
+    return (LE_LABEL.sub("", labels), name.endswith("_count") or name.endswith("_sum"), name.endswith("_sum"),
+            float(le.group(1)) if le else 0)
+
+
+def render(samples, openmetrics=False):
+    """Formats the samples in the Prometheus text format, or OpenMetrics."""
+    families = defaultdict(list)
+    for sample, value in samples.items():
+        if isinstance(sample, bytes):
+            sample = sample.decode("utf-8")
+        family = get_family(sample)
+        if family is not None:
+            families[family].append((sample, float(value)))
+    lines = []
+    for family in sorted(families):
+        metric_type, description = FAMILIES[family]
+        name = family if openmetrics or metric_type != "counter" else family + "_total"
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for sample, value in sorted(families[family], key=sort_key):
+            lines.append(f"{sample} {repr(value)}")
+    if openmetrics:
+        lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+class IPv6HTTPServer(HTTPServer):
+    address_family = socket.AF_INET6
+
+
+def parse_address(address):
+    """[host:]port – IPv6 addresses in brackets, eg. `[::1]:9100`."""
+    host, _, port = address.rpartition(":")
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+    return (host or "0.0.0.0", int(port))
+
+
+def serve_metrics(address, collect):
+    """Serves `collect()` (a dict of samples) on http://<address>/metrics in a background thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+            try:
+                body = render(collect(), openmetrics).encode("utf-8")
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    host, port = parse_address(address)
+    server_class = IPv6HTTPServer if ":" in host else HTTPServer
+    server = server_class((host, port), MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
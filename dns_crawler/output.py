@@ -0,0 +1,216 @@
+# Copyright © 2019-2021 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bz2
+import gzip
+import lzma
+import sys
+from os import path
+from queue import Queue
+from threading import Thread
+
+FLUSH = "flush"
+
+compression_suffixes = {
+    ".gz": "gzip",
+    ".xz": "xz",
+    ".bz2": "bz2",
+    ".zst": "zstd"
+}
+
+
+class OutputError(Exception):
+    pass
+
+
+def open_zstd(file):
+    try:
+        import zstandard
+    except ImportError:
+        raise OutputError("zstd compression needs the 'zstandard' package (pip install zstandard).")
+    return zstandard.ZstdCompressor().stream_writer(file)
+
+
+def open_compressed(file, compression):
+    if compression is None:
+        return file
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=file, mode="wb")
+    if compression == "xz":
+        return lzma.LZMAFile(file, mode="wb")
+    if compression == "bz2":
+        return bz2.BZ2File(file, mode="wb")
+    if compression == "zstd":
+        return open_zstd(file)
+    raise OutputError(f"Unknown output compression '{compression}', use one of: gzip, xz, bz2, zstd.")
+
+
+def get_compression(filename, compression):
+    if compression is not None or filename is None:
+        return compression
+    return compression_suffixes.get(path.splitext(filename)[1])
+
+
+def get_shard_filename(filename, index):
+    directory, basename = path.split(filename)
+    name, dot, extensions = basename.partition(".")
+    return path.join(directory, f"{name}-{index:05d}{dot}{extensions}")
+
+
+def get_part_filename(filename, index):
+    directory, basename = path.split(filename)
+    name, dot, extensions = basename.partition(".")
+    return path.join(directory, f"{name}.part{index}{dot}{extensions}")
+
+
+class ResultWriter:
+    """Writes JSON lines to stdout or (optionally compressed and sharded) files.
+
+    With `append`, plain files are appended to, but compressed ones never are – a file left by a crashed run has no
+    end of the compressed stream, and anything added after it can't be decompressed. The results go to a new file
+    instead: the next shard, or a new part (`results.part2.jsonl.gz`, …) of an unsharded output.
+    """
+
+    def __init__(self, filename=None, compression=None, max_lines_per_file=None, buffer_size=1048576, append=False):
+        self.filename = None if filename == "-" else filename
+        self.compression = get_compression(self.filename, compression)
+        self.max_lines_per_file = int(max_lines_per_file) if max_lines_per_file else None
+        self.buffer_size = int(buffer_size)
+        self.mode = "ab" if append else "wb"
+        self.shard = 0
+        # set if the results go to a new part of the output file
+        self.part_filename = None
+        if append and self.filename is not None and self.max_lines_per_file is not None:
+            # continue with a new file after the existing ones
+            while path.isfile(get_shard_filename(self.filename, self.shard + 1)):
+                self.shard = self.shard + 1
+        elif append and self.filename is not None and self.compression is not None and path.isfile(self.filename):
+            part = 2
+            while path.isfile(get_part_filename(self.filename, part)):
+                part = part + 1
+            self.part_filename = get_part_filename(self.filename, part)
+        self.lines = 0
+        self.raw = None
+        self.file = None
+        self.open()
+
+    def open(self):
+        if self.filename is None:
+            sys.stdout.flush()
+            self.raw = open(sys.stdout.fileno(), "wb", buffering=self.buffer_size, closefd=False)
+        else:
+            filename = self.part_filename or self.filename
+            if self.max_lines_per_file is not None:
+                self.shard = self.shard + 1
+                filename = get_shard_filename(self.filename, self.shard)
+            self.raw = open(filename, self.mode, buffering=self.buffer_size)
+        self.file = open_compressed(self.raw, self.compression)
+        self.lines = 0
+
+    def close_file(self):
+        if self.file is not self.raw:
+            self.file.close()
+        self.raw.close()
+
+    def write(self, results):
+        try:
+            for result in results:
+                if self.max_lines_per_file is not None and self.lines >= self.max_lines_per_file:
+                    self.close_file()
+                    self.open()
+                self.file.write(result.encode("utf-8") + b"\n")
+                self.lines = self.lines + 1
+        except (OSError, ValueError) as e:
+            # eg. a full disk or a closed pipe
+            raise OutputError(f"Writing results failed: {e}")
+
+    def flush(self):
+        try:
+            self.file.flush()
+            self.raw.flush()
+        except (OSError, ValueError) as e:
+            raise OutputError(f"Writing results failed: {e}")
+
+    def close(self):
+        self.close_file()
+
+
+class ThreadedResultWriter:
+    """Same as ResultWriter, but the actual writing (and compression) is done in a separate thread."""
+
+    def __init__(self, *args, queue_size=64, **kwargs):
+        self.writer = ResultWriter(*args, **kwargs)
+        self.queue = Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @property
+    def part_filename(self):
+        return self.writer.part_filename
+
+    def run(self):
+        while True:
+            results = self.queue.get()
+            if results is None:
+                self.queue.task_done()
+                break
+            try:
+                if self.error is not None:
+                    continue
+                if results is FLUSH:
+                    self.writer.flush()
+                else:
+                    self.writer.write(results)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check_error(self):
+        if isinstance(self.error, OutputError):
+            raise self.error
+        if self.error is not None:
+            raise OutputError(f"Writing results failed: {self.error}")
+
+    def write(self, results):
+        self.check_error()
+        if len(results) > 0:
+            self.queue.put(list(results))
+
+    def flush(self):
+        # waits until everything queued so far is written out
+        self.queue.put(FLUSH)
+        self.queue.join()
+        self.check_error()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        self.check_error()
+
+
+def create_writer(config, filename=None, append=False):
+    output_config = config["output"]
+    if filename is None:
+        filename = output_config["path"]
+    writer_class = ThreadedResultWriter if output_config["threaded"] else ResultWriter
+    return writer_class(filename=filename, compression=output_config["compression"],
+                        max_lines_per_file=output_config["max_lines_per_file"],
+                        buffer_size=output_config["buffer_size"], append=append)
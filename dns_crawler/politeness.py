@@ -0,0 +1,168 @@
+# Copyright © 2019-2021 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+from secrets import token_hex
+from time import monotonic, sleep
+
+from .geoip_utils import annotate_geoip
+from .utils import run_blocking
+
+RETRY_INTERVAL = 0.2
+
+# KEYS: connection holders (a sorted set of tokens scored by the time they were acquired), token bucket
+# ARGV: rate (tokens/s), burst, max concurrent connections, key TTL, token
+# Holders older than the key TTL (left behind by killed workers) are dropped, even if the target stays busy.
+# The time comes from the Redis server, clocks of the workers' machines might not agree. Redis < 5 has to replicate
+# the script's writes instead of the script itself for that.
+ACQUIRE_SCRIPT = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now - tonumber(ARGV[4]))
+if redis.call("ZCARD", KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local bucket = redis.call("HMGET", KEYS[2], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+if tokens < 1 then
+    return 0
+end
+redis.call("HMSET", KEYS[2], "tokens", tostring(tokens - 1), "updated", tostring(now))
+redis.call("EXPIRE", KEYS[2], ARGV[4])
+redis.call("ZADD", KEYS[1], now, ARGV[5])
+redis.call("EXPIRE", KEYS[1], ARGV[4])
+return 1
+"""
+
+
+class TargetLimiter:
+    """Cluster-wide limit of new connections per second and concurrent connections for each target IP (or ASN).
+
+    The state is shared by all workers through Redis.
+    """
+
+    def __init__(self, redis, config, geoip_dbs=None):
+        politeness = config["politeness"]
+        self.rate = float(politeness["rate"])
+        self.burst = float(politeness["burst"])
+        self.concurrency = int(politeness["concurrency"])
+        self.max_wait = float(politeness["max_wait"])
+        self.per_asn = politeness["per"] == "asn"
+        self.key_ttl = int(politeness["key_ttl"])
+        self.geoip_dbs = geoip_dbs
+        self.redis = redis
+        self.acquire_script = redis.register_script(ACQUIRE_SCRIPT)
+
+    def get_key(self, ip):
+        if self.per_asn and self.geoip_dbs is not None:
+            geoip = annotate_geoip([{"value": ip}], self.geoip_dbs)[0].get("geoip", {})
+            if geoip.get("asn"):
+                return f"asn-{geoip['asn']}"
+        return ip
+
+    def acquire(self, key):
+        """Returns a token for `release` if the target has a free slot, None otherwise."""
+        token = token_hex(8)
+        acquired = self.acquire_script(keys=[f"limit-conn-{key}", f"limit-rate-{key}"],
+                                       args=[self.rate, self.burst, self.concurrency, self.key_ttl, token])
+        return token if acquired == 1 else None
+
+    def release(self, key, token):
+        self.redis.zrem(f"limit-conn-{key}", token)
+
+    def map(self, ips, func, on_limited):
+        """Calls func for each IP once its target has a free slot.
+
+        Busy targets are deferred (the rest is processed in the meantime) and retried until `max_wait`
+        runs out, `on_limited` is called for the ones that didn't get a slot at all.
+        Results are returned in the same order as the IPs.
+        """
+        keys = [self.get_key(ip) for ip in ips]
+        results = [None] * len(ips)
+        pending = list(range(len(ips)))
+        deadline = monotonic() + self.max_wait
+        while len(pending) > 0:
+            deferred = []
+            for index in pending:
+                token = self.acquire(keys[index])
+                if token is None:
+                    deferred.append(index)
+                    continue
+                try:
+                    results[index] = func(ips[index])
+                finally:
+                    self.release(keys[index], token)
+            if len(deferred) > 0 and monotonic() >= deadline:
+                for index in deferred:
+                    results[index] = on_limited(ips[index])
+                break
+            if len(deferred) > 0:
+                sleep(RETRY_INTERVAL)
+            pending = deferred
+        return results
+
+    async def map_async(self, ips, func, on_limited):
+        """Same as `map`, for coroutine functions – the IPs which get a slot are processed concurrently."""
+        keys = [self.get_key(ip) for ip in ips]
+        results = [None] * len(ips)
+        pending = list(range(len(ips)))
+        deadline = monotonic() + self.max_wait
+
+        async def run(index, token):
+            try:
+                results[index] = await func(ips[index])
+            finally:
+                await run_blocking(self.release, keys[index], token)
+
+        while len(pending) > 0:
+            deferred = []
+            running = []
+            tokens = await asyncio.gather(*[run_blocking(self.acquire, keys[index]) for index in pending])
+            for index, token in zip(pending, tokens):
+                if token is not None:
+                    running.append(run(index, token))
+                else:
+                    deferred.append(index)
+            await asyncio.gather(*running)
+            if len(deferred) > 0 and monotonic() >= deadline:
+                for index in deferred:
+                    results[index] = on_limited(ips[index])
+                break
+            if len(deferred) > 0:
+                await asyncio.sleep(RETRY_INTERVAL)
+            pending = deferred
+        return results
+
+
+def limited_map(limiter, ips, func, on_limited):
+    if limiter is None:
+        return [func(ip) for ip in ips]
+    return limiter.map(ips, func, on_limited)
+
+
+async def limited_map_async(limiter, ips, func, on_limited):
+    if limiter is None:
+        return await asyncio.gather(*[func(ip) for ip in ips])
+    return await limiter.map_async(ips, func, on_limited)
@@ -16,14 +16,39 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from redis import Redis
-from redis.exceptions import ConnectionError
+import asyncio
+import json
+from functools import partial
+from secrets import token_hex
+from time import monotonic, sleep
 
+from .metrics import metrics
+from .results import RESULTS_KEY
+from .utils import run_blocking
 
 REDIS_DEFAULT_HOST = "localhost:6379:0"
 
+# everything belonging to a single crawl – the cache-* keys are left alone, so they stay warm between runs
+CRAWL_STATE_KEYS = ["locked", "feeding"]
+CRAWL_STATE_PATTERNS = ["rq:*", "crawler-config*", "sourceips-*", "limit-*", "lock-*"]
+
+# seconds, how often workers waiting for another one's result look into the cache
+CACHE_LOCK_INTERVAL = 0.1
+
+# KEYS: lock
+# ARGV: token
+UNLOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
 
 def get_redis_host(argv, index):
+    # imported here, so the single-process crawler doesn't need it
+    from redis import Redis
+    from redis.exceptions import ConnectionError
     default = REDIS_DEFAULT_HOST.split(":")
 
     try:
@@ -57,3 +82,117 @@ def get_redis_host(argv, index):
     except (ConnectionError, ConnectionAbortedError, ConnectionRefusedError, ConnectionResetError):
         raise Exception(f"Can't connect to Redis DB #{redis_db} at {redis_host}:{redis_port}.")
     return (redis_host, redis_port, redis_db)
+
+
+def clear_crawl_state(redis, keep_results=False):
+    pipe = redis.pipeline(transaction=False)
+    keys = CRAWL_STATE_KEYS if keep_results else CRAWL_STATE_KEYS + [RESULTS_KEY]
+    pipe.delete(*keys)
+    for pattern in CRAWL_STATE_PATTERNS:
+        for key in redis.scan_iter(match=pattern, count=1000):
+            pipe.delete(key)
+    pipe.execute()
+
+
+def read_cached(redis, key, cache_timeout):
+    if redis is None:
+        return None
+    cached = redis.get(key)
+    if cached is None:
+        return None
+    redis.expire(key, cache_timeout)
+    return json.loads(cached.decode("utf-8"))
+
+
+def get_cached(redis, key, cache_timeout, cache):
+    """Returns the cached value (and refreshes its TTL), or None if it's not cached."""
+    if redis is None:
+        return None
+    cached = read_cached(redis, key, cache_timeout)
+    metrics.inc("dns_crawler_cache_requests_total", cache=cache, result="miss" if cached is None else "hit")
+    return cached
+
+
+def set_cached(redis, key, value, cache_timeout):
+    if redis is not None:
+        redis.set(key, json.dumps(value), ex=cache_timeout)
+
+
+def lock_cached(redis, key, lock_timeout):
+    """Returns the token of the lock for computing a cached value, or None if another worker holds it already."""
+    token = token_hex(8)
+    if redis.set(f"lock-{key}", token, nx=True, px=int(float(lock_timeout) * 1000)):
+        return token
+    return None
+
+
+def unlock_cached(redis, key, token):
+    # only our own lock, it might have expired and been taken by someone else
+    if redis is not None and token is not None:
+        redis.eval(UNLOCK_SCRIPT, 1, f"lock-{key}", token)
+
+
+def release_cached(redis, locks):
+    for key, token in locks.items():
+        unlock_cached(redis, key, token)
+
+
+def claim_cached(redis, keys, cache_timeout, cache, lock_timeout=None, force=False, waiting=None):
+    """One round of cluster-wide single-flight cache lookups.
+
+    Returns ({key: cached value}, {key: lock token} for the values this worker has to compute, [keys being computed
+    by other workers right now]). The computed values are then `set_cached` and the locks released with
+    `release_cached`. With `force` (waited long enough), or without `lock_timeout`, no locks are taken and all
+    the missing values are to be computed. Keys seen busy for the first time are added to the `waiting` set.
+    """
+    values = {}
+    locks = {}
+    busy = []
+    for key in keys:
+        value = read_cached(redis, key, cache_timeout)
+        if value is not None:
+            values[key] = value
+            metrics.inc("dns_crawler_cache_requests_total", cache=cache, result="hit")
+            continue
+        token = None
+        if redis is not None and lock_timeout and not force:
+            token = lock_cached(redis, key, lock_timeout)
+            if token is None:
+                busy.append(key)
+                if waiting is not None and key not in waiting:
+                    waiting.add(key)
+                    metrics.inc("dns_crawler_cache_waits_total", cache=cache)
+                continue
+        locks[key] = token
+        metrics.inc("dns_crawler_cache_requests_total", cache=cache, result="miss")
+    return (values, locks, busy)
+
+
+def get_cached_locked(redis, key, cache_timeout, cache, lock_timeout=None):
+    """Single-flight `get_cached` – returns (cached value, None), or (None, lock token) when the value is missing.
+
+    Only one worker at a time gets the lock, it computes the value, `set_cached`s it, and calls `unlock_cached`.
+    The others wait for its result, for `lock_timeout` at most – then they compute the value as well (with a None
+    token).
+    """
+    deadline = monotonic() + (lock_timeout or 0)
+    waiting = set()
+    while True:
+        values, locks, busy = claim_cached(redis, [key], cache_timeout, cache, lock_timeout,
+                                           monotonic() >= deadline, waiting)
+        if len(busy) == 0:
+            return (values.get(key), locks.get(key))
+        sleep(CACHE_LOCK_INTERVAL)
+
+
+async def get_cached_locked_async(redis, key, cache_timeout, cache, lock_timeout=None):
+    """Same as `get_cached_locked`, the Redis calls and the waiting don't block the event loop."""
+    deadline = monotonic() + (lock_timeout or 0)
+    waiting = set()
+    while True:
+        claim = partial(claim_cached, redis, [key], cache_timeout, cache, lock_timeout, monotonic() >= deadline,
+                        waiting)
+        values, locks, busy = claim() if redis is None else await run_blocking(claim)
+        if len(busy) == 0:
+            return (values.get(key), locks.get(key))
+        await asyncio.sleep(CACHE_LOCK_INTERVAL)
@@ -0,0 +1,164 @@
+# Copyright © 2019-2021 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import zlib
+
+RESULTS_KEY = "results"
+
+COMPRESSION_LEVEL = 6
+CHUNK_SIZE = 1024 * 1024
+
+FLAG_COMPRESSED = 1
+FLAG_MORE = 2
+FLAG_FAILED = 4
+FLAG_LINE = 8
+
+# Preset zlib dictionary with fragments that repeat in (almost) every result, so even short results compress well.
+# Both the workers and the controller need the very same dictionary – don't change it during a crawl.
+# Most common fragments go last, zlib prefers them that way.
+RESULT_DICTIONARY = "".join([
+    '"x-content-type-options":"nosniff","x-frame-options":"SAMEORIGIN","x-xss-protection":"1; mode=block",',
+    '"content-security-policy":"","referrer-policy":"","content-language":"","transfer-encoding":"chunked",',
+    '"set-cookie":[{"domain":"","name":"","value":"","secure":false,"expires":null,"HttpOnly":null}],',
+    '"alt-svc":{},"content-length":{"raw":"","value":0},"content-encoding":"gzip","vary":"Accept-Encoding",',
+    '"strict-transport-security":{"raw":"max-age=31536000","includeSubdomains":false,"preload":false,',
+    '"max-age":31536000},"server":"nginx","date":"","location":"","content-type":"text/html; charset=utf-8",',
+    '"tls":{"version":"TLSv1.3","cipher_bits":256,"cipher_name":"TLS_AES_256_GCM_SHA384"},',
+    '"cert":[{"subject":{"CN":""},"issuer":{"C":"US","O":"Let\'s Encrypt","CN":"R3"},"version":3,',
+    '"serial":"","not_before":"","not_after":"","validity_period":90,"expired":false,"algorithm":"sha256",',
+    '"fingerprint":{"sha256":"","sha512":""},"pubkey":{"size":2048,"algorithm":"rsa"},"alt_names":[""]}],',
+    '"content":null,"detected_encoding":"utf-8","content_is_binary":true,',
+    '"TXT_SPF":[{"pass":[],"neutral":[],"softfail":[],"fail":[],"include":[],"redirect":null,"exp":null,',
+    '"all":"softfail","ip4":[],"ip6":[]}],"TXT_DMARC":[{"v":{"value":"DMARC1","explicit":true},',
+    '"p":{"value":"none","explicit":true},"sp":{"value":"none","explicit":false},"adkim":{"value":"r",',
+    '"explicit":false},"aspf":{"value":"r","explicit":false},"pct":{"value":100,"explicit":false},',
+    '"fo":{"value":["0"],"explicit":false},"rf":{"value":["afrf"],"explicit":false},"ri":{"value":86400,',
+    '"explicit":false},"rua":{"value":[{"scheme":"mailto","address":"","size_limit":null}],"explicit":true}}],',
+    '"TXT_openid":null,"DS":null,"DNSKEY":null,"DNSSEC":{"valid":null,"message":"No records"},',
+    '"WEB_TLSA":null,"WEB_TLSA_www":null,"TXT":[{"value":"\\"v=spf1 ',
+    '"MAIL":[{"host":"","TLSA":{"25":null,"465":null,"587":null},"banners":[{"ip":"","banners":{',
+    '"25":{"banner":"220 ESMTP"},"465":{"error":"timed out"},"587":{"error":"[Errno 111] Connection refused"}}',
+    '"DNS_AUTH":[{"ns":"","ipv4":[{"ip":"","geoip":{"country":"CZ","org":"","asn":0},',
+    '"hostnamebind":{"value":null,"error":"The DNS operation timed out."},"versionbind":{"value":null,',
+    '"error":"The DNS response does not contain an answer to the question"}}],"ipv6":[{"ip":"",',
+    '"HSTS":false,"WEB":{"WEB4_80":[{"ip":"","redirect_count":0,"steps":[{"url":"http://","status":301,',
+    '"is_redirect":true,"headers":{',
+    '{"domain":"","timestamp":"","results":{"DNS_LOCAL":{"NS_AUTH":[{"value":""}],"MAIL":[{"value":"10 "}],',
+    '"WEB4":[{"value":"","geoip":{"country":"CZ","org":"","asn":0}}],"WEB4_www":[{"value":"","geoip":{',
+    '"WEB6":[{"value":"","geoip":{"country":"CZ","org":"","asn":0}}],"WEB6_www":[{"value":"","geoip":{',
+    '"WEB4_80_www":[{"ip":"","redirect_count":0,"steps":[{"url":"http://www.","status":301,',
+    '"WEB4_443":[{"ip":"","redirect_count":0,"steps":[{"url":"https://","status":200,',
+    '"WEB4_443_www":[{"ip":"","redirect_count":0,"steps":[{"url":"https://www.","status":200,',
+    '{"value":null,"cname":""},{"value":"","from_cname":""},{"ip":"","error":"timeout"},',
+]).encode("utf-8")
+
+
+def compress_result(result):
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=RESULT_DICTIONARY)
+    return compressor.compress(result.encode("utf-8")) + compressor.flush()
+
+
+def decompress_result(data):
+    decompressor = zlib.decompressobj(zdict=RESULT_DICTIONARY)
+    return (decompressor.decompress(data) + decompressor.flush()).decode("utf-8")
+
+
+def encode_result(result, line=None):
+    """Splits the compressed result into frames, the last one is tagged with the input line number (if any)."""
+    data = compress_result(result)
+    chunks = [data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+    frames = []
+    for index, chunk in enumerate(chunks):
+        flags = FLAG_COMPRESSED
+        tag = b""
+        if index < len(chunks) - 1:
+            flags = flags | FLAG_MORE
+        elif line is not None:
+            flags = flags | FLAG_LINE
+            tag = line.to_bytes(8, "big")
+        frames.append(bytes([flags]) + tag + chunk)
+    return frames
+
+
+def push_result(redis, result, line=None):
+    # a single RPUSH is atomic, so chunks of one result are never interleaved with other workers' results
+    redis.rpush(RESULTS_KEY, *encode_result(result, line))
+
+
+def push_failure(redis, domain, error, line=None):
+    failure = json.dumps({"domain": domain, "error": error, "line": line}).encode("utf-8")
+    redis.rpush(RESULTS_KEY, bytes([FLAG_FAILED]) + failure)
+
+
+def read_results(redis, count, timeout=None):
+    """Pops up to `count` frames, waiting up to `timeout` seconds for the first one.
+
+    Without a timeout (None or 0), only the frames already in the list are read – BLPOP with a zero timeout would
+    block until some worker pushes a result, which might never happen (eg. when all the remaining jobs failed).
+    """
+    frames = []
+    if timeout:
+        first = redis.blpop(RESULTS_KEY, timeout=timeout)
+        if first is None:
+            return []
+        frames.append(first[1])
+        count = count - 1
+    pipe = redis.pipeline()
+    pipe.lrange(RESULTS_KEY, 0, count - 1)
+    pipe.ltrim(RESULTS_KEY, count, -1)
+    rest, _ = pipe.execute()
+    return frames + rest
+
+
+class ResultDecoder:
+    """Puts chunked results back together, chunks of one result can be split between multiple reads."""
+
+    def __init__(self):
+        self.pending = []
+
+    def decode(self, frames):
+        """Returns a tuple of (results, lines, failures).
+
+        `lines` are input line numbers of the results (or None), failures are dicts with the domain,
+        error message, and line number.
+        """
+        results = []
+        lines = []
+        failures = []
+        for frame in frames:
+            flags = frame[0]
+            if flags & FLAG_FAILED:
+                failures.append(json.loads(frame[1:].decode("utf-8")))
+                continue
+            if flags & FLAG_LINE:
+                lines.append(int.from_bytes(frame[1:9], "big"))
+                self.pending.append(frame[9:])
+            else:
+                self.pending.append(frame[1:])
+            if flags & FLAG_MORE:
+                continue
+            if not flags & FLAG_LINE:
+                lines.append(None)
+            data = b"".join(self.pending)
+            self.pending = []
+            if flags & FLAG_COMPRESSED:
+                results.append(decompress_result(data))
+            else:
+                results.append(data.decode("utf-8"))
+        return (results, lines, failures)
@@ -19,24 +19,35 @@
 import sys
 from os.path import basename
 
-from .crawl import get_json_result
+from .config_loader import default_config_filename, load_config
+from .crawl import Crawler
+from .imports import get_import_report
+from .input_utils import InputNormalizer
+from .output import OutputError, create_writer
 from .timestamp import timestamp
+from .utils import pop_option
 
 
 def print_help():
     exe = basename(sys.argv[0])
     sys.stderr.write(
         f"{exe} - a single-threaded crawler to process a small number of domains without a need for Redis\n\n")
-    sys.stderr.write(f"Usage: {exe} <file>\n")
+    sys.stderr.write(f"Usage: {exe} [-o output] [--import-report] <file>\n")
+    sys.stderr.write("       output - file to save the results to, stdout by default (see `output` in config.yml)\n")
+    sys.stderr.write("       --import-report - print which optional modules were loaded and how long it took\n")
     sys.stderr.write("       file - plaintext domain list, one domain per line, empty lines are ignored\n")
     sys.exit(1)
 
 
 def main():
+    output_filename = pop_option(sys.argv, ("-o", "--output"))
+    import_report = "--import-report" in sys.argv
+    sys.argv = [arg for arg in sys.argv if arg != "--import-report"]
     if "-h" in sys.argv or "--help" in sys.argv or len(sys.argv) < 2:
         print_help()
 
     filename = sys.argv[1]
+    writer = None
 
     try:
         try:
@@ -44,13 +55,43 @@ def main():
         except FileNotFoundError:
             sys.stderr.write(f"File '{filename}' does not exist.\n\n")
             print_help()
+        config = load_config(default_config_filename)
+        try:
+            writer = create_writer(config, output_filename)
+        except (OutputError, OSError) as e:
+            sys.stderr.write(f"{timestamp()} Can't open the output: {e}\n")
+            sys.exit(1)
         sys.stderr.write(f"{timestamp()} Reading domains from {filename}.\n")
-        domains = [line for line in file.read().splitlines() if line.strip()]
+        crawler = Crawler(config)
+        normalizer = InputNormalizer(config)
+        domains = [domain for domain in map(normalizer.normalize, file) if domain is not None]
         domain_count = len(domains)
-        sys.stderr.write(f"{timestamp()} Read {domain_count} domain{('s' if domain_count > 1 else '')}.\n")
-        for num, domain in enumerate(domains, start=1):
-            print(get_json_result(domain), flush=True)
-            sys.stderr.write(f"{timestamp()} {num}/{domain_count}\n")
+        sys.stderr.write(f"{timestamp()} Read {domain_count} domain{('s' if domain_count > 1 else '')}. "
+                         f"{normalizer.report()}\n")
+        if config["async"]["enabled"]:
+            finished = []
+
+            def write_result(index, domain, result, error):
+                if error is not None:
+                    sys.stderr.write(f"{timestamp()} {domain} failed: {error}\n")
+                else:
+                    writer.write([result])
+                    writer.flush()
+                finished.append(index)
+                sys.stderr.write(f"{timestamp()} {len(finished)}/{domain_count}\n")
+
+            from .async_crawl import AsyncCrawler
+            AsyncCrawler(crawler).run(domains, write_result)
+        else:
+            for num, domain in enumerate(domains, start=1):
+                writer.write([crawler.crawl_json(domain)])
+                writer.flush()
+                sys.stderr.write(f"{timestamp()} {num}/{domain_count}\n")
+        writer.close()
         sys.stderr.write(f"{timestamp()} Finished.\n")
+        if import_report:
+            sys.stderr.write(f"{timestamp()} {get_import_report()}\n")
     except KeyboardInterrupt:
+        if writer is not None:
+            writer.close()
         sys.exit(0)
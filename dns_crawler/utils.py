@@ -16,6 +16,110 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import atexit
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# the private event loop of each thread (see run_async)
+private_loops = threading.local()
+
+# threads for short blocking calls made by coroutines (Redis), see run_blocking
+BLOCKING_THREADS = 8
+blocking_executor = None
+blocking_executor_pid = None
+
 
 def drop_null_values(orig_dict):
     return {k: v for k, v in orig_dict.items() if v is not None}
+
+
+def pop_option(argv, names):
+    for index, arg in enumerate(argv):
+        if arg in names:
+            del argv[index]
+            try:
+                return argv.pop(index)
+            except IndexError:
+                return None
+    return None
+
+
+def get_private_loop():
+    loop = getattr(private_loops, "loop", None)
+    # a loop inherited from the parent process can't be used after a fork
+    if loop is None or loop.is_closed() or private_loops.pid != os.getpid():
+        loop = asyncio.new_event_loop()
+        private_loops.loop = loop
+        private_loops.pid = os.getpid()
+    return loop
+
+
+def run_async(coroutine):
+    """Runs the coroutine in the thread's private event loop – for sync code which wants to do a few things at once.
+
+    The loop is kept for the next call, so sockets opened in it (see dns_transport) can be reused.
+    """
+    loop = get_private_loop()
+    task = loop.create_task(coroutine)
+    try:
+        return loop.run_until_complete(task)
+    except BaseException:
+        # eg. a timeout signal, don't leave the coroutine behind for the next call
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except BaseException:
+            pass
+        raise
+
+
+def get_blocking_executor():
+    global blocking_executor, blocking_executor_pid
+    # threads aren't inherited by forked processes
+    if blocking_executor is None or blocking_executor_pid != os.getpid():
+        blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_THREADS, thread_name_prefix="blocking")
+        blocking_executor_pid = os.getpid()
+    return blocking_executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a short blocking call (eg. to Redis) in a thread, so the event loop can go on with other coroutines.
+
+    These have their own threads – in the loop's default executor, they might wait for slow HTTP(S) checks.
+    """
+    return await asyncio.get_event_loop().run_in_executor(get_blocking_executor(), partial(func, *args, **kwargs))
+
+
+def shutdown_loop(loop):
+    """Cancels the tasks left in the loop (eg. connections waiting for data) and closes it."""
+    all_tasks = getattr(asyncio, "all_tasks", None) or asyncio.Task.all_tasks
+    tasks = all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    if len(tasks) > 0:
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+
+
+@atexit.register
+def close_private_loop():
+    loop = getattr(private_loops, "loop", None)
+    if loop is not None and not loop.is_closed() and private_loops.pid == os.getpid():
+        shutdown_loop(loop)
+
+
+async def gather_until(deadline, coroutines, default=None):
+    """Like asyncio.gather, but gives up on coroutines which aren't finished in `deadline` seconds (None for no limit).
+
+    Results of those are replaced by `default`.
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    if len(tasks) == 0:
+        return []
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    for task in pending:
+        task.cancel()
+    return [task.result() if task in done else default for task in tasks]
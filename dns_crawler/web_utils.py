@@ -18,11 +18,13 @@
 
 import base64
 import re
+import socket
+import threading
 from itertools import takewhile
+from time import monotonic
 from urllib.parse import unquote, urljoin, urlparse
 
 import cert_human
-import icu
 import idna
 import requests
 import urllib3
@@ -30,7 +32,9 @@ from forcediphttpsadapter.adapters import ForcedIPHTTPSAdapter
 from requests_toolbelt.adapters.source import SourceAddressAdapter
 
 from .certificate import parse_cert
+from .imports import lazy_import
 from .ip_utils import is_valid_ipv6_address
+from .politeness import limited_map, limited_map_async
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 cert_human.enable_urllib3_patch()
@@ -132,7 +136,7 @@ def autodetect_encoding(data, content_type=None, forced_encoding=None):
         encoding = forced_encoding
     else:
         try:
-            encoding = icu.CharsetDetector(data).detect().getName()
+            encoding = lazy_import("icu").CharsetDetector(data).detect().getName()
         except AttributeError:
             encoding = "utf-8"
     try:
@@ -152,189 +156,276 @@ def autodetect_encoding(data, content_type=None, forced_encoding=None):
     return (data, encoding)
 
 
-def get_webserver_info(domain, ips, config, source_ip, path="/", ipv6=False, tls=False):
-    if not ips or len(ips) < 1:
-        return None
-    http_timeout = (config["timeouts"]["http"], config["timeouts"]["http_read"])
+def get_http_timeout(config, deadline=None):
+    """(connect, read) timeouts of a request, cut down to the time left until `deadline` (a `monotonic()` value)."""
+    connect, read = config["timeouts"]["http"], config["timeouts"]["http_read"]
+    if deadline is None:
+        return connect, read
+    left = deadline - monotonic()
+    if left <= 0:
+        raise requests.exceptions.ReadTimeout("Web checks ran out of time")
+    return min(connect, left), min(read, left)
+
+
+def abort_response(response):
+    """Shuts down the response's socket, so reading it (in another thread) stops right away."""
+    sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+    # pyOpenSSL wraps the socket, shutting the TLS connection down wouldn't wake the reader up
+    sock = getattr(sock, "socket", sock)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def read_content(response, deadline=None, size=None):
+    """The response's body (only its first chunk of `size` bytes, if set).
+
+    The read timeout is for a single read, a server sending the body byte by byte could keep the thread busy much
+    longer – reading is aborted when `deadline` (a `monotonic()` value) passes, and ReadTimeout is raised.
+    """
+    def read():
+        if size is None:
+            return response.content
+        return next(response.iter_content(size), b"")
+
+    if deadline is None:
+        return read()
+    timer = threading.Timer(deadline - monotonic(), abort_response, (response,))
+    timer.daemon = True
+    timer.start()
+    try:
+        content = read()
+    except requests.exceptions.RequestException:
+        if monotonic() < deadline:
+            raise
+        content = None
+    finally:
+        timer.cancel()
+    if content is None or monotonic() >= deadline:
+        raise requests.exceptions.ReadTimeout("Web checks ran out of time")
+    return content
+
+
+def get_webserver_ip_info(domain, ip, config, source_ip, path="/", ipv6=False, tls=False, deadline=None):
+    """Checks the domain's webserver at `ip`, following the redirects.
+
+    `deadline` (a `monotonic()` value) is a hard limit for the whole check – no request is started after it, and
+    timeouts of the requests (and reading the content) don't go past it, so the thread doing the check is done soon
+    after it, even if nobody waits for the result anymore.
+    """
     save_content = config["web"]["save_content"]
     save_binary = config["web"]["save_binary"]
     content_size_limit = config["web"]["content_size_limit"]
     max_redirects = config["web"]["max_redirects"]
     protocol = "https" if tls else "http"
     results = []
-    ip_index = 0
-    for entry in ips:
-        ip_index += 1
-        if config["web"]["max_ips_per_domain"] is not None and ip_index > config["web"]["max_ips_per_domain"]:
+    s1 = requests.session()
+    s2 = requests.session()
+    s1.mount("https://", CrawlerAdapter(dest_ip=ip, source_address=source_ip))
+    s2.mount("https://", SourceAddressAdapter(source_address=source_ip))
+    s2.mount("http://", SourceAddressAdapter(source_address=source_ip))
+    headers = create_request_headers(domain, config["web"]["user_agent"], config["web"]["accept_language"])
+    try:
+        if protocol == "https":
+            url = f"{protocol}://{domain}{path}"
+            r = s1.get(url, allow_redirects=False,
+                       verify=False, stream=True, timeout=get_http_timeout(config, deadline),
+                       headers=headers)
+        else:
+            if ipv6:
+                host = f"[{ip}]"
+            else:
+                host = ip
+            url = f"{protocol}://{host}{path}"
+            r = s2.get(url,
+                       allow_redirects=False, stream=True, timeout=get_http_timeout(config, deadline),
+                       headers=headers)
+    except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout,
+            ValueError, UnicodeDecodeError) as e:
+        if isinstance(e, AttributeError):
+            pass
+        else:
+            s1.close()
+            s2.close()
+            return [{
+                "ip": ip,
+                "error": emsg(e)
+            }]
+    redirect_count = 0
+    history = [{"r": r, "url": url}]
+    while "r" in history[-1] and history[-1]["r"].is_redirect:
+        url = urljoin(history[-1]["url"], history[-1]["r"].headers["location"])
+        h = {
+            "url": url
+        }
+        try:
+            h["r"] = s1.get(url, verify=False, allow_redirects=False, stream=True,
+                            timeout=get_http_timeout(config, deadline),
+                            headers=create_request_headers(urlparse(url).hostname, config["web"]["user_agent"],
+                                                           config["web"]["accept_language"]))
+        except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout,
+                requests.exceptions.InvalidURL, requests.exceptions.InvalidSchema, UnicodeError) as e:
+            h["e"] = emsg(e)
+        except requests.exceptions.InvalidHeader as e:
+            h["e"] = f"Invalid Location header: '{url}' - {emsg(e)}"
+        except urllib3.exceptions.LocationParseError as e:
+            h["e"] = emsg(e)
+        history.append(h)
+        redirect_count = redirect_count + 1
+        if redirect_count >= max_redirects:
             break
-        ip = entry["value"]
-        if ip is None:
+
+    steps = []
+    for (i, h) in enumerate(history):
+        if i == 0:
+            url = f"{protocol}://{domain}{path}"
+        else:
+            url = h["url"]
+        if "e" in h:
+            steps.append({
+                "url": url,
+                "error": h["e"]
+            })
             continue
-        s1 = requests.session()
-        s2 = requests.session()
-        s1.mount("https://", CrawlerAdapter(dest_ip=ip, source_address=source_ip))
-        s2.mount("https://", SourceAddressAdapter(source_address=source_ip))
-        s2.mount("http://", SourceAddressAdapter(source_address=source_ip))
-        headers = create_request_headers(domain, config["web"]["user_agent"], config["web"]["accept_language"])
-        try:
-            if protocol == "https":
-                url = f"{protocol}://{domain}{path}"
-                r = s1.get(url, allow_redirects=False,
-                           verify=False, stream=True, timeout=http_timeout, headers=headers)
+        step_tls = "r" in h and h["r"].url.startswith("https")
+        step = {}
+        if "r" in h:
+            step["url"] = h["r"].url
+            step["status"] = h["r"].status_code
+            step["is_redirect"] = h["r"].is_redirect
+        cookies = []
+        for cookie in h["r"].cookies:
+            cookies.append({
+                "domain": cookie.domain,
+                "name": cookie.name,
+                "value": cookie.value,
+                "secure": cookie.secure,
+                "expires": cookie.expires,
+                **cookie.__dict__["_rest"]
+            })
+        headers = {}
+        for k, v in h["r"].headers.items():
+            key = k.lower()
+            if key == "set-cookie":
+                headers[key] = cookies
+            elif key in header_parsers:
+                headers[key] = header_parsers[key](v)
             else:
-                if ipv6:
-                    host = f"[{ip}]"
-                else:
-                    host = ip
-                url = f"{protocol}://{host}{path}"
-                r = s2.get(url,
-                           allow_redirects=False, stream=True, timeout=http_timeout, headers=headers)
-        except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout,
-                ValueError, UnicodeDecodeError) as e:
-            if isinstance(e, AttributeError):
-                pass
+                headers[key] = v
+        step["headers"] = headers
+        if i == 0:
+            step["ip"] = ip
+        step["url"] = step["url"].replace(f"//{ip}/", f"//{domain}/").replace(f"//[{ip}]/", f"//{domain}/")
+        if step_tls:
+            if h["r"].raw._fp.fp:
+                if hasattr(h["r"].raw._fp.fp.raw._sock, "connection"):
+                    step["tls"] = {
+                        "version": h["r"].raw._fp.fp.raw._sock.connection.get_protocol_version_name(),
+                        "cipher_bits": h["r"].raw._fp.fp.raw._sock.connection.get_cipher_bits(),
+                        "cipher_name": h["r"].raw._fp.fp.raw._sock.connection.get_cipher_name()
+                    }
+            if config["web"]["save_cert_chain"]:
+                if h["r"].raw.peer_cert_chain:
+                    cert_chain = []
+                    for cert in h["r"].raw.peer_cert_chain:
+                        cert_chain.append(parse_cert(cert.to_cryptography()))
+                    step["cert"] = cert_chain
             else:
-                results.append({
-                    "ip": ip,
-                    "error": emsg(e)
-                })
-                continue
-        redirect_count = 0
-        history = [{"r": r, "url": url}]
-        while "r" in history[-1] and history[-1]["r"].is_redirect:
-            url = urljoin(history[-1]["url"], history[-1]["r"].headers["location"])
-            h = {
-                "url": url
-            }
+                if h["r"].raw.peer_cert:
+                    step["cert"] = [parse_cert(h["r"].raw.peer_cert.to_cryptography())]
+        if save_content:
+            detected_encoding = None
+            content = None
+            content_is_binary = headers_look_like_binary(step["headers"])
+
             try:
-                h["r"] = s1.get(url, verify=False, allow_redirects=False, stream=True, timeout=http_timeout,
-                                headers=create_request_headers(urlparse(url).hostname, config["web"]["user_agent"],
-                                                               config["web"]["accept_language"]))
-            except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout,
-                    requests.exceptions.InvalidURL, requests.exceptions.InvalidSchema, UnicodeError) as e:
-                h["e"] = emsg(e)
-            except requests.exceptions.InvalidHeader as e:
-                h["e"] = f"Invalid Location header: '{url}' - {emsg(e)}"
-            except urllib3.exceptions.LocationParseError as e:
-                h["e"] = emsg(e)
-            history.append(h)
-            redirect_count = redirect_count + 1
-            if redirect_count >= max_redirects:
-                break
-
-        steps = []
-        for (i, h) in enumerate(history):
-            if i == 0:
-                url = f"{protocol}://{domain}{path}"
-            else:
-                url = h["url"]
-            if "e" in h:
-                steps.append({
-                    "url": url,
-                    "error": h["e"]
-                })
-                continue
-            step_tls = "r" in h and h["r"].url.startswith("https")
-            step = {}
-            if "r" in h:
-                step["url"] = h["r"].url
-                step["status"] = h["r"].status_code
-                step["is_redirect"] = h["r"].is_redirect
-            cookies = []
-            for cookie in h["r"].cookies:
-                cookies.append({
-                    "domain": cookie.domain,
-                    "name": cookie.name,
-                    "value": cookie.value,
-                    "secure": cookie.secure,
-                    "expires": cookie.expires,
-                    **cookie.__dict__["_rest"]
-                })
-            headers = {}
-            for k, v in h["r"].headers.items():
-                key = k.lower()
-                if key == "set-cookie":
-                    headers[key] = cookies
-                elif key in header_parsers:
-                    headers[key] = header_parsers[key](v)
-                else:
-                    headers[key] = v
-            step["headers"] = headers
-            if i == 0:
-                step["ip"] = ip
-            step["url"] = step["url"].replace(f"//{ip}/", f"//{domain}/").replace(f"//[{ip}]/", f"//{domain}/")
-            if step_tls:
-                if h["r"].raw._fp.fp:
-                    if hasattr(h["r"].raw._fp.fp.raw._sock, "connection"):
-                        step["tls"] = {
-                            "version": h["r"].raw._fp.fp.raw._sock.connection.get_protocol_version_name(),
-                            "cipher_bits": h["r"].raw._fp.fp.raw._sock.connection.get_cipher_bits(),
-                            "cipher_name": h["r"].raw._fp.fp.raw._sock.connection.get_cipher_name()
-                        }
-                if config["web"]["save_cert_chain"]:
-                    if h["r"].raw.peer_cert_chain:
-                        cert_chain = []
-                        for cert in h["r"].raw.peer_cert_chain:
-                            cert_chain.append(parse_cert(cert.to_cryptography()))
-                        step["cert"] = cert_chain
+                if content_is_binary:
+                    if save_binary:
+                        chunk = read_content(h["r"], deadline, content_size_limit)
+                        if chunk:
+                            content = f"data:{step['headers']['content-type']};base64,"\
+                                    f"{base64.b64encode(chunk).decode()}"
                 else:
-                    if h["r"].raw.peer_cert:
-                        step["cert"] = [parse_cert(h["r"].raw.peer_cert.to_cryptography())]
-            if save_content:
-                detected_encoding = None
+                    try:
+                        content, detected_encoding = autodetect_encoding(read_content(h["r"], deadline))
+                    except (requests.exceptions.ChunkedEncodingError,
+                            requests.exceptions.ContentDecodingError) as e:
+                        results.append({
+                            "ip": ip,
+                            "error": emsg(e)
+                        })
+                        continue
+            except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout):
                 content = None
-                content_is_binary = headers_look_like_binary(step["headers"])
-
-                try:
-                    if content_is_binary:
-                        if save_binary:
-                            for chunk in h["r"].iter_content(content_size_limit):
-                                content = f"data:{step['headers']['content-type']};base64,"\
-                                        f"{base64.b64encode(chunk).decode()}"
-                                break
-                    else:
-                        try:
-                            content, detected_encoding = autodetect_encoding(h["r"].content)
-                        except (requests.exceptions.ChunkedEncodingError,
-                                requests.exceptions.ContentDecodingError) as e:
-                            results.append({
-                                "ip": ip,
-                                "error": emsg(e)
-                            })
-                            continue
-                except requests.exceptions.ConnectionError:
-                    content = None
-                if content == "":
-                    content = None
-                if content is None:
-                    detected_encoding = None
-                if content and not content_is_binary:
-                    if len(content) > content_size_limit:
-                        content = content[:content_size_limit]
-                step["content"] = content
-                if content_is_binary:
-                    step["content_is_binary"] = True
-                if detected_encoding is not None:
-                    step["detected_encoding"] = detected_encoding.lower()
-            h["r"].close()
-            steps.append(step)
-
-        result = {
-            "ip": ip,
-            "redirect_count": redirect_count
-        }
+            if content == "":
+                content = None
+            if content is None:
+                detected_encoding = None
+            if content and not content_is_binary:
+                if len(content) > content_size_limit:
+                    content = content[:content_size_limit]
+            step["content"] = content
+            if content_is_binary:
+                step["content_is_binary"] = True
+            if detected_encoding is not None:
+                step["detected_encoding"] = detected_encoding.lower()
+        h["r"].close()
+        steps.append(step)
+
+    result = {
+        "ip": ip,
+        "redirect_count": redirect_count
+    }
 
-        if config["web"]["save_intermediate_steps"]:
-            result["steps"] = steps
+    if config["web"]["save_intermediate_steps"]:
+        result["steps"] = steps
+    else:
+        if len(steps) > 0:
+            result["final_step"] = steps[-1]
         else:
-            if len(steps) > 0:
-                result["final_step"] = steps[-1]
-            else:
-                result["final_step"] = None
-        results.append(result)
+            result["final_step"] = None
+    results.append(result)
+
+    s1.close()
+    s2.close()
+    return results
+
 
-        s1.close()
-        s2.close()
+def get_webserver_ips(ips, config):
+    max_ips = config["web"]["max_ips_per_domain"]
+    if max_ips is not None:
+        ips = ips[:int(max_ips)]
+    return [entry["value"] for entry in ips if entry["value"] is not None]
+
+
+def join_webserver_results(ip_results):
+    results = [result for results in ip_results for result in results]
     if len(results) == 0:
         return None
     return results
+
+
+def get_webserver_info(domain, ips, config, source_ip, path="/", ipv6=False, tls=False, limiter=None):
+    if not ips or len(ips) < 1:
+        return None
+    ips = get_webserver_ips(ips, config)
+    return join_webserver_results(limited_map(limiter, ips,
+                                              lambda ip: get_webserver_ip_info(domain, ip, config, source_ip,
+                                                                               path=path, ipv6=ipv6, tls=tls),
+                                              lambda ip: [{"ip": ip, "error": "rate limited"}]))
+
+
+async def get_webserver_info_async(domain, ips, config, source_ip, probe, path="/", ipv6=False, tls=False,
+                                   limiter=None):
+    """Same as `get_webserver_info`, but all the IPs are tried at once.
+
+    `probe(domain, ip, source_ip, path, ipv6, tls)` is a coroutine which calls `get_webserver_ip_info` (in a thread).
+    """
+    if not ips or len(ips) < 1:
+        return None
+    ips = get_webserver_ips(ips, config)
+    return join_webserver_results(await limited_map_async(limiter, ips,
+                                                          lambda ip: probe(domain, ip, source_ip, path, ipv6, tls),
+                                                          lambda ip: [{"ip": ip, "error": "rate limited"}]))
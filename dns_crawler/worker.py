@@ -19,14 +19,22 @@
 import logging
 import sys
 from os.path import basename
+from time import sleep
 
 from redis import Redis
-from rq import Connection, Worker
+from rq import Connection, SimpleWorker
+from rq.job import Job
+from rq.registry import StartedJobRegistry
+from rq.utils import current_timestamp
 
-from .crawl import process_domain, get_json_result  # noqa F401
+from .crawl import get_crawler, process_domain, get_json_result, push_json_result, push_json_results  # noqa F401
+from .imports import import_subsystems
+from .results import push_failure
 
 logger = logging.getLogger("rq.worker")
 
+FEEDING_POLL_INTERVAL = 1
+
 
 def print_help():
     exe = basename(sys.argv[0])
@@ -36,10 +44,85 @@ def print_help():
     sys.exit(1)
 
 
-class CrawlerWorker(Worker):
+def push_job_failure(redis, job, error):
+    """Lets the controller know about every domain of the job that didn't make it, so it doesn't wait for them."""
+    if job.func_name.endswith("push_json_results"):
+        # domains of a batch can be finished in any order (see AsyncCrawler)
+        done = {int(field[5:]) for field in redis.hkeys(job.key) if field.startswith(b"done-")}
+        lines = job.args[1] if len(job.args) > 1 and job.args[1] is not None else [None] * len(job.args[0])
+        domains = [domain for index, domain in enumerate(job.args[0]) if index not in done]
+        lines = [line for index, line in enumerate(lines) if index not in done]
+    else:
+        domains = job.args[:1]
+        lines = job.args[1:2] or [None]
+    pipe = redis.pipeline(transaction=False)
+    for domain, line in zip(domains, lines):
+        push_failure(pipe, domain, error, line)
+    pipe.execute()
+
+
+def fail_orphaned_jobs(redis, queue):
+    """Reports the jobs of workers which died in the middle of them (eg. killed for running out of memory) as failed.
+
+    Their time in StartedJobRegistry (the job timeout + a minute) runs out, and RQ's cleanup moves them
+    to FailedJobRegistry – but nobody tells the controller. Returns the number of such jobs.
+    """
+    registry = StartedJobRegistry(queue=queue)
+    now = current_timestamp()
+    job_ids = registry.get_expired_job_ids(now)
+    if len(job_ids) == 0:
+        return 0
+    for job in Job.fetch_many(job_ids, connection=redis):
+        if job is not None:
+            push_job_failure(redis, job, "the worker died while crawling the domain")
+    registry.cleanup(now)
+    return len(job_ids)
+
+
+class CrawlerWorker(SimpleWorker):
+    """Runs the jobs in its own process instead of forking a work horse for each one – the crawler's caches
+    (DNS records, DNSSEC keys), open sockets, and resolver stats stay around for the next jobs. If a job takes
+    the worker down (eg. a segfault), the worker is replaced (see WorkerPool), and the job's domains are reported
+    as failed once its time runs out (see `fail_orphaned_jobs`)."""
+
     log_result_lifespan = False
     log_job_description = False
 
+    def dequeue_job_and_maintain_ttl(self, timeout):
+        # the controller might be still reading the input and topping up the queue,
+        # so an empty queue doesn't necessarily mean there's no more work for burst workers
+        while True:
+            result = super().dequeue_job_and_maintain_ttl(timeout)
+            if result is not None or self.connection.get("feeding") != b"1":
+                return result
+            self.heartbeat()
+            sleep(FEEDING_POLL_INTERVAL)
+
+    def handle_job_failure(self, job, queue, started_job_registry=None, exc_string=""):
+        push_job_failure(self.connection, job, exc_string.strip().split("\n")[-1] if exc_string else "job failed")
+        super().handle_job_failure(job, queue, started_job_registry=started_job_registry, exc_string=exc_string)
+
+    def clean_registries(self):
+        # RQ's cleanup would move jobs of dead workers to FailedJobRegistry without reporting them
+        for queue in self.queues:
+            fail_orphaned_jobs(self.connection, queue)
+        super().clean_registries()
+
+
+def preload_crawler(redis):
+    with Connection(redis):
+        import_subsystems(get_crawler().config)
+
+
+def run_worker(redis, name):
+    with Connection(redis):
+        # config, resolver, GeoIP DBs… are set up just once (or inherited from dns-crawler-workers),
+        # and used by all the jobs, which run in this process
+        get_crawler()
+        q = ["default"]
+        w = CrawlerWorker(q, name=name)
+        w.work(burst=True)
+
 
 def main():
     if "-h" in sys.argv or "--help" in sys.argv or len(sys.argv) != 5:
@@ -49,7 +132,4 @@ def main():
     redis_port = sys.argv[2]
     redis_db = sys.argv[3]
 
-    with Connection(Redis(host=redis_host, port=redis_port, db=redis_db)):
-        q = ["default"]
-        w = CrawlerWorker(q, name=sys.argv[4])
-        w.work(burst=True)
+    run_worker(Redis(host=redis_host, port=redis_port, db=redis_db), sys.argv[4])
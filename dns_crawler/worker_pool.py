@@ -0,0 +1,142 @@
+# Copyright © 2019-2021 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import signal
+import subprocess
+import sys
+import traceback
+
+from redis import Redis
+
+from .timestamp import timestamp
+
+
+def get_returncode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class ForkedWorker:
+    """A worker forked from the current process – it gets all the imported modules and the crawler set up
+    by `WorkerPool.preload` for free (shared copy-on-write). Behaves like the parts of `subprocess.Popen`
+    which the pool uses."""
+
+    def __init__(self, redis, name, close_on_fork=()):
+        # imported here, so the subprocess-based pool doesn't need the whole crawler in the parent
+        from .worker import run_worker
+        self.returncode = None
+        self.pid = os.fork()
+        if self.pid == 0:
+            code = 1
+            try:
+                for sock in close_on_fork:
+                    sock.close()
+                run_worker(redis, name)
+                code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                # never return into the parent's code (or run its atexit handlers)
+                os._exit(code)
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid != 0:
+                self.returncode = get_returncode(status)
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            _, status = os.waitpid(self.pid, 0)
+            self.returncode = get_returncode(status)
+        return self.returncode
+
+    def terminate(self):
+        if self.returncode is None:
+            os.kill(self.pid, signal.SIGTERM)
+
+
+class WorkerPool:
+    """Worker processes started by `dns-crawler-workers`, crashed ones are replaced right away.
+
+    After `preload`, workers are forked from this process, otherwise each one is a new `dns-crawler-worker`.
+    """
+
+    def __init__(self, redis_host, hostname):
+        self.redis_host = redis_host
+        self.hostname = hostname
+        self.procs = []
+        self.stopping = []
+        self.started = 0
+        self.redis = None
+        # sockets which the workers shouldn't keep open (eg. the metrics server)
+        self.close_on_fork = []
+
+    def preload(self):
+        """Imports the crawler and sets it up (config, resolver, GeoIP DBs…), so forked workers start right away.
+
+        Returns False if the OS can't fork.
+        """
+        if not hasattr(os, "fork"):
+            return False
+        from .worker import preload_crawler
+        # a connection just for the workers, they get a new connection pool after the fork
+        self.redis = Redis(host=self.redis_host[0], port=self.redis_host[1], db=self.redis_host[2])
+        preload_crawler(self.redis)
+        return True
+
+    def spawn(self):
+        # worker names have to be unique, RQ keeps the dead ones around for a while
+        self.started = self.started + 1
+        name = f"{self.hostname}-{self.started}"
+        if self.redis is not None:
+            self.procs.append(ForkedWorker(self.redis, name, self.close_on_fork))
+        else:
+            self.procs.append(subprocess.Popen(["dns-crawler-worker",
+                                                self.redis_host[0],
+                                                str(self.redis_host[1]),
+                                                str(self.redis_host[2]),
+                                                name]))
+
+    def resize(self, count):
+        while len(self.procs) < count:
+            self.spawn()
+        while len(self.procs) > count:
+            # warm shutdown, the worker finishes its current job first
+            proc = self.procs.pop()
+            proc.terminate()
+            self.stopping.append(proc)
+
+    def check(self):
+        """Replaces crashed workers, forgets the ones which finished (or were stopped)."""
+        for proc in list(self.procs):
+            if proc.poll() is None:
+                continue
+            self.procs.remove(proc)
+            if proc.returncode != 0:
+                sys.stderr.write(f"{timestamp()} Worker crashed (exit code {proc.returncode}), starting a new one.\n")
+                self.spawn()
+        self.stopping = [proc for proc in self.stopping if proc.poll() is None]
+
+    def running(self):
+        return len(self.procs) + len(self.stopping)
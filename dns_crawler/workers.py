@@ -16,7 +16,6 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import subprocess
 import sys
 from multiprocessing import cpu_count
 from os import getcwd, path
@@ -25,36 +24,62 @@ from socket import gethostname
 from time import sleep
 
 from redis import Redis
+from rq import Queue
+from rq.registry import StartedJobRegistry
 
+from .autoscale import Autoscaler, FixedSize, supervise
 from .config_loader import default_config_filename, load_config
 from .controller import ControllerNotRunning
+from .imports import get_import_report
 from .ip_utils import get_source_addresses
+from .metrics import get_host_key, serve_metrics
 from .redis_utils import get_redis_host
 from .timestamp import timestamp
+from .utils import pop_option
+from .worker_pool import WorkerPool
 
 
 def print_help():
     exe = basename(sys.argv[0])
     sys.stderr.write(f"{exe} - a process that spawns crawler workers.\n\n")
-    sys.stderr.write(f"Usage: {exe} [count] [redis]\n")
-    sys.stderr.write("       count - worker count, 8 workers per CPU core by default\n")
+    sys.stderr.write(f"Usage: {exe} [-a] [-m metrics] [count] [redis]\n")
+    sys.stderr.write("       -a - adjust the number of workers to the load (see `autoscale` in config.yml)\n")
+    sys.stderr.write("       metrics - [host:]port to serve Prometheus metrics of the workers on this machine on\n")
+    sys.stderr.write("       count - worker count, 8 workers per CPU core by default (1 with `async.enabled`),\n")
+    sys.stderr.write("               max worker count with -a\n")
     sys.stderr.write("       redis - redis host:port:db, localhost:6379:0 by default\n\n")
     sys.stderr.write(f"Examples: {exe} 8\n")
     sys.stderr.write(f"          {exe} 24 192.168.0.22:4444:0\n")
     sys.stderr.write(f"          {exe} 16 redis.foo.bar:7777:2\n")
     sys.stderr.write(f"          {exe} 16 redis.foo.bar # port 6379 and DB 0 will be used if not specified\n")
+    sys.stderr.write(f"          {exe} -m 9101 24 192.168.0.22\n")
+    sys.stderr.write(f"          {exe} -a 192.168.0.22 # autoscaling, 1 to 24 workers per CPU core by default\n")
     sys.exit(1)
 
 
+def collect_metrics(redis, hostname, procs):
+    samples = redis.hgetall(get_host_key(hostname))
+    queue = Queue(connection=redis)
+    samples["dns_crawler_queued_jobs"] = queue.count
+    samples["dns_crawler_started_jobs"] = StartedJobRegistry(queue=queue).count
+    samples["dns_crawler_workers"] = sum(1 for p in procs if p.poll() is None)
+    return samples
+
+
 def main():
     cpus = cpu_count()
     worker_count = cpus * 8
     hostname = gethostname()
+    metrics_address = pop_option(sys.argv, ("-m", "--metrics"))
+    autoscale = "-a" in sys.argv or "--autoscale" in sys.argv
+    sys.argv = [arg for arg in sys.argv if arg not in ("-a", "--autoscale")]
     if "-h" in sys.argv or "--help" in sys.argv:
         print_help()
 
+    max_workers = None
     try:
         worker_count = int(sys.argv[1])
+        max_workers = worker_count
     except ValueError:
         sys.stderr.write(f"Worker count ('{sys.argv[1]}') is not an integer.\n\n")
         print_help()
@@ -96,6 +121,10 @@ def main():
     except ControllerNotRunning:
         sys.stderr.write(f"{timestamp()} Can't load the shared config. Is dns-crawler-controller running?\n")
         exit(1)
+    autoscale = autoscale or config["autoscale"]["enabled"]
+    if len(sys.argv) < 2 and config["async"]["enabled"]:
+        # each worker crawls lots of domains at once
+        worker_count = cpus
     source_ipv4, source_ipv6 = get_source_addresses(redis=redis, hostname=hostname, config=config)
     if source_ipv4 is None and source_ipv6 is None:
         sys.stderr.write(f"{timestamp()} Can't connect to the internet\n")
@@ -103,15 +132,11 @@ def main():
     sys.stderr.write(f"{timestamp()} We will use these source IPs for HTTP(S) " +
                      f"connections – IPv4: {source_ipv4}, IPv6: {source_ipv6}.\n")
 
-    commands = []
-
-    for n in range(worker_count):
-        commands.append(["dns-crawler-worker",
-                         redis_host[0],
-                         str(redis_host[1]),
-                         str(redis_host[2]),
-                         f"{hostname}-{n+1}"
-                         ])
+    pool = WorkerPool(redis_host, hostname)
+    # everything is imported and set up just once here, the workers are forked from this process
+    prefork = pool.preload()
+    if prefork:
+        sys.stderr.write(f"{timestamp()} Crawler loaded. {get_import_report()}\n")
 
     while redis.get("locked") == b"1":
         try:
@@ -120,16 +145,30 @@ def main():
         except KeyboardInterrupt:
             exit(0)
 
-    sys.stderr.write(f"{timestamp()} Starting {worker_count} workers.\n")
+    if metrics_address is not None:
+        server = serve_metrics(metrics_address, lambda: collect_metrics(redis, hostname, pool.procs))
+        pool.close_on_fork.append(server.socket)
+        sys.stderr.write(f"{timestamp()} Serving metrics on {metrics_address}.\n")
 
-    procs = []
-    for i, cmd in enumerate(commands):
-        procs.append(subprocess.Popen(cmd))
-        if i % 10 == 0:
+    if autoscale:
+        autoscaler = Autoscaler(redis, hostname, config, cpus, max_workers=max_workers)
+        sys.stderr.write(f"{timestamp()} Starting {autoscaler.min_workers} workers, " +
+                         f"autoscaling between {autoscaler.min_workers} and {autoscaler.max_workers}.\n")
+        try:
+            supervise(autoscaler, pool)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    sys.stderr.write(f"{timestamp()} Starting {worker_count} workers.\n")
+    for i in range(worker_count):
+        pool.spawn()
+        if not prefork and i % 10 == 0:
+            # each new process has to import everything on its own
             sleep(5)
 
     try:
-        for p in procs:
-            p.wait()
+        # crashed workers are replaced, their jobs are reported as failed by the controller
+        supervise(FixedSize(worker_count), pool)
     except KeyboardInterrupt:
         pass
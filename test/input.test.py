@@ -0,0 +1,38 @@
+# Copyright © 2019-2021 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from dns_crawler.config_loader import default_config_filename, load_config
+from dns_crawler.input_utils import InputNormalizer, normalize_domain
+
+assert normalize_domain("Example.CZ.\n") == ("example.cz", b"example.cz")
+assert normalize_domain("  \n") == (None, None)
+
+# fullwidth letters and dots are mapped to the name they stand for, which is what gets crawled
+assert normalize_domain("ｅｘａｍｐｌｅ．ｃｚ") == ("example.cz", b"example.cz")
+assert normalize_domain("ＥＸＡＭＰＬＥ.cz．") == ("example.cz", b"example.cz")
+assert normalize_domain("ＨÁČEK.cz") == ("háček.cz", b"xn--hek-ela4t.cz")
+
+# A-labels stay as they are
+assert normalize_domain("xn--hek-ela4t.cz") == ("xn--hek-ela4t.cz", b"xn--hek-ela4t.cz")
+
+normalizer = InputNormalizer(load_config(default_config_filename))
+domains = [normalizer.normalize(line) for line in ["example.cz", "ｅｘａｍｐｌｅ．ｃｚ", "háček.cz", "ｈáčｅｋ.cz",
+                                                   "invalid..cz", ""]]
+assert domains == ["example.cz", None, "háček.cz", None, None, None]
+assert normalizer.duplicate_count == 2
+assert normalizer.invalid_count == 1
@@ -0,0 +1,73 @@
+# Copyright © 2019-2021 CZ.NIC, z. s. p. o.
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This file is part of dns-crawler.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+
+from redis import Redis
+from rq import Connection, Queue
+from rq.registry import StartedJobRegistry
+
+from dns_crawler.config_loader import default_config_filename, load_config
+from dns_crawler.crawl import get_crawler, push_json_result
+from dns_crawler.results import ResultDecoder, read_results
+from dns_crawler.worker import CrawlerWorker, fail_orphaned_jobs
+
+redis = Redis(host=os.environ.get("REDIS_HOST", "localhost"), port=int(os.environ.get("REDIS_PORT", 6379)))
+# the workers get their config from the controller
+load_config(default_config_filename, redis, save=True)
+
+with Connection(redis):
+    crawler = get_crawler()
+    cache = crawler.local_resolver.cache
+    keys = crawler.dnssec_validator.keys
+    pool = crawler.local_resolver
+    queue = Queue("default")
+    queue.enqueue(push_json_result, "nic.cz", 0)
+    queue.enqueue(push_json_result, "nic.cz", 1)
+    worker = CrawlerWorker([queue], name="test-worker")
+
+    # the first job looks up the nameservers' and mailservers' addresses, and validates the keys of the root and cz…
+    worker.work(burst=True, max_jobs=1)
+    hits, key_hits = cache.hits, keys.hits
+    assert len(cache.entries) > 0
+    assert len(keys.entries) > 0
+    # the resolvers' response times are known from now on
+    known = [nameserver for nameserver, resolver_stats in pool.stats.items() if resolver_stats.rtt is not None]
+    assert len(known) > 0
+
+    # …and the second one gets them from the worker's caches, they weren't lost with a work horse
+    worker.work(burst=True, max_jobs=1)
+    assert cache.hits > hits
+    assert keys.hits > key_hits
+    assert all(pool.stats[nameserver].rtt is not None for nameserver in known)
+
+    # a job whose worker died while crawling stays in StartedJobRegistry until its time runs out…
+    job = queue.enqueue(push_json_result, "example.cz", 2)
+    queue.remove(job)
+    registry = StartedJobRegistry(queue=queue)
+    redis.zadd(registry.key, {job.id: 1})
+    # …then it's reported as failed
+    assert fail_orphaned_jobs(redis, queue) == 1
+    assert fail_orphaned_jobs(redis, queue) == 0
+    assert job.id not in registry
+
+results, lines, failures = ResultDecoder().decode(read_results(redis, 100))
+assert [(failure["domain"], failure["line"]) for failure in failures] == [("example.cz", 2)]
+assert sorted(lines) == [0, 1]
+assert all(json.loads(result)["domain"] == "nic.cz" for result in results)